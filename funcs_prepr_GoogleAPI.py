@@ -7,20 +7,78 @@ Created on Wed Oct 19/11/2024
 """
 
 import pandas as pd
+import numpy as np
 import os
-import time
 import googlemaps
-import json
+from geocode_metrics import timed
+from geocode_engine import RecordedError
+from geocode_countries import CountryRegistry
+from geocode_schema import init_result_columns, missing_coordinates
+from geocode_outputs import write_outputs
+from geocode_cache_store import is_sqlite_cache, load_geocode_cache_db, save_cache_db, save_cache_entry, append_cache_entry_csv, get_cities_dict_log, save_candidates_db, is_snapshot_cache, load_geocode_cache_snapshot, cache_lock, map_cache_columns, save_snapshot_entries, append_snapshot_log
+
+# Fixed types of the author file columns, so every chunk of a streamed file is read (and written) the same way,
+# whatever values the chunk has (e.g. a chunk without empty deathyear would otherwise be read as integers)
+AUTHOR_DTYPES = {
+    'indexauthor': 'Int64',
+    'starturl': str,
+    'birthyear': str,
+    'deathyear': 'float64',
+    'nameandbirthdeathyear': str,
+    'georeferenceurl': str,
+    'borncity': str,
+    'deathcity': str,
+    'activecity': str,
+}
+
+def compute_year_map(df: pd.DataFrame) -> pd.Series:
+    """
+    The year of each author used on the maps: the death year, or the birth year + 60 if the death year is empty.
+    Computed for all the rows at once, as a nullable integer column (NA if both years are empty or not numbers).
+
+    Args:
+        df (pd.DataFrame): The author data, with the birthyear and deathyear columns.
+
+    Returns:
+        pd.Series: The year_map of each author (Int32).
+    """
+    death_year = pd.to_numeric(df['deathyear'], errors='coerce')
+    birth_year = pd.to_numeric(df['birthyear'], errors='coerce')
+    return np.trunc(death_year.fillna(birth_year + 60)).astype('Int32')
 
 def load_author_data(file_path: str) -> pd.DataFrame:
     return pd.read_csv(file_path, dtype={2: str, 6: str}, low_memory=False)
 
+def read_author_chunks(file_path: str, chunk_size: int, usecols: list = None):
+    """
+    Reads the author file in chunks of chunk_size rows with the fixed types of AUTHOR_DTYPES,
+    so only one chunk is in memory at a time. The index of the rows continues from one chunk to the next.
+
+    Args:
+        file_path (str): The author CSV file.
+        chunk_size (int): Number of rows per chunk.
+        usecols (list): Columns to read (default: the columns of AUTHOR_DTYPES).
+
+    Returns:
+        Iterator of pd.DataFrame: The chunks.
+    """
+    usecols = usecols if usecols is not None else list(AUTHOR_DTYPES)
+    return pd.read_csv(file_path, usecols=usecols, dtype={col: AUTHOR_DTYPES[col] for col in usecols}, chunksize=chunk_size)
+
 def correct_column_name(df: pd.DataFrame, old_name: str, new_name: str) -> pd.DataFrame:
     if old_name in df.columns:
         df.rename(columns={old_name: new_name}, inplace=True)
     return df
 
-def load_geocode_cache(cache_file: str):
+def load_geocode_cache(cache_file: str, import_csv: str = None):
+    # SQLite cache (.db/.sqlite): indexed by city, an existing CSV cache can be imported on first use
+    if is_sqlite_cache(cache_file):
+        return load_geocode_cache_db(cache_file, import_csv)
+
+    # Columnar snapshot (.arrow/.feather/.parquet): memory-mapped, cities are looked up lazily
+    if is_snapshot_cache(cache_file):
+        return load_geocode_cache_snapshot(cache_file)
+
     if os.path.exists(cache_file):
         geocode_cache_df = pd.read_csv(cache_file)
         
@@ -39,41 +97,96 @@ def load_geocode_cache(cache_file: str):
     return geocode_cache, unique_id
 
 def save_cache(geocode_cache, cache_file: str) -> None: #source - Lucas Koren
+    if is_sqlite_cache(cache_file):
+        save_cache_db(geocode_cache, cache_file)
+        return
+
+    if is_snapshot_cache(cache_file):
+        # Only the new entries, appended to the log of the snapshot (merged into it by compact_cache_snapshot)
+        save_snapshot_entries(geocode_cache, cache_file)
+        return
+
     cache_df = pd.DataFrame.from_dict(geocode_cache, orient='index')
     cache_df.reset_index(inplace=True)
     cache_df.columns = ['city', 'coordinates', 'country', 'city_id']
 
-    # Check if the cache file exists
-    if os.path.exists(cache_file):
-        existing_df = pd.read_csv(cache_file)
-        # existing_df = pd.read_csv(cache_file, on_bad_lines='skip')
-
-        # Find new entries that are not already in the file (based on all 4 columns)
-        merged_df = pd.merge(cache_df,existing_df, on=['city', 'coordinates', 'country', 'city_id'],how='left', indicator=True)
-        new_entries = merged_df[merged_df['_merge'] == 'left_only'].drop(columns=['_merge'])
+    # The file is read and appended under a lock, so two workers never both append the same new entry
+    with cache_lock(cache_file):
+        # Check if the cache file exists
+        if os.path.exists(cache_file):
+            existing_df = pd.read_csv(cache_file)
+            # existing_df = pd.read_csv(cache_file, on_bad_lines='skip')
+
+            # Find new entries that are not already in the file (based on all 4 columns)
+            merged_df = pd.merge(cache_df,existing_df, on=['city', 'coordinates', 'country', 'city_id'],how='left', indicator=True)
+            new_entries = merged_df[merged_df['_merge'] == 'left_only'].drop(columns=['_merge'])
+
+            # Append only new entries to the file
+            if not new_entries.empty:
+                new_entries.drop_duplicates(subset=['city', 'coordinates', 'country', 'city_id'], inplace=True) ### being redundant to avoid repeated values
+                new_entries.to_csv(cache_file, mode='a', index=False, header=False, encoding='utf-8')
+        else:
+            # If the file does not exist, write the entire DataFrame as the initial cache
+            cache_df.to_csv(cache_file, index=False, encoding='utf-8')
 
-        # Append only new entries to the file
-        if not new_entries.empty:
-            new_entries.drop_duplicates(subset=['city', 'coordinates', 'country', 'city_id'], inplace=True) ### being redundant to avoid repeated values
-            new_entries.to_csv(cache_file, mode='a', index=False, header=False, encoding='utf-8')
+def save_cache_entry_to_file(cache_file: str, cache_key: str, coordinates, country, city_id) -> None:
+    """
+    Saves only one new city to the cache file, without re-reading the whole cache.
+    In SQLite the city is inserted by key, in a CSV cache the row is appended (duplicates are dropped when loading).
+    """
+    if is_sqlite_cache(cache_file):
+        save_cache_entry(cache_file, cache_key, coordinates, country, city_id)
+    elif is_snapshot_cache(cache_file):
+        with cache_lock(cache_file):
+            append_snapshot_log(pd.DataFrame([[cache_key, coordinates, country, city_id]], columns=['city', 'coordinates', 'country', 'city_id']), cache_file)
     else:
-        # If the file does not exist, write the entire DataFrame as the initial cache
-        cache_df.to_csv(cache_file, index=False, encoding='utf-8')
+        append_cache_entry_csv(cache_file, cache_key, coordinates, country, city_id)
             
-def load_or_initialize_cities_dict(filename: str) -> None:
-    if os.path.exists(filename):
-        with open(filename, 'r') as f:
-            return json.load(f)
-    else:
-        return {}  # Start with an empty dictionary if file does not exist
+def save_city_candidates(cache_file: str, city_name: str, candidates: list) -> None:
+    """
+    Saves all geocoding results of a city name, so the name is resolved from the cache on the next runs.
+    In a CSV cache the candidates are already saved as the "{city}_{coordinates}" entries.
+    """
+    if is_sqlite_cache(cache_file):
+        save_candidates_db(cache_file, city_name, candidates)
 
-def save_cities_dict_to_json(cities_dict: dict, filename=str) -> None:
-    with open(filename, 'w') as f:
-        json.dump(cities_dict, f)
-    print(f"Added {city_name} to {filename}")
+def failure_reason(error: Exception) -> str:
+    """
+    Short reason saved in the negative cache for a geocoding error, e.g. 'http_400' or 'api_INVALID_REQUEST'.
+    """
+    if isinstance(error, RecordedError):
+        return error.reason
+    if isinstance(error, googlemaps.exceptions.HTTPError):
+        return f"http_{error.status_code}"
+    if isinstance(error, googlemaps.exceptions.ApiError):
+        return f"api_{error.status}"
+    return f"exception_{type(error).__name__}"
+
+def load_or_initialize_cities_dict(filename: str) -> dict:
+    """
+    Loads cities_dict from the JSON snapshot and replays the JSON-Lines log written since the last compaction.
+    Starts with an empty dictionary if neither file exists.
+    """
+    return get_cities_dict_log(filename).load()
+
+def save_city_to_cities_dict(cities_dict: dict, city_name: str, filename: str, metrics=None) -> None:
+    """
+    Appends only city_name to the cities_dict log instead of rewriting the whole JSON file.
+    The log is compacted into the JSON snapshot periodically.
+    """
+    with timed(metrics, 'save_cities_dict_to_json'):
+        get_cities_dict_log(filename).append(cities_dict, city_name)
+    print(f"Added {city_name} to {get_cities_dict_log(filename).log_file}")
+
+def save_cities_dict_to_json(cities_dict: dict, filename: str, metrics=None) -> None:
+    """
+    Writes the whole cities_dict to the JSON file (once, at the end of the run) and empties the log.
+    """
+    with timed(metrics, 'save_cities_dict_to_json'):
+        get_cities_dict_log(filename).compact(cities_dict)
     print(f"The file has been saved to: {os.path.abspath(filename)}")
 
-def save_city_data_and_assign_city_id_column(geocode_cache, city_col: str, author, cache_key, coordinates, country, unique_id: int) -> None:
+def save_city_data_and_assign_city_id_column(geocode_cache, city_col: str, author, cache_key, coordinates, country, unique_id: int, cache_writer=None, cache_file: str = None) -> None:
     """
     Saves city data in the geocode cache, assigns city_id to respective columns, and updates the cache.
     
@@ -85,15 +198,25 @@ def save_city_data_and_assign_city_id_column(geocode_cache, city_col: str, autho
         coordinates (str): The geocoded coordinates of the city.
         country (str): The country where the city is located.
         unique_id (int): The unique city_id to be assigned.
+        cache_writer (CacheWriteBehind): Optional write-behind layer. If given, the cache entry and the city_id
+            are only enqueued and written at the next checkpoint.
+        cache_file (str): Path to the cache file the entry is saved to when there is no cache_writer.
     """
+    if cache_writer is None and cache_file is None:
+        raise ValueError("save_city_data_and_assign_city_id_column needs a cache_writer or a cache_file")
     geocode_cache[cache_key] = {'coordinates': coordinates, 'country': country, 'city_id': unique_id}
+    if cache_writer is not None:
+        cache_writer.enqueue_entry(cache_key, coordinates, country, unique_id)
+        cache_writer.enqueue_city_id(author, city_col, unique_id)
+        return
+
     if city_col == 'borncity':
         author_data.at[author, 'borncity_city_id'] = unique_id
     elif city_col == 'deathcity':
         author_data.at[author, 'deathcity_city_id'] = unique_id
     elif city_col == 'activecity':
         author_data.at[author, 'activecity_city_id'] = unique_id
-    save_cache(geocode_cache, cache_file)
+    save_cache_entry_to_file(cache_file, cache_key, coordinates, country, unique_id)
         
 def set_flag(city_col, author, country, row) -> None:
     """
@@ -118,9 +241,10 @@ def set_flag(city_col, author, country, row) -> None:
     # Get the year of discovery from the dictionary
     year_discovery_value = year_discovery.get(country, None)
 
-    # Ensure the year discovery is available and compare with the year_map
+    # Ensure the year discovery is available and compare with the year_map (a missing year_map, pd.NA in the
+    # nullable Int32 column, is never before the discovery: the flag is "no", as in americas_or_oceania_flags)
     if year_discovery_value:
-        before_year_discovery = row['year_map'] < year_discovery_value
+        before_year_discovery = pd.notna(row['year_map']) and row['year_map'] < year_discovery_value
         if before_year_discovery and is_in_americas_or_oceania:
             author_data.at[author, f'{city_col}_americas_or_oceania_before_discovery'] = "yes"
         else:
@@ -129,242 +253,27 @@ def set_flag(city_col, author, country, row) -> None:
         # If no year of discovery is available, set the flag as 'no'
         author_data.at[author, f'{city_col}_americas_or_oceania_before_discovery'] = ""
 
-def assign_unique_id(city_col, author, coordinates, id_cache) -> int:
+def assign_unique_id(city_col, author, coordinates, id_allocator) -> int:
     """
-    Assigns a unique ID to a city based on its coordinates. If the coordinates are already in the cache, 
-    the cached ID is assigned, otherwise a new ID is generated.
+    Assigns a unique ID to a city based on its coordinates. The ID comes from the persisted coordinate index
+    (quantized coordinates -> city_id), so the same coordinates get the same ID in every run.
     
     Args:
         city_col (str): The column representing the type of city (e.g., 'borncity', 'deathcity', 'activecity').
         author (int): The row index of the author in the dataset.
         coordinates (str): The geocoded coordinates of the city.
-        id_cache (dict): Cache mapping coordinates to unique IDs.
+        id_allocator (CityIdAllocator): Index mapping coordinates to unique IDs.
     
     Returns:
-        unique_id (int): The assigned or cached unique ID.
+        city_id (int): The assigned or cached unique ID.
     """
-    global unique_id  # Access the global unique ID counter
-
-    if coordinates not in id_cache:
-        id_cache[coordinates] = unique_id
-        author_data.at[author, f'{city_col}_city_id'] = unique_id
-        unique_id += 1  # Increment the ID counter for the next city
-    else:
-        author_data.at[author, f'{city_col}_city_id'] = id_cache[coordinates]
+    city_id = id_allocator.get_id(coordinates)
+    author_data.at[author, f'{city_col}_city_id'] = city_id
 
-    return unique_id  # Return the unique_id (either new or cached)
-         
-def geocode_city(city_name, year, gmaps: googlemaps.Client):
-     """
-     Geocodes a city using the Google Maps API.
-     
-     Args:
-         city_name (str): The name of the city to geocode.
-         year (int): The year for historical context (not used directly in this function).
-     
-     Returns:
-         tuple: The city name, latitude, longitude, and country code.
-     """
-     time.sleep(0.04)  # To avoid hitting API limits
-     
-     try: # to avoid HTTPError 400 - Bad request
-     
-         geocode_result = gmaps.geocode(city_name)
-         
-         # Check if there are no geocoding results
-         if len(geocode_result) == 0:
-            print(f"(Not geocoded) City {city_name} could not be geocoded. No coordinates were returned.")
-            
-            # attempt 1 -  empty cache, just column names and comas in the fist row. when run the code again, Rio Tinto shows up.
-
-            # geocode_cache[city_name] = {'coordinates': None, 'country': None, 'city_id': None} # ADDING THE CITIES NOT GEOCODED IN CACHE TOO
-            # save_cache()  # Save the cache immediately after adding an unsuccessful attempt # ADDING THE CITIES NOT GEOCODED IN CACHE TOO
-            # return city_name, None, None, None
-        
-            # attempt 2 - shows in the cache only the comas of the first row and id 1. 
-        
-            # coordinates = None
-            # country_name = None            
-            # unique_id = assign_unique_id(city_col, author, coordinates, id_cache)
-            # save_city_data_and_assign_city_id_column(city_col, author, cache_key, coordinates, country_name, unique_id)
-            # return city_name, None, None, None           
-          
-            return None
-         
-         # Initialize variables before condition checks
-         europe_location = None
-         america_oceania_location = None
-         
-         #If there is only one result for the city:
-         if len(geocode_result) == 1:
-             
-             location = geocode_result[0]['geometry']['location']
-             country_name = None
-             for component in geocode_result[0]['address_components']:
-                if "country" in component['types']:
-                    country_name = component['long_name']  # long_name for full country name
-                    break
-             coordinates = f"{location['lat']}, {location['lng']}"
-             
-                        
-             # Generate a unique city_id based on coordinates and assign it
-             unique_id = assign_unique_id(city_col, author, coordinates, id_cache)
-             
-             # Save the city and set the flag based on the discovery year
-             print(f"(Geocoded) Saving city {city_name} to cache. It has only 1 geocoding result. Coordinates: {coordinates}, country: {country_name}, city_id: {unique_id}")
-             save_city_data_and_assign_city_id_column(geocode_cache, city_col, author, cache_key, coordinates, country_name, unique_id)
-             set_flag(city_col, author, country_name, row)
-                              
-            # Check if city_name is already in cities_dict before adding
-             if city_name not in cities_dict:
-                 
-                # Add the city to the dictionary           
-                cities_dict[city_name] = {
-                    "coordinates": [coordinates],
-                    "country": [country_name],
-                    "city_id": [unique_id]
-                }
-            
-                # Save the updated dictionary to the JSON file
-                save_cities_dict_to_json(cities_dict)
-                print(f"Added {city_name} with ID {unique_id} to the dictionary.")
-             else:
-                print(f"{city_name} already exists in the dictionary. Skipping addition.")
-           
-             return city_name, location['lat'], location['lng'], country_name
-         
-         #If there are multiple results for the city name
-         elif len(geocode_result) > 1:
-             europe_location = None
-             americas_oceania_location = None
-             
-             if city_name not in cities_dict:
-                 cities_dict[city_name] = []
-               
-            #Loop through the results to check country codes     
-             for i, result in enumerate(geocode_result):
-                  location = result['geometry']['location']
-                  country_name = None
-                  for component in geocode_result[0]['address_components']:
-                     if "country" in component['types']:
-                         country_name = component['long_name']  # long_name for full country name
-                         break
-                  coordinates = f"{location['lat']}, {location['lng']}"
+    return city_id
          
-                   # Print debugging information
-                  print(f"(Geocoded) Multiple geocoding results for {city_name}, result {i+1}: Coordinates: {coordinates}, Country: {country_name}")
-             
-                   # Create a unique cache key for each location
-                  unique_cache_key = f"{city_name}_{coordinates}"
-         
-                   # Assign a unique ID for each result
-                  unique_id = assign_unique_id(city_col, author, coordinates, id_cache)
-             
-                  # Store each result in the cache with a unique city_id
-                  print(f"Saving city {city_name} with more than 1 result to cache with coordinates: {coordinates}, country: {country_name}, city_id: {unique_id}")
-                  save_city_data_and_assign_city_id_column(geocode_cache, city_col, author, unique_cache_key, coordinates, country_name, unique_id)
-                  
-                  ###############################
-                  ##########
-                  set_flag(city_col, author, country_name, row)
-                  
-                  # Add each location to the list under the city_name key in cities_dict
-                  if coordinates not in cities_dict:   
-                      
-                      cities_dict[city_name].append({
-                          "coordinates": [coordinates],
-                          "country": [country_name],
-                          "city_id": [unique_id]
-                      })
-                                                   
-                  # Save the updated dictionary to the JSON file
-                      save_cities_dict_to_json(cities_dict)
-                      print(f"Added {city_name} with ID {unique_id} to the dictionary.")
-                  else:
-                        print(f"{city_name} already exists in the dictionary. Skipping addition.")
-          
-                 
-                 #Check if the country is in Europe
-                  if country_name in european_countries:
-                      europe_location = (city_name, location["lat"], location["lng"], country_name)
-                     
-                  #Check if the country is in Americas or Oceania
-                  if country_name in americas_or_oceania_countries:
-                      america_oceania_location = (city_name, location['lat'], location['lng'], country_name)
-             
-             # Check the discovery year for countries in the Americas or Oceania
-             if america_oceania_location:
-                 country_name = america_oceania_location[3]
-                 discovery_year = year_discovery.get(country_name, None)
-                 
-                 #If the author died before the discovery year, prioritize Europe
-                 if discovery_year and year < discovery_year:
-                     if europe_location:
-                         
-                         unique_id = assign_unique_id(city_col, author, f"{europe_location[1]}, {europe_location[2]}", id_cache)
-                         print(f"(Geocoded) Saving city {city_name} to cache. It has more than 1 result for this name. Geocoded in Europe with coordinates: {coordinates}, country: {country_name}, city_id: {unique_id}")
-                         save_city_data_and_assign_city_id_column(geocode_cache, city_col, author, cache_key, f"{europe_location[1]}, {europe_location[2]}", europe_location[3], unique_id)
-                         set_flag(city_col, author, europe_location[3], row)
-                         
-                                            
-                         return europe_location
-                     
-                     else:
-                         #If no European location, prioritize any other non-Americas/Oceania location
-                         other_location = None
-                         
-                         for result in geocode_result:
-                             location = result["geometry"]["location"]
-                             country_name = None
-                             for component in geocode_result[0]['address_components']:
-                                if "country" in component['types']:
-                                    country_name = component['long_name']  # long_name for full country name
-                                    break
-                                                 
-                             #Prioritize non-Americas/Oceania countries first
-                             if country_name not in americas_or_oceania_countries and country_name not in european_countries:
-                                 other_location = (city_name, location["lat"], location["lng"], country_name)
-                                 break
-                             
-                         # If there is another location outuside Americas/Oceania, use it 
-                         if other_location:
-                             
-                             unique_id = assign_unique_id(city_col, author, f"{other_location[1]}, {other_location[2]}", id_cache)
-                             print(f" (Geocoded) Saving city {city_name} to cache.  It has more than 1 result for this name. Geocoded outside Europe and Americas/Oceania with coordinates: {coordinates}, country: {country_name}, city_id: {unique_id}")
-                             save_city_data_and_assign_city_id_column(geocode_cache, city_col, author, cache_key, f"{other_location[1]}, {other_location[2]}", other_location[3], unique_id)
-                             set_flag(city_col, author, other_location[3], row)                       
-                                                      
-                             return other_location
-                                 
-                         # If no other location is found, use Americas/Oceania location
-                         if america_oceania_location:
-                             
-                             unique_id = assign_unique_id(city_col, author, f"{america_oceania_location[1]}, {america_oceania_location[2]}", id_cache)
-                             print(f" (Geocoded) Saving city {city_name} with more than 1 result in Americas/Oceania (no option in Europe or other location) to cache with coordinates: {coordinates}, country: {country_name}, city_id: {unique_id}")
-                             save_city_data_and_assign_city_id_column(geocode_cache, city_col, author, cache_key, f"{america_oceania_location[1]}, {america_oceania_location[2]}", america_oceania_location[3], unique_id)
-                             set_flag(city_col, author, america_oceania_location[3], row)
-                                                      
-                             return america_oceania_location
-                         
-                # If the year is greater than or equal to the discovery year, use the first geocoded result
-                 elif discovery_year and year >= discovery_year:
-                   first_result = geocode_result[0]
-                   location = first_result["geometry"]["location"]
-                   country_name = None
-                   for component in first_result['address_components']:
-                       if "country" in component['types']:
-                           country_name = component['long_name']
-                           break
-           
-                   unique_id = assign_unique_id(city_col, author, f"{location['lat']}, {location['lng']}", id_cache)
-                   print(f"(Geocoded) Using first geocoded result for {city_name} with multiple results as year >= discovery year. Coordinates: {location['lat']}, {location['lng']}, country: {country_name}, city_id: {unique_id}")
-                   save_city_data_and_assign_city_id_column(geocode_cache, city_col, author, cache_key, f"{location['lat']}, {location['lng']}", country_name, unique_id)
-                   set_flag(city_col, author, country_name, row)
-           
-                   return city_name, location["lat"], location["lng"], country_name
-     except Exception as e:
-         print(f"Error geocoding {city_name}: {e}")
-         return None  # Skip to next city if an error occurs
+# geocode_city is in preprocessing_GoogleAPI.py: it uses the state of the run (geocode cache, candidates,
+# negative cache, city_id index and cities_dict), which this module does not have.
 
 
 
@@ -377,39 +286,21 @@ def map_coordinates(df, city_col, geocode_cache) -> pd.DataFrame:
     Args:
         df (pandas.DataFrame): The DataFrame containing the city data.
         city_col (str): The column name for the city ('borncity', 'deathcity', or 'activecity').
-        geocode_cache (dict): A dictionary that stores cached geocoding results.
+        geocode_cache (dict): A dictionary that stores cached geocoding results (or a columnar cache DataFrame, see map_cache_columns).
     
     Returns:
         pandas.DataFrame: Updated DataFrame with the coordinates, country, and city_id mapped.
         
     """
     
-    df[f'{city_col}_coordinates'] = df[city_col].map(lambda city: geocode_cache.get(city, {}).get('coordinates', ""))
-    df[f'{city_col}_country'] = df[city_col].map(lambda city: geocode_cache.get(city, {}).get('country', ""))
-    df[f'{city_col}_city_id'] = df[city_col].map(lambda city: geocode_cache.get(city, {}).get('city_id', ""))
-    return df
+    return map_cache_columns(df, [city_col], geocode_cache)
 
 def add_columns_to_author_data(df) -> pd.DataFrame:
-    columns_to_add = [
-        'year_map',
-        'borncity_coordinates',
-        'deathcity_coordinates',
-        'activecity_coordinates',
-        'borncity_country',
-        'deathcity_country',
-        'activecity_country',
-        'borncity_americas_or_oceania_before_discovery',
-        'deathcity_americas_or_oceania_before_discovery',
-        'activecity_americas_or_oceania_before_discovery',
-        'borncity_city_id',
-        'deathcity_city_id',
-        'activecity_city_id'
-    ]
-    
-    for col in columns_to_add:
-        df[col] = ""
-    
-    return df
+    """
+    Adds the empty result columns (year_map, and the coordinates, country, flag and city_id of each city column)
+    with their types: year_map and city_id are nullable Int32 instead of "" strings (see geocode_schema.py).
+    """
+    return init_result_columns(df, ['borncity', 'deathcity', 'activecity'])
 
 def ensure_utf8_encoding(column):
     def convert_to_utf8(value):
@@ -452,8 +343,112 @@ def replace_empty_NA(column: pd.Series) -> pd.Series:
 
     return column.apply(strip_spaces).replace('', pd.NA)
 
+def normalize_city_name(city_name):
+    """
+    Normalizes a city name before it is used as a cache key: strips the spaces at both ends and
+    collapses repeated spaces, so "Rio  Tinto " and "Rio Tinto" are geocoded once. Other values (NaN) are kept.
+    """
+    if isinstance(city_name, str):
+        return " ".join(city_name.split())
+    return city_name
 
-def filter_flag_and_not_geocoded_authors(author_data, csv_path_cleaned, excel_path_cleaned, csv_path_bad, excel_path_bad):
+def plan_unique_cities(author_data: pd.DataFrame, city_columns: list, geocode_candidates: dict, negative_cache: dict,
+                       force_retry: bool = False, run_started_at: float = None,
+                       countries: CountryRegistry = None) -> pd.DataFrame:
+    """
+    Planning stage of the geocoding: builds the distinct city names of all city columns before any API call,
+    so each name is geocoded once, not once per row.
+
+    Args:
+        author_data (pd.DataFrame): The author data, with year_map and normalized city columns. In streaming mode,
+            an iterable of chunks of it: each chunk is aggregated and dropped, only the distinct names are kept.
+        city_columns (list): The city columns, e.g. ['borncity', 'deathcity', 'activecity'].
+        geocode_candidates (dict): City name -> list of cached candidates (see load_geocode_candidates).
+        negative_cache (dict): City name -> failure reason and failed_at (see load_negative_cache).
+        force_retry (bool): If True, the names of the negative cache that failed before run_started_at are geocoded again.
+        run_started_at (float): Start of the run (seconds since epoch), used with force_retry.
+        countries (CountryRegistry): Region and discovery year of the countries, to tag the names whose candidate depends on year_map.
+
+    Returns:
+        pd.DataFrame: One row per distinct city name with the columns city, occurrences, city_cols, min_year, max_year,
+            status ('cached', 'negative' or 'to_geocode') and year_sensitive (True if the year range of the name
+            crosses the discovery year of one of its cached candidates, so different authors can get different candidates).
+    """
+    chunks = [author_data] if isinstance(author_data, pd.DataFrame) else author_data
+
+    def aggregate(chunk):
+        # first_cell: position of the cell in the born cities, then the death cities, then the active cities of the whole file
+        cells = pd.concat([
+            pd.DataFrame({'city': chunk[city_col], 'city_col': city_col, 'year_map': chunk['year_map'],
+                          'first_cell': i * 2 ** 40 + np.asarray(chunk.index, dtype=np.int64)})
+            for i, city_col in enumerate(city_columns)
+        ], ignore_index=True)
+        cells = cells[cells['city'].notna() & (cells['city'] != "")]
+
+        return cells.groupby('city', sort=False).agg(
+            first_cell=('first_cell', 'min'),
+            occurrences=('city_col', 'size'),
+            city_cols=('city_col', lambda cols: ",".join(sorted(set(cols)))),
+            min_year=('year_map', 'min'),
+            max_year=('year_map', 'max'),
+        ).reset_index()
+
+    # The names are in the order of their first cell, also when the chunks are combined
+    plan = pd.concat([aggregate(chunk) for chunk in chunks], ignore_index=True)
+    plan = plan.groupby('city', sort=False).agg(
+        first_cell=('first_cell', 'min'),
+        occurrences=('occurrences', 'sum'),
+        city_cols=('city_cols', lambda cols: ",".join(sorted(set(",".join(cols).split(","))))),
+        min_year=('min_year', 'min'),
+        max_year=('max_year', 'max'),
+    ).reset_index()
+    plan = plan.sort_values('first_cell', kind='stable').drop(columns='first_cell').reset_index(drop=True)
+
+    def status(city_name):
+        if city_name in geocode_candidates:
+            return 'cached'
+        if city_name in negative_cache:
+            failed_before_this_run = run_started_at is None or negative_cache[city_name]['failed_at'] < run_started_at
+            if not (force_retry and failed_before_this_run):
+                return 'negative'
+        return 'to_geocode'
+
+    def year_sensitive(city_name, min_year, max_year):
+        # Only known for cached names, the candidates of the others are not known before the API call
+        if city_name not in geocode_candidates or countries is None:
+            return None
+        for candidate in geocode_candidates[city_name]:
+            discovery_year = countries.discovery_year(candidate.get('country'))
+            if (countries.is_americas_or_oceania(candidate.get('country')) and discovery_year and pd.notna(min_year)
+                    and min_year < discovery_year <= max_year):
+                return True
+        return False
+
+    plan['status'] = [status(city_name) for city_name in plan['city']]
+    plan['year_sensitive'] = [year_sensitive(city_name, min_year, max_year)
+                              for city_name, min_year, max_year in plan[['city', 'min_year', 'max_year']].itertuples(index=False)]
+    return plan
+
+def plan_report(plan: pd.DataFrame) -> dict:
+    """
+    Summary of the plan (dry-run report): how many cells and distinct names there are,
+    how many are resolved from the cache or skipped, and how many API calls the run will make.
+    """
+    report = {
+        'cells': int(plan['occurrences'].sum()),
+        'distinct_names': len(plan),
+        'cached': int((plan['status'] == 'cached').sum()),
+        'negative_cache': int((plan['status'] == 'negative').sum()),
+        'api_calls': int((plan['status'] == 'to_geocode').sum()),
+        'year_sensitive': int((plan['year_sensitive'] == True).sum()),  # noqa: E712 (the column also has None)
+    }
+    print(f"Plan: {report['cells']} city cells, {report['distinct_names']} distinct city names. "
+          f"{report['cached']} in the cache ({report['year_sensitive']} depend on the author's year), "
+          f"{report['negative_cache']} skipped (negative cache), {report['api_calls']} API calls to make.")
+    return report
+
+
+def filter_flag_and_not_geocoded_authors(author_data, csv_path_cleaned, excel_path_cleaned, csv_path_bad, excel_path_bad, writer=None):
     """
     Filters out rows with a 'yes' flag for locations in the Americas or Oceania before discovery
     and rows with cities that are not geocoded, then saves the results to both CSV and Excel formats.
@@ -464,6 +459,7 @@ def filter_flag_and_not_geocoded_authors(author_data, csv_path_cleaned, excel_pa
     - excel_path_cleaned (str): File path for saving Excel output of cleaned data.
     - csv_path_bad (str): File path for saving CSV output of bad results.
     - excel_path_bad (str): File path for saving Excel output of bad results.
+    - writer (OutputWriter): Optional, writes the files (the caller closes it). None: written before returning.
     
     Returns:
     - tuple of pd.DataFrame: DataFrames with cleaned data and bad results.
@@ -481,9 +477,9 @@ def filter_flag_and_not_geocoded_authors(author_data, csv_path_cleaned, excel_pa
 
     # Create a boolean mask for rows with missing coordinates in born, death, or active cities
     not_geocoded = (
-        ((author_data["borncity"].notnull()) & (author_data["borncity_coordinates"].isnull())) |
-        ((author_data["deathcity"].notna()) & (author_data["deathcity_coordinates"].isna())) |
-        ((author_data["activecity"].notna()) & (author_data["activecity_coordinates"].isna()))
+        ((author_data["borncity"].notnull()) & missing_coordinates(author_data, "borncity")) |
+        ((author_data["deathcity"].notna()) & missing_coordinates(author_data, "deathcity")) |
+        ((author_data["activecity"].notna()) & missing_coordinates(author_data, "activecity"))
     )
 
     # Combine both conditions to filter out rows flagged with 'yes' or missing coordinates
@@ -494,11 +490,9 @@ def filter_flag_and_not_geocoded_authors(author_data, csv_path_cleaned, excel_pa
     authors_bad_results = author_data.loc[bad_results]
 
     # Save the cleaned and bad results data to separate CSV and Excel files
-    authors_cleaned.to_csv(csv_path_cleaned, index=False)
-    authors_cleaned.to_excel(excel_path_cleaned, index=False)
-    
-    authors_bad_results.to_csv(csv_path_bad, index=False)
-    authors_bad_results.to_excel(excel_path_bad, index=False)
+    # (Parquet next to the CSV, the Excel files are written by writer, see geocode_outputs.py)
+    write_outputs(authors_cleaned, csv_path_cleaned, excel_path_cleaned, writer)
+    write_outputs(authors_bad_results, csv_path_bad, excel_path_bad, writer)
 
     print(f"Number of rows in cleaned data: {authors_cleaned.shape[0]}")
     print(f"Number of rows in bad results: {authors_bad_results.shape[0]}")
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 2026
+"""
+
+# Geocoding backends queried before the Google Maps API. A backend answers a city name with
+# HIT (results in the same format as googlemaps geocode), AMBIGUOUS or MISS. Only misses and
+# ambiguous names are sent to Google (see GeocodeEngine).
+#
+# GeoNamesBackend is an offline geocoder built from the GeoNames cities dump used in
+# preprocessing_openai_API.py (https://public.opendatasoft.com/explore/dataset/geonames-all-cities-with-a-population-500/).
+# The index is built once and saved in a compact binary file (.npz):
+#   python geocode_backends.py build-geonames geonames-all-cities-with-a-population-500.csv geonames_index.npz
+
+import json
+import argparse
+from abc import ABC, abstractmethod
+import numpy as np
+import pandas as pd
+
+HIT = 'hit'
+AMBIGUOUS = 'ambiguous'
+MISS = 'miss'
+
+
+def normalize_key(city_name: str) -> str:
+    # Case-insensitive key with the spaces normalized, e.g. " rio  TINTO" -> "rio tinto"
+    return " ".join(city_name.split()).casefold()
+
+
+def google_result(lat: float, lng: float, country: str) -> dict:
+    """
+    One result in the format returned by googlemaps geocode, so the results of every backend are saved the same way.
+    """
+    return {
+        'geometry': {'location': {'lat': lat, 'lng': lng}},
+        'address_components': [{'long_name': country, 'types': ['country', 'political']}] if country else [],
+    }
+
+
+class GeocoderBackend(ABC):
+    """
+    Interface of a geocoding backend. lookup returns (status, results): status is HIT, AMBIGUOUS or MISS,
+    and results is the list of results in the googlemaps format (empty for MISS).
+    A backend without lookup can not be created (TypeError), instead of failing in the middle of a run.
+    """
+    name = 'backend'
+
+    @abstractmethod
+    def lookup(self, city_name: str):
+        pass
+
+
+class GeoNamesIndex:
+    """
+    Index of the GeoNames cities: normalized name (name, ASCII name and alternate names) -> cities,
+    with their coordinates, country and population.
+
+    The names are kept in CSR form: keys[i] has the cities rows[offsets[i]:offsets[i + 1]].
+    Saved with np.savez_compressed, the keys as one UTF-8 blob (much smaller than a numpy string array).
+    """
+
+    def __init__(self, keys: list, offsets: np.ndarray, rows: np.ndarray, lat: np.ndarray, lng: np.ndarray,
+                 population: np.ndarray, country_codes: np.ndarray, countries: list):
+        self.keys = keys
+        self.offsets = offsets
+        self.rows = rows
+        self.lat = lat
+        self.lng = lng
+        self.population = population
+        self.country_codes = country_codes
+        self.countries = countries
+        self.positions = {key: i for i, key in enumerate(keys)}
+
+    def __len__(self):
+        return len(self.lat)
+
+    @classmethod
+    def from_csv(cls, csv_path: str, delimiter: str = ';'):
+        """
+        Builds the index from the opendatasoft GeoNames CSV (columns Name, ASCII Name, Alternate Names,
+        Country name EN, Population and Coordinates as "lat, lng").
+        """
+        geonames_df = pd.read_csv(csv_path, delimiter=delimiter, low_memory=False,
+                                  usecols=['Name', 'ASCII Name', 'Alternate Names', 'Country name EN', 'Population', 'Coordinates'])
+        geonames_df = geonames_df[geonames_df['Coordinates'].notna() & geonames_df['Name'].notna()].reset_index(drop=True)
+
+        coordinates = geonames_df['Coordinates'].str.split(',', n=1, expand=True)
+        lat = coordinates[0].astype(float).to_numpy()
+        lng = coordinates[1].astype(float).to_numpy()
+        population = pd.to_numeric(geonames_df['Population'], errors='coerce').fillna(0).astype(np.int64).to_numpy()
+        country_codes, countries = pd.factorize(geonames_df['Country name EN'])
+
+        rows_by_key = {}
+        for row, (name, ascii_name, alternate_names) in enumerate(
+                geonames_df[['Name', 'ASCII Name', 'Alternate Names']].itertuples(index=False)):
+            names = [name, ascii_name]
+            if isinstance(alternate_names, str):
+                names += alternate_names.split(',')
+            for key in {normalize_key(value) for value in names if isinstance(value, str) and value.strip()}:
+                rows_by_key.setdefault(key, []).append(row)
+
+        keys = sorted(rows_by_key)
+        offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(rows_by_key[key]) for key in keys])
+        rows = np.fromiter((row for key in keys for row in rows_by_key[key]), dtype=np.int32, count=int(offsets[-1]))
+
+        return cls(keys, offsets, rows, lat, lng, population, country_codes.astype(np.int32),
+                   [None if pd.isna(country) else country for country in countries])
+
+    def save(self, index_path: str) -> None:
+        np.savez_compressed(
+            index_path,
+            keys=np.frombuffer("\n".join(self.keys).encode('utf-8'), dtype=np.uint8),
+            offsets=self.offsets, rows=self.rows, lat=self.lat, lng=self.lng, population=self.population,
+            country_codes=self.country_codes,
+            countries=np.frombuffer(json.dumps(self.countries).encode('utf-8'), dtype=np.uint8),
+        )
+
+    @classmethod
+    def load(cls, index_path: str):
+        with np.load(index_path) as data:
+            keys = data['keys'].tobytes().decode('utf-8').split("\n")
+            countries = json.loads(data['countries'].tobytes().decode('utf-8'))
+            return cls(keys, data['offsets'], data['rows'], data['lat'], data['lng'], data['population'],
+                       data['country_codes'], countries)
+
+    def candidates(self, city_name: str) -> list:
+        """
+        All the cities with this name, the most populated first.
+
+        Returns:
+            list: Dictionaries with lat, lng, country and population.
+        """
+        position = self.positions.get(normalize_key(city_name))
+        if position is None:
+            return []
+        rows = self.rows[self.offsets[position]:self.offsets[position + 1]]
+        rows = rows[np.argsort(-self.population[rows], kind='stable')]
+        return [{'lat': float(self.lat[row]), 'lng': float(self.lng[row]),
+                 'country': self.countries[self.country_codes[row]] if self.country_codes[row] >= 0 else None,
+                 'population': int(self.population[row])} for row in rows]
+
+
+class GeoNamesBackend(GeocoderBackend):
+    """
+    Offline geocoder built on a GeoNamesIndex.
+
+    A name with one city is a HIT. A name with several cities (homonyms such as Springfield) is AMBIGUOUS and is
+    sent to Google, unless the most populated city dominates: it has at least dominance times the inhabitants
+    of the second one (Paris, France and Paris, Texas). Then only that city is returned as a HIT.
+    GeoNames can not tell which homonym an author means, and returning several cities would let year_map pick
+    a small town over the place Google would have answered.
+
+    Args:
+        index (GeoNamesIndex): The GeoNames index.
+        dominance (float): Ratio of inhabitants between the first and the second city of a name needed to answer locally.
+        min_population (int): Cities with less inhabitants are ignored.
+    """
+    name = 'geonames'
+
+    def __init__(self, index: GeoNamesIndex, dominance: float = 10.0, min_population: int = 0):
+        self.index = index
+        self.dominance = dominance
+        self.min_population = min_population
+
+    @classmethod
+    def from_file(cls, path: str, **kwargs):
+        """
+        Loads the index from a .npz file, or builds it from the GeoNames CSV and saves it next to it (.npz).
+        """
+        if path.endswith('.csv'):
+            index = GeoNamesIndex.from_csv(path)
+            index.save(path[:-len('.csv')] + '.npz')
+        else:
+            index = GeoNamesIndex.load(path)
+        return cls(index, **kwargs)
+
+    def lookup(self, city_name: str):
+        candidates = [candidate for candidate in self.index.candidates(city_name) if candidate['population'] >= self.min_population]
+        if not candidates:
+            return MISS, []
+        # The candidates are sorted by population, the first one is the only answer if it dominates the second
+        if len(candidates) > 1 and candidates[0]['population'] < self.dominance * candidates[1]['population']:
+            return AMBIGUOUS, []
+        return HIT, [google_result(candidates[0]['lat'], candidates[0]['lng'], candidates[0]['country'])]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build the offline GeoNames index used before the Google Maps API.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build-geonames', help="build the index from the GeoNames cities CSV (';' separated)")
+    build_parser.add_argument('source')
+    build_parser.add_argument('target')
+    args = parser.parse_args()
+
+    geonames_index = GeoNamesIndex.from_csv(args.source)
+    geonames_index.save(args.target)
+    print(f"Indexed {len(geonames_index)} cities under {len(geonames_index.keys)} names in {args.target}")
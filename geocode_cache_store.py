@@ -0,0 +1,1504 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 2026
+"""
+
+# SQLite backend for the geocode cache. The city name is the primary key, so looking up
+# or inserting one city costs O(1) instead of re-reading and merging the whole cache CSV.
+
+import os
+import json
+import time
+import sqlite3
+import argparse
+import tempfile
+from contextlib import contextmanager
+from collections.abc import MutableMapping
+import numpy as np
+import pandas as pd
+from geocode_metrics import timed
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+CACHE_COLUMNS = ['city', 'coordinates', 'country', 'city_id']
+UNIT_COLUMNS = ['author', 'city_col', 'coordinates', 'country', 'city_id', 'flag']  # a resolved city cell of an author
+SQLITE_EXTENSIONS = ('.db', '.sqlite', '.sqlite3')
+SNAPSHOT_EXTENSIONS = ('.arrow', '.feather', '.parquet')
+
+# Coordinates are indexed on a grid of 1e-5 degree cells (about 1 m), as integers
+COORDINATE_GRID = 100000
+
+# Open connections, one per cache file, so repeated saves do not reconnect every time
+_connections = {}
+
+# Seconds a worker waits for another worker that is writing to the same cache
+LOCK_TIMEOUT = 60
+
+
+def is_sqlite_cache(cache_file: str) -> bool:
+    """
+    Checks if the cache file is a SQLite database (by its extension) instead of a CSV file.
+    """
+    return os.path.splitext(cache_file)[1].lower() in SQLITE_EXTENSIONS
+
+
+def open_cache_db(cache_db: str) -> sqlite3.Connection:
+    """
+    Opens (or creates) the SQLite geocode cache and makes sure the cache table exists.
+
+    Args:
+        cache_db (str): Path to the SQLite file.
+
+    Returns:
+        sqlite3.Connection: Connection to the cache database, reused by the other functions.
+    """
+    if cache_db in _connections:
+        return _connections[cache_db]
+
+    conn = sqlite3.connect(cache_db, timeout=LOCK_TIMEOUT)
+    # WAL: several workers can share the cache, readers do not block the writer and writers wait for each other
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA busy_timeout={LOCK_TIMEOUT * 1000}")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS geocode_cache ("
+        "city TEXT PRIMARY KEY, coordinates TEXT, country TEXT, city_id INTEGER)"
+    )
+    # city_id assigned to each (author, city column), saved at every checkpoint of CacheWriteBehind
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS city_id_checkpoint ("
+        "author INTEGER, city_col TEXT, city_id INTEGER, PRIMARY KEY (author, city_col))"
+    )
+    # All geocoding results of a city name, in the order returned by the API (rank)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS geocode_candidates ("
+        "city TEXT, rank INTEGER, coordinates TEXT, country TEXT, city_id INTEGER, PRIMARY KEY (city, rank))"
+    )
+    # Negative cache: city names that could not be geocoded, why, and when (seconds since epoch)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS geocode_failures ("
+        "city TEXT PRIMARY KEY, reason TEXT, failed_at REAL)"
+    )
+    # city_id of each quantized coordinate, and the next free city_id handed out in blocks (see CityIdAllocator)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS city_id_index ("
+        "lat_q INTEGER, lng_q INTEGER, city_id INTEGER, PRIMARY KEY (lat_q, lng_q))"
+    )
+    conn.execute("CREATE TABLE IF NOT EXISTS city_id_blocks (name TEXT PRIMARY KEY, next_id INTEGER)")
+    conn.commit()
+    _connections[cache_db] = conn
+    return conn
+
+
+def close_cache_db(cache_db: str) -> None:
+    conn = _connections.pop(cache_db, None)
+    if conn is not None:
+        conn.close()
+
+
+@contextmanager
+def cache_lock(cache_file: str, timeout: float = LOCK_TIMEOUT):
+    """
+    Advisory lock shared by all processes that write to the same CSV/snapshot cache (or cities_dict file).
+    Every read-merge-write of the file is done while holding it, so two workers never append the same
+    entry twice or overwrite each other's entries. The lock is a "{cache_file}.lock" file next to the cache.
+
+    Args:
+        cache_file (str): Path to the file that is protected.
+        timeout (float): Seconds to wait for the lock before raising TimeoutError.
+    """
+    lock_file = open(f"{cache_file}.lock", 'a+')
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            try:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                else:
+                    lock_file.seek(0)
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+                break
+            except OSError:
+                if time.monotonic() >= deadline:
+                    raise TimeoutError(f"Could not lock {cache_file} after {timeout} seconds")
+                time.sleep(0.01)
+        yield
+    finally:
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+        except OSError:
+            pass  # the lock was never taken (timeout)
+        lock_file.close()
+
+
+def _to_sql_value(value):
+    # pandas gives NaN for empty cells and numpy integers for city_id, SQLite needs plain Python values
+    if value is None or value is pd.NA or (isinstance(value, float) and pd.isna(value)):
+        return None
+    if hasattr(value, 'item'):
+        return value.item()
+    return value
+
+
+def import_csv_cache(cache_csv: str, cache_db: str) -> int:
+    """
+    Imports an existing geocode cache CSV (columns city, coordinates, country, city_id) into the SQLite cache.
+    Rows are inserted in file order, so if a city appears more than once the last row wins,
+    the same as load_geocode_cache does with the CSV.
+
+    Args:
+        cache_csv (str): Path to the CSV cache.
+        cache_db (str): Path to the SQLite cache.
+
+    Returns:
+        int: Number of rows imported.
+    """
+    cache_df = pd.read_csv(cache_csv)
+    cache_df.drop_duplicates(subset=CACHE_COLUMNS, inplace=True)
+
+    rows = [tuple(_to_sql_value(value) for value in row) for row in cache_df[CACHE_COLUMNS].itertuples(index=False)]
+
+    conn = open_cache_db(cache_db)
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO geocode_cache (city, coordinates, country, city_id) VALUES (?, ?, ?, ?)", rows)
+
+    print(f"Imported {len(rows)} rows from {cache_csv} into {cache_db}")
+    return len(rows)
+
+
+def export_csv_cache(cache_db: str, cache_csv: str) -> int:
+    """
+    Exports the SQLite cache to the CSV format used by the original cache file.
+    """
+    cache_df = read_cache_db(cache_db)
+    cache_df.to_csv(cache_csv, index=False, encoding='utf-8')
+    return len(cache_df)
+
+
+def read_cache_db(cache_db: str) -> pd.DataFrame:
+    conn = open_cache_db(cache_db)
+    return pd.read_sql_query("SELECT city, coordinates, country, city_id FROM geocode_cache ORDER BY rowid", conn)
+
+
+def load_geocode_cache_db(cache_db: str, import_csv: str = None):
+    """
+    Loads the geocode cache from SQLite into the same dictionary format as load_geocode_cache.
+    If the database does not exist yet and import_csv points to an existing CSV cache, the CSV is imported first.
+
+    Args:
+        cache_db (str): Path to the SQLite cache.
+        import_csv (str): Optional path to a CSV cache to import when the database is new.
+
+    Returns:
+        tuple: The geocode cache dictionary and the highest city_id in the cache.
+    """
+    is_new_db = not os.path.exists(cache_db)
+    conn = open_cache_db(cache_db)
+
+    if is_new_db and import_csv and os.path.exists(import_csv):
+        import_csv_cache(import_csv, cache_db)
+
+    geocode_cache = {}
+    for city, coordinates, country, city_id in conn.execute("SELECT city, coordinates, country, city_id FROM geocode_cache ORDER BY rowid"):
+        geocode_cache[city] = {'coordinates': coordinates, 'country': country, 'city_id': city_id}
+
+    max_id_in_cache = conn.execute("SELECT MAX(city_id) FROM geocode_cache").fetchone()[0]
+    unique_id = max_id_in_cache if max_id_in_cache is not None else 0
+
+    return geocode_cache, unique_id
+
+
+def save_cache_entry(cache_db: str, cache_key: str, coordinates, country, city_id) -> None:
+    """
+    Saves one city in the SQLite cache. Replaces the entry if the city is already there.
+
+    Args:
+        cache_db (str): Path to the SQLite cache.
+        cache_key (str): The key used for the city in the geocode cache.
+        coordinates (str): The geocoded coordinates of the city.
+        country (str): The country where the city is located.
+        city_id (int): The city_id of the city.
+    """
+    conn = open_cache_db(cache_db)
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO geocode_cache (city, coordinates, country, city_id) VALUES (?, ?, ?, ?)",
+            (cache_key, _to_sql_value(coordinates), _to_sql_value(country), _to_sql_value(city_id))
+        )
+
+
+def save_cache_db(geocode_cache: dict, cache_db: str) -> None:
+    """
+    Saves the whole geocode cache dictionary in SQLite in one transaction.
+    Kept for callers of save_cache, new code should use save_cache_entry.
+    """
+    rows = [
+        (city, _to_sql_value(data.get('coordinates')), _to_sql_value(data.get('country')), _to_sql_value(data.get('city_id')))
+        for city, data in geocode_cache.items()
+    ]
+    conn = open_cache_db(cache_db)
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO geocode_cache (city, coordinates, country, city_id) VALUES (?, ?, ?, ?)", rows)
+
+
+def append_csv_rows(df: pd.DataFrame, file_path: str) -> None:
+    """
+    Appends rows to a CSV file without reading it (the caller holds cache_lock). The header is written if the
+    file is new or empty, a last line cut by a crash is ended first, and the rows are fsync'd before returning.
+    """
+    with open(file_path, 'a+b') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size:
+            f.seek(size - 1)
+            if f.read(1) != b'\n':
+                f.write(b'\n')
+        f.write(df.to_csv(index=False, header=size == 0).encode('utf-8'))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def append_cache_entry_csv(cache_file: str, cache_key: str, coordinates, country, city_id) -> None:
+    """
+    Appends one city to the CSV cache without reading the file. Duplicated rows are dropped
+    when the cache is loaded, so appending is enough to keep the CSV cache up to date.
+    The append is done under cache_lock, so lines of different workers are never interleaved.
+    """
+    entry_df = pd.DataFrame([[cache_key, coordinates, country, city_id]], columns=CACHE_COLUMNS)
+    with cache_lock(cache_file):
+        append_csv_rows(entry_df, cache_file)
+
+
+def compact_csv_cache(cache_file: str) -> int:
+    """
+    Rewrites the CSV cache and its city_id checkpoint without their duplicated rows (temporary file + rename).
+    Only rows that are the same in every column are dropped, so the rows of a city with several entries
+    are kept. For the city_id checkpoint the last city_id of each (author, city column) is kept.
+
+    Returns:
+        int: Number of rows dropped from the cache.
+    """
+    dropped = 0
+    if os.path.exists(cache_file):
+        with cache_lock(cache_file):
+            cache_df = pd.read_csv(cache_file)
+            compacted = cache_df.drop_duplicates(keep='last')
+            dropped = len(cache_df) - len(compacted)
+            if dropped:
+                write_csv_atomic(compacted, cache_file)
+
+    checkpoint_file = city_id_checkpoint_file(cache_file)
+    if os.path.exists(checkpoint_file):
+        with cache_lock(checkpoint_file):
+            checkpoint_df = pd.read_csv(checkpoint_file)
+            compacted = checkpoint_df.drop_duplicates(subset=['author', 'city_col'], keep='last')
+            if len(compacted) < len(checkpoint_df):
+                write_csv_atomic(compacted, checkpoint_file)
+    return dropped
+
+
+def is_snapshot_cache(cache_file: str) -> bool:
+    """
+    Checks if the cache file is a columnar snapshot (Arrow IPC/Feather or Parquet).
+    """
+    return os.path.splitext(cache_file)[1].lower() in SNAPSHOT_EXTENSIONS
+
+
+def _import_pyarrow():
+    # pyarrow is only needed for the columnar snapshots: pip install pyarrow
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("Columnar cache snapshots need pyarrow (pip install pyarrow).") from e
+    return pyarrow
+
+
+def read_cache_frame(cache_file: str) -> pd.DataFrame:
+    """
+    Reads a cache in any format (CSV, SQLite or snapshot) as a DataFrame with one row per cache key (the last one wins).
+    """
+    if is_sqlite_cache(cache_file):
+        cache_df = read_cache_db(cache_file)
+    elif is_snapshot_cache(cache_file):
+        snapshot = load_cache_snapshot(cache_file)
+        cache_df = snapshot.to_dataframe()
+        snapshot.close()
+    else:
+        cache_df = pd.read_csv(cache_file)
+    cache_df = cache_df[CACHE_COLUMNS].drop_duplicates(subset='city', keep='last')
+    cache_df['city_id'] = pd.to_numeric(cache_df['city_id'], errors='coerce').astype('Int64')
+    return cache_df
+
+
+def snapshot_log_file(snapshot_file: str) -> str:
+    # The entries added to a snapshot cache are appended to this log next to it, and merged into the snapshot on close
+    return f"{os.path.splitext(snapshot_file)[0]}_log.csv"
+
+
+def read_snapshot_log(snapshot_file: str) -> pd.DataFrame:
+    """
+    Reads the entries appended to a snapshot cache since its last compaction (empty if there are none).
+    """
+    log_file = snapshot_log_file(snapshot_file)
+    if os.path.exists(log_file):
+        log_df = pd.read_csv(log_file, dtype={'city': str, 'coordinates': str, 'country': str})
+        log_df['city_id'] = pd.to_numeric(log_df['city_id'], errors='coerce').astype('Int64')
+        return log_df
+    return pd.DataFrame(columns=CACHE_COLUMNS)
+
+
+def append_snapshot_log(entries_df: pd.DataFrame, snapshot_file: str) -> None:
+    """
+    Appends new entries of a snapshot cache to its log (the caller holds cache_lock). A checkpoint costs
+    the size of the new entries, the snapshot itself is only rewritten by compact_cache_snapshot.
+    If there is no snapshot yet, the entries are written as the snapshot.
+    """
+    if not os.path.exists(snapshot_file):
+        write_cache_snapshot(entries_df, snapshot_file)
+        return
+    log_file = snapshot_log_file(snapshot_file)
+    entries_df[CACHE_COLUMNS].to_csv(log_file, mode='a', index=False, header=not os.path.exists(log_file), encoding='utf-8')
+
+
+def compact_cache_snapshot(snapshot_file: str, geocode_cache=None) -> int:
+    """
+    Merges the log of a snapshot cache into the snapshot (temporary file + rename) and empties the log.
+    Called once at the end of a run. The open snapshot cache of the run (geocode_cache) is unmapped before
+    the file is replaced, which Windows requires, and opened again on the new snapshot.
+
+    Returns:
+        int: Number of log lines merged into the snapshot.
+    """
+    log_file = snapshot_log_file(snapshot_file)
+    with cache_lock(snapshot_file):
+        if not os.path.exists(log_file):
+            return 0
+        log_lines = len(read_snapshot_log(snapshot_file))
+        cache_df = read_cache_frame(snapshot_file)
+        if isinstance(geocode_cache, SnapshotGeocodeCache):
+            geocode_cache.close()
+        try:
+            write_cache_snapshot(cache_df, snapshot_file)
+            os.remove(log_file)
+        finally:
+            if isinstance(geocode_cache, SnapshotGeocodeCache):
+                geocode_cache.open()
+    return log_lines
+
+
+def save_snapshot_entries(geocode_cache, snapshot_file: str) -> None:
+    """
+    Saves the entries of the geocode cache that are not in a snapshot cache yet, by appending them to its log.
+    For a SnapshotGeocodeCache these are the entries set since the last save, for a dictionary the entries
+    that differ from the snapshot and its log on disk.
+    """
+    with cache_lock(snapshot_file):
+        if isinstance(geocode_cache, SnapshotGeocodeCache):
+            entries_df = geocode_cache.unsaved_entries()
+        else:
+            entries_df = pd.DataFrame([[city, data.get('coordinates'), data.get('country'), data.get('city_id')]
+                                       for city, data in geocode_cache.items()], columns=CACHE_COLUMNS)
+            if os.path.exists(snapshot_file):
+                on_disk = read_cache_frame(snapshot_file)
+                on_disk = on_disk.astype(object).where(on_disk.notna(), None)
+                merged = entries_df.astype(object).where(entries_df.notna(), None).merge(on_disk, how='left', indicator=True)
+                entries_df = merged[merged['_merge'] == 'left_only'][CACHE_COLUMNS]
+        if not entries_df.empty:
+            append_snapshot_log(entries_df, snapshot_file)
+        if isinstance(geocode_cache, SnapshotGeocodeCache):
+            geocode_cache.unsaved.clear()
+
+
+def write_cache_snapshot(cache_df: pd.DataFrame, snapshot_file: str) -> None:
+    """
+    Writes the cache as a columnar snapshot, sorted by city so a city is found by binary search without
+    reading the whole file. The position column keeps the original order of the entries (the order of the
+    geocoding results of a city). .arrow/.feather files are written uncompressed, so they can be memory-mapped.
+    The file is written to a temporary file and renamed.
+    """
+    pa = _import_pyarrow()
+    cache_df = cache_df[CACHE_COLUMNS].drop_duplicates(subset='city', keep='last')
+    cache_df = cache_df.assign(position=range(len(cache_df))).sort_values('city', kind='stable')
+
+    schema = pa.schema([('city', pa.string()), ('coordinates', pa.string()), ('country', pa.string()), ('city_id', pa.int64()),
+                        ('position', pa.int64())])
+    table = pa.table({
+        'city': pa.array(cache_df['city'].astype(object).tolist(), pa.string()),
+        'coordinates': pa.array([None if pd.isna(value) else str(value) for value in cache_df['coordinates']], pa.string()),
+        'country': pa.array([None if pd.isna(value) else str(value) for value in cache_df['country']], pa.string()),
+        'city_id': pa.array([_to_sql_value(value) for value in cache_df['city_id']], pa.int64()),
+        'position': pa.array(cache_df['position'].tolist(), pa.int64()),
+    }, schema=schema)
+
+    folder = os.path.dirname(os.path.abspath(snapshot_file))
+    fd, temp_path = tempfile.mkstemp(prefix='.tmp_', suffix=os.path.splitext(snapshot_file)[1], dir=folder)
+    os.close(fd)
+    try:
+        if snapshot_file.lower().endswith('.parquet'):
+            pa.parquet.write_table(table, temp_path)
+        else:
+            with pa.OSFile(temp_path, 'wb') as sink:
+                with pa.ipc.new_file(sink, schema) as writer:
+                    writer.write_table(table)
+        os.replace(temp_path, snapshot_file)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+class SnapshotGeocodeCache(MutableMapping):
+    """
+    Geocode cache read from a columnar snapshot, used like the geocode cache dictionary.
+
+    Arrow IPC/Feather snapshots are memory-mapped, so nothing is parsed when the cache is opened: a city is found by
+    binary search on the sorted city column and only that row is turned into a dictionary. The entries of the log
+    (see snapshot_log_file) and the cities added during the run are kept in memory (new_entries). Checkpoints
+    (save_cache or CacheWriteBehind) append the new cities to the log, compact_cache_snapshot merges it on close.
+
+    Args:
+        snapshot_file (str): Path to the .arrow/.feather or .parquet snapshot.
+    """
+
+    def __init__(self, snapshot_file: str):
+        self.snapshot_file = snapshot_file
+        self.source = None
+        self.new_entries = {}
+        self.unsaved = set()  # cities set since the last save, not in the log yet
+        self.open()
+
+    def open(self) -> None:
+        """
+        Maps the snapshot and reads its log. The cities that were not saved yet are kept.
+        """
+        pa = _import_pyarrow()
+        if self.snapshot_file.lower().endswith('.parquet'):
+            self.table = pa.parquet.read_table(self.snapshot_file, memory_map=True)
+        else:
+            self.source = pa.memory_map(self.snapshot_file, 'r')
+            self.table = pa.ipc.open_file(self.source).read_all()
+        self.cities = self.table.column('city').combine_chunks()
+
+        unsaved_entries = {city: self.new_entries[city] for city in self.unsaved}
+        self.new_entries = {row.city: {'coordinates': _to_sql_value(row.coordinates), 'country': _to_sql_value(row.country),
+                                       'city_id': _to_sql_value(row.city_id)}
+                            for row in read_snapshot_log(self.snapshot_file).itertuples(index=False)}
+        self.new_entries.update(unsaved_entries)
+
+    def close(self) -> None:
+        """
+        Unmaps the snapshot. The table and the city column point into the mapping, so they are dropped first.
+        """
+        self.table = None
+        self.cities = None
+        if self.source is not None:
+            self.source.close()
+            self.source = None
+
+    def _lower_bound(self, value: str) -> int:
+        # Binary search on the sorted city column, only the compared values are read
+        low, high = 0, len(self.cities)
+        while low < high:
+            middle = (low + high) // 2
+            if self.cities[middle].as_py() < value:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _find_row(self, city) -> int:
+        row = self._lower_bound(city)
+        if row < len(self.cities) and self.cities[row].as_py() == city:
+            return row
+        return None
+
+    def _row(self, row: int) -> dict:
+        return {
+            'coordinates': self.table.column('coordinates')[row].as_py(),
+            'country': self.table.column('country')[row].as_py(),
+            'city_id': self.table.column('city_id')[row].as_py(),
+        }
+
+    def __getitem__(self, city):
+        if city in self.new_entries:
+            return self.new_entries[city]
+        row = self._find_row(city) if isinstance(city, str) else None
+        if row is None:
+            raise KeyError(city)
+        return self._row(row)
+
+    def __setitem__(self, city, data) -> None:
+        self.new_entries[city] = data
+        self.unsaved.add(city)
+
+    def __delitem__(self, city) -> None:
+        del self.new_entries[city]  # the snapshot itself is read-only
+        self.unsaved.discard(city)
+
+    def unsaved_entries(self) -> pd.DataFrame:
+        return pd.DataFrame([[city, self.new_entries[city].get('coordinates'), self.new_entries[city].get('country'),
+                              self.new_entries[city].get('city_id')] for city in self.unsaved], columns=CACHE_COLUMNS)
+
+    def __contains__(self, city) -> bool:
+        return city in self.new_entries or (isinstance(city, str) and self._find_row(city) is not None)
+
+    def __iter__(self):
+        for city in self.cities.to_pylist():
+            if city not in self.new_entries:
+                yield city
+        yield from self.new_entries
+
+    def __len__(self) -> int:
+        return len(self.cities) + sum(1 for city in self.new_entries if self._find_row(city) is None)
+
+    def items(self):
+        # Column by column instead of one row at a time, in the original order of the cache
+        table = self.table.sort_by('position')
+        columns = [table.column(name).to_pylist() for name in CACHE_COLUMNS]
+        for city, coordinates, country, city_id in zip(*columns):
+            if city not in self.new_entries:
+                yield city, {'coordinates': coordinates, 'country': country, 'city_id': city_id}
+        yield from self.new_entries.items()
+
+    def values(self):
+        return (data for _, data in self.items())
+
+    def keys_with_prefix(self, prefix: str) -> list:
+        """
+        Cache keys starting with prefix, found by binary search on the sorted city column.
+        """
+        keys = []
+        for row in range(self._lower_bound(prefix), len(self.cities)):
+            city = self.cities[row].as_py()
+            if not city.startswith(prefix):
+                break
+            keys.append(city)
+        keys.extend(city for city in self.new_entries if city.startswith(prefix) and city not in keys)
+        return keys
+
+    def candidates(self, city: str) -> list:
+        """
+        All geocoding results of a city name, the same as build_candidate_index but for one city.
+        """
+        multi_result = []
+        for cache_key in self.keys_with_prefix(f"{city}_"):
+            data = self[cache_key]
+            if cache_key == f"{city}_{data.get('coordinates')}":
+                row = self._find_row(cache_key)
+                position = self.table.column('position')[row].as_py() if row is not None else len(self.cities)
+                multi_result.append((position, {'coordinates': data.get('coordinates'), 'country': data.get('country'), 'city_id': data.get('city_id')}))
+        if multi_result:
+            # In the order the results were cached, new entries of this run last
+            return [candidate for _, candidate in sorted(multi_result, key=lambda item: item[0])]
+        if city in self:
+            data = self[city]
+            return [{'coordinates': data.get('coordinates'), 'country': data.get('country'), 'city_id': data.get('city_id')}]
+        return []
+
+    def max_city_id(self) -> int:
+        pa = _import_pyarrow()
+        snapshot_max = pa.compute.max(self.table.column('city_id')).as_py() or 0
+        return max([snapshot_max] + [data.get('city_id') or 0 for data in self.new_entries.values()])
+
+    def to_dataframe(self) -> pd.DataFrame:
+        cache_df = self.table.to_pandas().sort_values('position')[CACHE_COLUMNS]
+        if self.new_entries:
+            new_df = pd.DataFrame([[city, data.get('coordinates'), data.get('country'), data.get('city_id')]
+                                   for city, data in self.new_entries.items()], columns=CACHE_COLUMNS)
+            cache_df = pd.concat([cache_df, new_df], ignore_index=True).drop_duplicates(subset='city', keep='last')
+        return cache_df
+
+
+class SnapshotCandidateIndex(MutableMapping):
+    """
+    City name -> list of candidates for a snapshot cache, computed for each city the first time it is looked up
+    (build_candidate_index would read the whole snapshot).
+    """
+
+    def __init__(self, geocode_cache: SnapshotGeocodeCache):
+        self.geocode_cache = geocode_cache
+        self.known = {}
+
+    def __getitem__(self, city):
+        if city not in self.known:
+            candidates = self.geocode_cache.candidates(city) if isinstance(city, str) else []
+            if not candidates:
+                raise KeyError(city)
+            self.known[city] = candidates
+        return self.known[city]
+
+    def __setitem__(self, city, candidates) -> None:
+        self.known[city] = candidates
+
+    def __delitem__(self, city) -> None:
+        del self.known[city]
+
+    def __contains__(self, city) -> bool:
+        try:
+            self[city]
+            return True
+        except KeyError:
+            return False
+
+    def __iter__(self):
+        return iter(build_candidate_index(dict(self.geocode_cache.items())).keys() | self.known.keys())
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+
+def load_cache_snapshot(snapshot_file: str) -> SnapshotGeocodeCache:
+    return SnapshotGeocodeCache(snapshot_file)
+
+
+def load_geocode_cache_snapshot(snapshot_file: str):
+    """
+    Opens a snapshot cache (memory-mapped, nothing is parsed yet) in the same format as load_geocode_cache.
+
+    Returns:
+        tuple: The snapshot cache (used like the geocode cache dictionary) and the highest city_id in it.
+    """
+    geocode_cache = load_cache_snapshot(snapshot_file)
+    return geocode_cache, geocode_cache.max_city_id()
+
+
+def convert_cache(source_file: str, target_file: str) -> int:
+    """
+    Converts a cache between the CSV, SQLite and snapshot formats (chosen by the file extensions).
+
+    Returns:
+        int: Number of cache entries written.
+    """
+    cache_df = read_cache_frame(source_file)
+    if is_snapshot_cache(target_file):
+        write_cache_snapshot(cache_df, target_file)
+        # The new snapshot replaces the entries logged for the old one
+        if os.path.exists(snapshot_log_file(target_file)):
+            os.remove(snapshot_log_file(target_file))
+    elif is_sqlite_cache(target_file):
+        conn = open_cache_db(target_file)
+        rows = [tuple(_to_sql_value(value) for value in row) for row in cache_df.itertuples(index=False)]
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO geocode_cache (city, coordinates, country, city_id) VALUES (?, ?, ?, ?)", rows)
+    else:
+        write_csv_atomic(cache_df, target_file)
+    print(f"Converted {len(cache_df)} cache entries from {source_file} to {target_file}")
+    return len(cache_df)
+
+
+def parse_coordinates(coordinates: str):
+    """
+    Splits "lat, lng" coordinates into two floats. Returns (None, None) if they cannot be parsed.
+    """
+    try:
+        lat, lng = map(float, str(coordinates).split(","))
+        return lat, lng
+    except ValueError:
+        return None, None
+
+
+def quantize_coordinates(lat: float, lng: float) -> tuple:
+    """
+    Integer grid cell (1e-5 degree) of a coordinate, used as key of the city_id index instead of the "lat, lng" string.
+    """
+    return int(round(lat * COORDINATE_GRID)), int(round(lng * COORDINATE_GRID))
+
+
+class CityIdAllocator:
+    """
+    Assigns city_ids from a persisted coordinate -> city_id index, keyed on quantized integer coordinates.
+    The same place gets the same city_id in every run (and in every worker).
+
+    New city_ids are handed out in blocks of block_size: a worker reserves a block in one SQLite transaction
+    and assigns ids from it without a shared counter. If two workers index the same coordinates at the
+    same time, the first insert wins and the other worker uses that city_id (the id it had taken is left unused).
+    With a CSV cache the index is kept in memory and built from the city_ids already in the cache.
+
+    Args:
+        cache_file (str): Path to the cache (.sqlite or .csv).
+        geocode_cache (dict): The geocode cache dictionary, used to build the index the first time.
+        block_size (int): Number of city_ids reserved at once.
+    """
+
+    def __init__(self, cache_file: str, geocode_cache: dict, block_size: int = 1000):
+        self.cache_file = cache_file
+        self.block_size = block_size
+        self.index = {}  # (lat_q, lng_q) -> city_id, memory copy of the lookups already done
+        self.next_id = None
+        self.block_end = None
+
+        # Coordinates and city_ids already in the cache, the first city_id of a coordinate wins
+        existing = {}
+        for data in geocode_cache.values():
+            lat, lng = parse_coordinates(data.get('coordinates'))
+            city_id = _to_sql_value(data.get('city_id'))
+            if lat is not None and city_id is not None:
+                existing.setdefault(quantize_coordinates(lat, lng), int(city_id))
+        self.max_existing_id = max(existing.values(), default=0)
+
+        if is_sqlite_cache(cache_file):
+            conn = open_cache_db(cache_file)
+            with conn:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO city_id_index (lat_q, lng_q, city_id) VALUES (?, ?, ?)",
+                    [(lat_q, lng_q, city_id) for (lat_q, lng_q), city_id in existing.items()]
+                )
+        else:
+            self.index = existing
+
+    def get_id(self, coordinates: str) -> int:
+        """
+        Returns the city_id of the coordinates ("lat, lng"), assigning a new one if they are not indexed yet.
+        """
+        lat, lng = parse_coordinates(coordinates)
+        if lat is None:
+            raise ValueError(f"Invalid coordinates: {coordinates}")
+        key = quantize_coordinates(lat, lng)
+
+        if key in self.index:
+            return self.index[key]
+
+        if not is_sqlite_cache(self.cache_file):
+            city_id = self._take_id()
+            self.index[key] = city_id
+            return city_id
+
+        conn = open_cache_db(self.cache_file)
+        row = conn.execute("SELECT city_id FROM city_id_index WHERE lat_q = ? AND lng_q = ?", key).fetchone()
+        if row is None:
+            with conn:
+                conn.execute("INSERT OR IGNORE INTO city_id_index (lat_q, lng_q, city_id) VALUES (?, ?, ?)", key + (self._take_id(),))
+            # Read it back: if another worker indexed these coordinates first, its city_id is used
+            row = conn.execute("SELECT city_id FROM city_id_index WHERE lat_q = ? AND lng_q = ?", key).fetchone()
+
+        self.index[key] = row[0]
+        return row[0]
+
+    def _take_id(self) -> int:
+        if self.next_id is None or self.next_id >= self.block_end:
+            self._reserve_block()
+        city_id = self.next_id
+        self.next_id += 1
+        return city_id
+
+    def _reserve_block(self) -> None:
+        if not is_sqlite_cache(self.cache_file):
+            start = max(self.index.values(), default=self.max_existing_id) + 1 if self.next_id is None else self.next_id
+            self.next_id, self.block_end = start, start + self.block_size
+            return
+
+        conn = open_cache_db(self.cache_file)
+        conn.execute("BEGIN IMMEDIATE")  # locks the database, so two workers never reserve the same block
+        try:
+            row = conn.execute("SELECT next_id FROM city_id_blocks WHERE name = 'next'").fetchone()
+            if row is None:
+                max_indexed = conn.execute("SELECT MAX(city_id) FROM city_id_index").fetchone()[0] or 0
+                max_cached = conn.execute("SELECT MAX(city_id) FROM geocode_cache").fetchone()[0] or 0
+                start = max(max_indexed, max_cached, self.max_existing_id) + 1
+            else:
+                start = row[0]
+            conn.execute("INSERT OR REPLACE INTO city_id_blocks (name, next_id) VALUES ('next', ?)", (start + self.block_size,))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        self.next_id, self.block_end = start, start + self.block_size
+
+
+def is_candidate_key(cache_key: str, data: dict) -> bool:
+    # Multi-result cities were cached under "{city}_{coordinates}" keys
+    coordinates = data.get('coordinates')
+    return isinstance(coordinates, str) and cache_key.endswith(f"_{coordinates}") and len(cache_key) > len(coordinates) + 1
+
+
+def build_candidate_index(geocode_cache: dict) -> dict:
+    """
+    Builds the index city name -> list of candidates from the geocode cache dictionary.
+    Cities with more than one geocoding result were cached under "{city}_{coordinates}" keys, those are
+    grouped under the city name. A city cached only under its own name has one candidate.
+
+    Args:
+        geocode_cache (dict): The geocode cache dictionary (see load_geocode_cache).
+
+    Returns:
+        dict: City name -> list of dictionaries with coordinates, country and city_id.
+    """
+    multi_result = {}
+    single_result = {}
+    for cache_key, data in geocode_cache.items():
+        candidate = {'coordinates': data.get('coordinates'), 'country': data.get('country'), 'city_id': data.get('city_id')}
+        if is_candidate_key(cache_key, data):
+            city = cache_key[:-(len(data['coordinates']) + 1)]
+            multi_result.setdefault(city, []).append(candidate)
+        else:
+            single_result[cache_key] = [candidate]
+
+    # The entry under the plain name of a multi-result city is only the result chosen for one author, not a new candidate
+    single_result.update(multi_result)
+    return single_result
+
+
+def load_candidates_db(cache_db: str) -> dict:
+    conn = open_cache_db(cache_db)
+    candidates = {}
+    for city, coordinates, country, city_id in conn.execute(
+            "SELECT city, coordinates, country, city_id FROM geocode_candidates ORDER BY city, rank"):
+        candidates.setdefault(city, []).append({'coordinates': coordinates, 'country': country, 'city_id': city_id})
+    return candidates
+
+
+def load_geocode_candidates(cache_file: str, geocode_cache: dict) -> dict:
+    """
+    Loads the index city name -> list of candidates used to resolve a city from the cache without calling the API.
+    In SQLite the candidates table is used, cities that are only in the old cache format are indexed from geocode_cache.
+
+    Args:
+        cache_file (str): Path to the cache (.sqlite or .csv).
+        geocode_cache (dict): The geocode cache dictionary loaded from the same file.
+
+    Returns:
+        dict: City name -> list of dictionaries with coordinates, country and city_id.
+    """
+    if isinstance(geocode_cache, SnapshotGeocodeCache):
+        return SnapshotCandidateIndex(geocode_cache)
+
+    candidates = build_candidate_index(geocode_cache)
+    if is_sqlite_cache(cache_file):
+        candidates.update(load_candidates_db(cache_file))
+    return candidates
+
+
+def save_candidates_db(cache_db: str, city: str, candidates: list) -> None:
+    conn = open_cache_db(cache_db)
+    with conn:
+        _write_candidates(conn, city, candidates)
+
+
+def _write_candidates(conn: sqlite3.Connection, city: str, candidates: list) -> None:
+    conn.execute("DELETE FROM geocode_candidates WHERE city = ?", (city,))
+    conn.executemany(
+        "INSERT INTO geocode_candidates (city, rank, coordinates, country, city_id) VALUES (?, ?, ?, ?, ?)",
+        [(city, rank, _to_sql_value(c.get('coordinates')), _to_sql_value(c.get('country')), _to_sql_value(c.get('city_id')))
+         for rank, c in enumerate(candidates)]
+    )
+
+
+def write_csv_atomic(df: pd.DataFrame, file_path: str) -> None:
+    """
+    Writes a DataFrame to CSV through a temporary file in the same folder and then renames it,
+    so the file is either the old version or the new one, never half written.
+    """
+    folder = os.path.dirname(os.path.abspath(file_path))
+    fd, temp_path = tempfile.mkstemp(prefix='.tmp_', suffix='.csv', dir=folder)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8', newline='') as temp_file:
+            df.to_csv(temp_file, index=False)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_path, file_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def city_id_checkpoint_file(cache_file: str) -> str:
+    # For a CSV cache the city_id checkpoint is kept next to it
+    return f"{os.path.splitext(cache_file)[0]}_city_ids.csv"
+
+
+def load_city_id_checkpoint(cache_file: str) -> pd.DataFrame:
+    """
+    Loads the city_id assigned to each (author, city column) up to the last checkpoint.
+
+    Returns:
+        pd.DataFrame: Columns author, city_col and city_id (empty if there is no checkpoint yet).
+    """
+    if is_sqlite_cache(cache_file):
+        conn = open_cache_db(cache_file)
+        return pd.read_sql_query("SELECT author, city_col, city_id FROM city_id_checkpoint", conn)
+
+    checkpoint_file = city_id_checkpoint_file(cache_file)
+    if os.path.exists(checkpoint_file):
+        # The checkpoints are appended, the last city_id of each (author, city column) wins
+        return pd.read_csv(checkpoint_file).drop_duplicates(subset=['author', 'city_col'], keep='last').reset_index(drop=True)
+    return pd.DataFrame(columns=['author', 'city_col', 'city_id'])
+
+
+def api_usage_file(cache_file: str) -> str:
+    # The API calls of the day (for --daily-cap) are counted next to the cache, see TokenBucket
+    return f"{os.path.splitext(cache_file)[0]}_api_calls.json"
+
+
+def negative_cache_file(cache_file: str) -> str:
+    # For a CSV cache the negative cache is kept next to it
+    return f"{os.path.splitext(cache_file)[0]}_failures.csv"
+
+
+def read_negative_cache(cache_file: str) -> pd.DataFrame:
+    if is_sqlite_cache(cache_file):
+        conn = open_cache_db(cache_file)
+        return pd.read_sql_query("SELECT city, reason, failed_at FROM geocode_failures", conn)
+
+    failures_file = negative_cache_file(cache_file)
+    if os.path.exists(failures_file):
+        return pd.read_csv(failures_file)
+    return pd.DataFrame(columns=['city', 'reason', 'failed_at'])
+
+
+def load_negative_cache(cache_file: str, ttl_days: float = 30) -> dict:
+    """
+    Loads the city names that could not be geocoded and have not expired yet.
+
+    Args:
+        cache_file (str): Path to the cache (.sqlite or .csv).
+        ttl_days (float): Days after which a failed city is geocoded again. None keeps the failures forever.
+
+    Returns:
+        dict: City name -> dictionary with the failure reason ('zero_results', 'http_400', ...) and failed_at.
+    """
+    failures_df = read_negative_cache(cache_file)
+    if ttl_days is not None:
+        failures_df = failures_df[failures_df['failed_at'] >= time.time() - ttl_days * 86400]
+
+    return {city: {'reason': reason, 'failed_at': failed_at} for city, reason, failed_at in failures_df.itertuples(index=False)}
+
+
+def save_failure(cache_file: str, city: str, reason: str) -> None:
+    """
+    Saves one city that could not be geocoded in the negative cache (without the write-behind layer).
+    """
+    failed_at = time.time()
+    if is_sqlite_cache(cache_file):
+        conn = open_cache_db(cache_file)
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO geocode_failures (city, reason, failed_at) VALUES (?, ?, ?)", (city, reason, failed_at))
+        return
+
+    failures_file = negative_cache_file(cache_file)
+    failure_df = pd.DataFrame([[city, reason, failed_at]], columns=['city', 'reason', 'failed_at'])
+    with cache_lock(failures_file):
+        if os.path.exists(failures_file):
+            failure_df.to_csv(failures_file, mode='a', index=False, header=False, encoding='utf-8')
+        else:
+            failure_df.to_csv(failures_file, index=False, encoding='utf-8')
+
+
+class CacheWriteBehind:
+    """
+    Write-behind layer for the geocode cache and the city_id columns of the author data.
+
+    The geocoding code only enqueues the new cache entries and city_id assignments. They are written
+    together every flush_every entries or every flush_interval seconds (checked when something is enqueued),
+    and at the end of the run with flush(). Every flush is a checkpoint:
+    - SQLite cache: the entries and the city_ids are written in one transaction.
+    - CSV cache: the new rows of the cache and of the city_id checkpoint are appended (fsync'd), close() compacts them.
+    - Snapshot cache: the entries are appended to the log of the snapshot, close() merges it into the snapshot.
+      Appends and compactions hold cache_lock, so several workers can share the same cache without losing
+      each other's entries.
+    If the run is killed, everything up to the last checkpoint is kept (a rewritten file is never half written,
+    a line of an append cut by the crash is ended before the next append).
+
+    Args:
+        cache_file (str): Path to the cache (.sqlite or .csv).
+        geocode_cache (dict): The geocode cache dictionary (used to compact a snapshot cache).
+        author_data (pd.DataFrame): DataFrame that receives the city_id columns at every flush.
+        flush_every (int): Number of enqueued items that triggers a flush.
+        flush_interval (float): Seconds after the last flush that trigger a flush.
+        metrics (GeocodeMetrics): Optional, every flush is timed as 'save_cache'.
+        journal (ProgressJournal): Optional, its resolved units are written after the cache at every checkpoint.
+    """
+
+    def __init__(self, cache_file: str, geocode_cache: dict, author_data: pd.DataFrame = None,
+                 flush_every: int = 200, flush_interval: float = 30.0, metrics=None, journal=None):
+        self.cache_file = cache_file
+        self.geocode_cache = geocode_cache
+        self.author_data = author_data
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.metrics = metrics
+        self.journal = journal
+
+        self.pending_entries = []     # (cache_key, coordinates, country, city_id)
+        self.pending_city_ids = []    # (author, city_col, city_id)
+        self.pending_candidates = {}  # city -> list of candidates
+        self.pending_failures = {}    # city -> (reason, failed_at)
+        self.last_flush = time.monotonic()
+
+    def enqueue_entry(self, cache_key: str, coordinates, country, city_id) -> None:
+        self.pending_entries.append((cache_key, coordinates, country, city_id))
+        self._flush_if_due()
+
+    def enqueue_candidates(self, city: str, candidates: list) -> None:
+        """
+        Enqueues all geocoding results of a city name. In a CSV cache the candidates are saved
+        as the "{city}_{coordinates}" entries, so only the SQLite cache writes them separately.
+        """
+        self.pending_candidates[city] = list(candidates)
+        self.pending_failures.pop(city, None)
+        self._flush_if_due()
+
+    def enqueue_failure(self, city: str, reason: str) -> None:
+        """
+        Enqueues a city name that could not be geocoded in the negative cache.
+        A city that is geocoded later (enqueue_candidates) is removed from the negative cache at the same checkpoint.
+        """
+        self.pending_failures[city] = (reason, time.time())
+        self._flush_if_due()
+
+    def enqueue_city_id(self, author, city_col: str, city_id) -> None:
+        self.pending_city_ids.append((author, city_col, city_id))
+        self._flush_if_due()
+
+    def _flush_if_due(self) -> None:
+        pending = len(self.pending_entries) + len(self.pending_city_ids) + len(self.pending_candidates) + len(self.pending_failures)
+        if pending >= self.flush_every or time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Writes everything enqueued since the last flush (one checkpoint) and assigns the city_id columns.
+        """
+        if self.pending_entries or self.pending_city_ids or self.pending_candidates or self.pending_failures:
+            with timed(self.metrics, 'save_cache'):
+                if is_sqlite_cache(self.cache_file):
+                    self._flush_sqlite()
+                else:
+                    self._flush_csv()
+                self._assign_city_id_columns()
+        if self.journal is not None:
+            self.journal.flush()
+
+        self.pending_entries = []
+        self.pending_city_ids = []
+        self.pending_candidates = {}
+        self.pending_failures = {}
+        self.last_flush = time.monotonic()
+
+    def close(self) -> None:
+        """
+        Last checkpoint of the run, then the files are compacted: the log of a snapshot cache is merged into
+        the snapshot, the duplicated rows of a CSV cache and of its city_id checkpoint are dropped.
+        """
+        self.flush()
+        if is_snapshot_cache(self.cache_file):
+            compact_cache_snapshot(self.cache_file, self.geocode_cache)
+        elif not is_sqlite_cache(self.cache_file):
+            compact_csv_cache(self.cache_file)
+
+    def _flush_sqlite(self) -> None:
+        conn = open_cache_db(self.cache_file)
+        with conn:  # one transaction: all of the checkpoint is saved or none of it
+            conn.executemany(
+                "INSERT OR REPLACE INTO geocode_cache (city, coordinates, country, city_id) VALUES (?, ?, ?, ?)",
+                [tuple(_to_sql_value(value) for value in entry) for entry in self.pending_entries]
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO city_id_checkpoint (author, city_col, city_id) VALUES (?, ?, ?)",
+                [tuple(_to_sql_value(value) for value in assignment) for assignment in self.pending_city_ids]
+            )
+            for city, candidates in self.pending_candidates.items():
+                _write_candidates(conn, city, candidates)
+            conn.executemany("DELETE FROM geocode_failures WHERE city = ?", [(city,) for city in self.pending_candidates])
+            conn.executemany(
+                "INSERT OR REPLACE INTO geocode_failures (city, reason, failed_at) VALUES (?, ?, ?)",
+                [(city, reason, failed_at) for city, (reason, failed_at) in self.pending_failures.items()]
+            )
+
+    def _flush_csv(self) -> None:
+        # Merge-on-write: other workers may have written to the files since they were loaded
+        if self.pending_entries and is_snapshot_cache(self.cache_file):
+            # A snapshot is not rewritten at every checkpoint, the entries are appended to its log (merged on close)
+            with cache_lock(self.cache_file):
+                append_snapshot_log(pd.DataFrame(self.pending_entries, columns=CACHE_COLUMNS), self.cache_file)
+            if isinstance(self.geocode_cache, SnapshotGeocodeCache):
+                self.geocode_cache.unsaved.difference_update(entry[0] for entry in self.pending_entries)
+        elif self.pending_entries:
+            # The new rows are appended (the cost of a checkpoint does not grow with the cache), close() compacts the file
+            with cache_lock(self.cache_file):
+                pending_df = pd.DataFrame(self.pending_entries, columns=CACHE_COLUMNS)
+                pending_df['city_id'] = pd.to_numeric(pending_df['city_id'], errors='coerce').astype('Int64')
+                append_csv_rows(pending_df, self.cache_file)
+
+        if self.pending_city_ids:
+            checkpoint_file = city_id_checkpoint_file(self.cache_file)
+            with cache_lock(checkpoint_file):
+                append_csv_rows(pd.DataFrame(self.pending_city_ids, columns=['author', 'city_col', 'city_id']), checkpoint_file)
+
+        if self.pending_failures or self.pending_candidates:
+            failures_file = negative_cache_file(self.cache_file)
+            with cache_lock(failures_file):
+                failures_df = read_negative_cache(self.cache_file)
+                # A city that was geocoded in this checkpoint is no longer a failure
+                keep = ~failures_df['city'].isin(list(self.pending_candidates)) & ~failures_df['city'].isin(list(self.pending_failures))
+                if self.pending_failures or not keep.all():
+                    failures_df = pd.concat([
+                        failures_df[keep],
+                        pd.DataFrame([[city, reason, failed_at] for city, (reason, failed_at) in self.pending_failures.items()],
+                                     columns=['city', 'reason', 'failed_at'])
+                    ], ignore_index=True)
+                    write_csv_atomic(failures_df, failures_file)
+
+    def _assign_city_id_columns(self) -> None:
+        # One assignment per city column instead of one author_data.at per cell, the last value enqueued wins
+        if self.author_data is None or not self.pending_city_ids:
+            return
+        assignments = pd.DataFrame(self.pending_city_ids, columns=['author', 'city_col', 'city_id'])
+        assignments = assignments.drop_duplicates(subset=['author', 'city_col'], keep='last')
+        for city_col, group in assignments.groupby('city_col'):
+            self.author_data.loc[group['author'].values, f'{city_col}_city_id'] = group['city_id'].values
+
+
+class CitiesDictLog:
+    """
+    Append-only JSON-Lines log for cities_dict, with periodic compaction into the JSON snapshot.
+
+    Instead of dumping the whole cities_dict after every new city, only the changed city is appended
+    to the log ({"city": ..., "value": ...} per line). Every compact_every lines the dictionary is written
+    to the JSON file (temporary file + rename) and the log is emptied. Loading reads the JSON snapshot
+    and replays the log on top of it, the last line of a city wins. Appends and compactions hold cache_lock,
+    and a compaction writes what is on disk (snapshot + log), so workers sharing the file keep each other's cities.
+
+    Args:
+        filename (str): Path to the cities_dict JSON file (the snapshot). The log is the same path with .jsonl.
+        compact_every (int): Number of log lines that triggers a compaction.
+    """
+
+    def __init__(self, filename: str, compact_every: int = 1000):
+        self.filename = filename
+        self.log_file = f"{os.path.splitext(filename)[0]}.jsonl"
+        self.compact_every = compact_every
+        self.log_lines = 0
+
+    def load(self) -> dict:
+        with cache_lock(self.filename):
+            cities_dict, self.log_lines = self._read()
+        return cities_dict
+
+    def _read(self):
+        cities_dict = {}
+        if os.path.exists(self.filename):
+            with open(self.filename, 'r') as f:
+                cities_dict = json.load(f)
+
+        log_lines = 0
+        if os.path.exists(self.log_file):
+            valid_size = 0
+            with open(self.log_file, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line.decode('utf-8'))
+                    except (json.JSONDecodeError, UnicodeDecodeError):
+                        break  # last line was cut by a crash, everything before it is valid
+                    cities_dict[record['city']] = record['value']
+                    log_lines += 1
+                    valid_size += len(line)
+
+            # Drop the cut line so the next appended line starts clean
+            if valid_size < os.path.getsize(self.log_file):
+                with open(self.log_file, 'r+b') as f:
+                    f.truncate(valid_size)
+        return cities_dict, log_lines
+
+    def append(self, cities_dict: dict, city_name: str) -> None:
+        with cache_lock(self.filename):
+            with open(self.log_file, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({'city': city_name, 'value': cities_dict[city_name]}) + '\n')
+        self.log_lines += 1
+        if self.log_lines >= self.compact_every:
+            self.compact(cities_dict)
+
+    def compact(self, cities_dict: dict) -> None:
+        with cache_lock(self.filename):
+            # Cities written by other workers are in the log too, what is on disk wins over this process' copy
+            merged_dict = dict(cities_dict)
+            merged_dict.update(self._read()[0])
+            self._write_snapshot(merged_dict)
+
+            # The snapshot has everything in the log now
+            open(self.log_file, 'w').close()
+        self.log_lines = 0
+
+    def _write_snapshot(self, cities_dict: dict) -> None:
+        folder = os.path.dirname(os.path.abspath(self.filename))
+        fd, temp_path = tempfile.mkstemp(prefix='.tmp_', suffix='.json', dir=folder)
+        try:
+            with os.fdopen(fd, 'w') as temp_file:
+                json.dump(cities_dict, temp_file)
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+            os.replace(temp_path, self.filename)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+
+# One log per cities_dict file, so the number of lines since the last compaction is kept between calls
+_cities_dict_logs = {}
+
+
+def get_cities_dict_log(filename: str, compact_every: int = 1000) -> CitiesDictLog:
+    if filename not in _cities_dict_logs:
+        _cities_dict_logs[filename] = CitiesDictLog(filename, compact_every)
+    return _cities_dict_logs[filename]
+
+
+def assign_units(author_data: pd.DataFrame, units: pd.DataFrame) -> None:
+    """
+    Writes resolved units (author, city_col, coordinates, country, city_id, flag) to the result columns of
+    author_data, with one assignment per result column and city column instead of one author_data.at per cell.
+    """
+    for city_col, group in units.groupby('city_col'):
+        authors = group['author'].values
+        author_data.loc[authors, f'{city_col}_coordinates'] = group['coordinates'].values
+        author_data.loc[authors, f'{city_col}_country'] = group['country'].values
+        author_data.loc[authors, f'{city_col}_city_id'] = group['city_id'].values
+        author_data.loc[authors, f'{city_col}_americas_or_oceania_before_discovery'] = group['flag'].values
+
+
+def cache_lookup_frame(geocode_cache, city_names=None) -> pd.DataFrame:
+    """
+    The cache as a DataFrame indexed by city (columns coordinates, country and city_id, object dtype),
+    so many cities are looked up with one reindex.
+
+    Args:
+        geocode_cache: The geocode cache, city -> entry (dictionary or SnapshotGeocodeCache), or a columnar
+            cache: a DataFrame with the CACHE_COLUMNS (e.g. read_cache_frame).
+        city_names (iterable): Only the entries of these cities (default: the whole cache). Not used for a DataFrame.
+
+    Returns:
+        pd.DataFrame: One row per city of the cache.
+    """
+    if isinstance(geocode_cache, pd.DataFrame):
+        cache_df = geocode_cache.drop_duplicates(subset='city', keep='last')
+        return cache_df.set_index('city')[CACHE_COLUMNS[1:]].astype(object)
+
+    city_names = list(geocode_cache) if city_names is None else [city for city in city_names if isinstance(city, str) and city in geocode_cache]
+    entries = [geocode_cache[city] for city in city_names]
+    return pd.DataFrame({name: [entry.get(name, "") for entry in entries] for name in CACHE_COLUMNS[1:]},
+                        index=pd.Index(city_names, dtype=object, name='city'), dtype=object)
+
+
+def map_cache_columns(author_data: pd.DataFrame, city_columns: list, geocode_cache) -> pd.DataFrame:
+    """
+    Adds the coordinates, country and city_id of the cities of each city column, looked up in the cache with
+    one index lookup (get_indexer) per city column. Cities that are not in the cache (and missing values) get "".
+
+    Args:
+        author_data (pd.DataFrame): The author data.
+        city_columns (list): The city columns (e.g. ['borncity', 'deathcity', 'activecity']).
+        geocode_cache: The geocode cache or a columnar cache (see cache_lookup_frame).
+
+    Returns:
+        pd.DataFrame: author_data with the {city_col}_coordinates, {city_col}_country and {city_col}_city_id columns.
+    """
+    if isinstance(geocode_cache, pd.DataFrame):
+        lookup = cache_lookup_frame(geocode_cache)
+    else:
+        # Only the entries of the cities of author_data (a chunk uses a small part of the cache)
+        lookup = cache_lookup_frame(geocode_cache, pd.unique(author_data[city_columns].to_numpy(dtype=object).ravel()))
+
+    # One column of values per cache column, with a last "" for the cities that are not in the cache (position -1)
+    values = {name: np.append(lookup[name].to_numpy(dtype=object), "") for name in CACHE_COLUMNS[1:]}
+    for name, column in values.items():
+        column[pd.isna(column)] = ""
+
+    for city_col in city_columns:
+        positions = lookup.index.get_indexer(author_data[city_col].to_numpy(dtype=object))
+        for name, column in values.items():
+            author_data[f'{city_col}_{name}'] = column[positions]
+    return author_data
+
+
+class ResultBuffer:
+    """
+    Buffer of the resolved units of the author data, one list per field. The geocoding loop only adds to it,
+    and the units are written to author_data in bulk with apply() at the end of each chunk (see assign_units).
+    When the same (author, city column) is added more than once, the last one wins.
+    """
+
+    def __init__(self):
+        self.units = {name: [] for name in UNIT_COLUMNS}
+
+    def __len__(self):
+        return len(self.units['author'])
+
+    def add(self, author, city_col: str, coordinates, country, city_id, flag) -> None:
+        for name, value in zip(UNIT_COLUMNS, (author, city_col, coordinates, country, city_id, flag)):
+            self.units[name].append(value)
+
+    def take(self) -> pd.DataFrame:
+        """
+        Returns the buffered units as a DataFrame (one row per (author, city column)) and empties the buffer.
+        """
+        units = pd.DataFrame(self.units, columns=UNIT_COLUMNS).drop_duplicates(subset=['author', 'city_col'], keep='last')
+        self.units = {name: [] for name in UNIT_COLUMNS}
+        return units.reset_index(drop=True)
+
+    def apply(self, author_data: pd.DataFrame) -> int:
+        """
+        Writes the buffered units to author_data and empties the buffer.
+
+        Returns:
+            int: Number of units written.
+        """
+        units = self.take()
+        assign_units(author_data, units)
+        return len(units)
+
+
+def input_fingerprint(input_file: str) -> dict:
+    """
+    Identifies the input file of a run (path, size and modification time), so files written for another input are not reused.
+    """
+    return {'input_file': os.path.abspath(input_file), 'input_size': os.path.getsize(input_file),
+            'input_mtime': os.path.getmtime(input_file)}
+
+
+class ProgressJournal:
+    """
+    Journal of the (author, city column) units resolved in a run, to resume a run that was killed.
+
+    Every resolved unit is recorded with its values (coordinates, country, city_id and the americas/oceania flag)
+    as one JSON line. The lines are buffered and appended when the cache is checkpointed (CacheWriteBehind.flush
+    calls flush()), so the journal never has a unit whose cache entries were not saved yet. The first line
+    is a header that identifies the input file (path, size and modification time): a journal written
+    for another input is not used.
+
+    Only the lines not written yet are kept in memory for the units of this run. With resume=True the units of the
+    previous run are read once into a frame indexed by author, and restore() takes the rows of the authors of
+    author_data from it (one chunk at a time in streaming mode). Otherwise the journal starts empty.
+
+    Args:
+        journal_file (str): Path of the JSON-Lines journal.
+        input_file (str): The input file of the run.
+        resume (bool): Load the units of the previous run instead of starting a new journal.
+    """
+
+    def __init__(self, journal_file: str, input_file: str, resume: bool = False):
+        self.journal_file = journal_file
+        self.header = input_fingerprint(input_file)
+        self.done = pd.DataFrame(columns=UNIT_COLUMNS)  # units of the previous run, indexed by author
+        self.done_keys = set()                          # their (author, city_col)
+        self.pending = []                               # lines not written yet
+
+        if resume:
+            self.done = self._read()
+            self.done_keys = set(zip(self.done['author'], self.done['city_col']))
+        if self.done.empty:
+            self._start()
+
+    def _start(self) -> None:
+        with open(self.journal_file, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(self.header) + '\n')
+
+    def _read(self) -> pd.DataFrame:
+        empty = pd.DataFrame(columns=UNIT_COLUMNS)
+        if not os.path.exists(self.journal_file):
+            return empty
+
+        records = []
+        valid_size = 0
+        with open(self.journal_file, 'rb') as f:
+            for i, line in enumerate(f):
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                except (json.JSONDecodeError, UnicodeDecodeError):
+                    break  # last line was cut by a crash, everything before it is valid
+                if i == 0:
+                    if record != self.header:
+                        print(f"(Resume) {self.journal_file} was written for another input file, starting from the beginning.")
+                        return empty
+                else:
+                    records.append(record)
+                valid_size += len(line)
+
+        # Drop the cut line so the next appended line starts clean
+        if valid_size < os.path.getsize(self.journal_file):
+            with open(self.journal_file, 'r+b') as f:
+                f.truncate(valid_size)
+
+        # The last line of a unit wins, the index is the author so restore() can look up the authors of a chunk
+        units = pd.DataFrame(records, columns=UNIT_COLUMNS).drop_duplicates(subset=['author', 'city_col'], keep='last')
+        units.index = pd.Index(units['author'].values)
+        return units
+
+    def __len__(self):
+        return len(self.done)
+
+    def is_done(self, author, city_col: str) -> bool:
+        return (author, city_col) in self.done_keys
+
+    def record(self, author, city_col: str, coordinates, country, city_id, flag) -> None:
+        """
+        Records a resolved unit. It is written at the next flush.
+        """
+        self.pending.append({'author': _to_sql_value(author), 'city_col': city_col, 'coordinates': coordinates,
+                             'country': country, 'city_id': _to_sql_value(city_id), 'flag': flag})
+
+    def record_units(self, units: pd.DataFrame) -> None:
+        """
+        Records many resolved units at once (a DataFrame with the columns of UNIT_COLUMNS).
+        """
+        for author, city_col, coordinates, country, city_id, flag in units[UNIT_COLUMNS].itertuples(index=False):
+            self.record(author, city_col, coordinates, country, city_id, flag)
+
+    def flush(self) -> None:
+        if not self.pending:
+            return
+        with open(self.journal_file, 'a', encoding='utf-8') as f:
+            f.write(''.join(json.dumps(line) + '\n' for line in self.pending))
+            f.flush()
+            os.fsync(f.fileno())
+        self.pending = []
+
+    def restore(self, author_data: pd.DataFrame) -> int:
+        """
+        Writes the values of the journaled units of the authors of author_data back to it (one assignment per column).
+        The units are looked up by author in the index, so restoring a chunk does not go through the whole journal.
+
+        Returns:
+            int: Number of units restored.
+        """
+        if self.done.empty:
+            return 0
+        positions = self.done.index.get_indexer_for(author_data.index)
+        units = self.done.iloc[positions[positions >= 0]]
+        assign_units(author_data, units)
+        return len(units)
+
+    def remove(self) -> None:
+        # The run is complete, the next run starts from the beginning
+        self.pending = []
+        if os.path.exists(self.journal_file):
+            os.remove(self.journal_file)
+
+
+if __name__ == '__main__':
+    # Import/export of the cache between formats, e.g. to share a cache without re-parsing the CSV:
+    #   python geocode_cache_store.py export-snapshot geocode_cache.csv geocode_cache.arrow
+    #   python geocode_cache_store.py import-snapshot geocode_cache.arrow geocode_cache.csv
+    parser = argparse.ArgumentParser(description="Convert the geocode cache between CSV, SQLite and columnar snapshot files.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for command, help_text in [('export-snapshot', "write a CSV/SQLite cache as an .arrow/.feather/.parquet snapshot"),
+                               ('import-snapshot', "write a snapshot back as a CSV/SQLite cache"),
+                               ('convert', "convert between any two cache formats")]:
+        subparser = subparsers.add_parser(command, help=help_text)
+        subparser.add_argument('source')
+        subparser.add_argument('target')
+    args = parser.parse_args()
+
+    if args.command == 'export-snapshot' and not is_snapshot_cache(args.target):
+        parser.error(f"{args.target} is not a snapshot file ({', '.join(SNAPSHOT_EXTENSIONS)})")
+    if args.command == 'import-snapshot' and not is_snapshot_cache(args.source):
+        parser.error(f"{args.source} is not a snapshot file ({', '.join(SNAPSHOT_EXTENSIONS)})")
+    convert_cache(args.source, args.target)
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 2026
+"""
+
+# Registry of the countries of countries.json, built once per run: every country name (and alias) gets a
+# compact integer code, with its region (Europe, Americas/Oceania or other) and its discovery year.
+# Scalar lookups are dictionary/set lookups, and the vectorized lookups work on arrays of codes,
+# so the disambiguation and the flags compare small integers instead of scanning lists of names.
+#
+# countries.json can also have "country_aliases": {"alias": "country"} for the names the geocoder returns
+# for a country of the lists (e.g. "Czechia" for "Czech Republic"). An alias has its own code, so the
+# country columns keep the name returned by the geocoder, with the region and discovery year of the country.
+# Countries that are not in countries.json get a code (region OTHER) the first time they are seen.
+
+import json
+import numpy as np
+import pandas as pd
+
+# Regions (see CountryRegistry.regions)
+EUROPE = 0
+AMERICAS_OR_OCEANIA = 1
+OTHER = 2
+REGION_NAMES = ['europe', 'americas_or_oceania', 'other']
+
+# Code of a missing country (None, NaN or empty)
+NO_COUNTRY = -1
+
+
+class CountryRegistry:
+    """
+    Country name or alias -> code, region and discovery year.
+
+    Args:
+        countries (dict): The content of countries.json (european_countries, americas_or_oceania_countries,
+            year_discovery and optionally country_aliases).
+    """
+
+    def __init__(self, countries: dict):
+        self.names = []            # code -> name (or alias)
+        self.canonical = []        # code -> name of the country in countries.json
+        self.region_list = []      # code -> region
+        self.discovery_list = []   # code -> discovery year (NaN if unknown)
+        self.positions = {}        # name -> code
+        self._arrays = None
+
+        year_discovery = countries.get('year_discovery', {})
+        for name in countries.get('european_countries', []):
+            self._add(name, name, EUROPE, year_discovery.get(name))
+        for name in countries.get('americas_or_oceania_countries', []):
+            self._add(name, name, AMERICAS_OR_OCEANIA, year_discovery.get(name))
+        for name, year in year_discovery.items():
+            self._add(name, name, OTHER, year)
+        for alias, name in countries.get('country_aliases', {}).items():
+            code = self.positions[name]
+            self._add(alias, name, self.region_list[code], self.discovery_list[code])
+
+        self.european_countries = {name for name, region in zip(self.names, self.region_list) if region == EUROPE}
+        self.americas_or_oceania_countries = {name for name, region in zip(self.names, self.region_list) if region == AMERICAS_OR_OCEANIA}
+
+    @classmethod
+    def from_file(cls, countries_file: str = 'countries.json'):
+        with open(countries_file, 'r') as f:
+            return cls(json.load(f))
+
+    def _add(self, name: str, canonical: str, region: int, discovery_year) -> int:
+        if name in self.positions:
+            return self.positions[name]
+        self.positions[name] = len(self.names)
+        self.names.append(name)
+        self.canonical.append(canonical)
+        self.region_list.append(region)
+        self.discovery_list.append(float(discovery_year) if discovery_year else np.nan)
+        self._arrays = None
+        return self.positions[name]
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name) -> bool:
+        return name in self.positions
+
+    # Scalar lookups
+
+    def code(self, name) -> int:
+        """
+        Code of a country name, NO_COUNTRY for a missing country. A new name is added (region OTHER).
+        """
+        if not isinstance(name, str) or not name:
+            return NO_COUNTRY
+        code = self.positions.get(name)
+        return code if code is not None else self._add(name, name, OTHER, None)
+
+    def region(self, name) -> int:
+        code = self.positions.get(name) if isinstance(name, str) else None
+        return OTHER if code is None else self.region_list[code]
+
+    def discovery_year(self, name):
+        """
+        Discovery year of a country, None if it has none (like year_discovery.get(name)).
+        """
+        code = self.positions.get(name) if isinstance(name, str) else None
+        if code is None or np.isnan(self.discovery_list[code]):
+            return None
+        return int(self.discovery_list[code])
+
+    def is_european(self, name) -> bool:
+        return name in self.european_countries
+
+    def is_americas_or_oceania(self, name) -> bool:
+        return name in self.americas_or_oceania_countries
+
+    # Vectorized lookups
+
+    def _lookup_arrays(self):
+        if self._arrays is None:
+            self._arrays = (pd.Index(self.names, dtype=object), np.array(self.region_list, dtype=np.int8),
+                            np.array(self.discovery_list, dtype=np.float64))
+        return self._arrays
+
+    def codes(self, names) -> np.ndarray:
+        """
+        Codes of many country names at once (NO_COUNTRY for the missing ones). New names are added (region OTHER).
+
+        Args:
+            names (array-like): The country names.
+
+        Returns:
+            np.ndarray: The codes (int32).
+        """
+        names = pd.Index(np.asarray(names, dtype=object))
+        codes = self._lookup_arrays()[0].get_indexer(names)
+        new_names = [name for name in names[codes == NO_COUNTRY].unique() if isinstance(name, str) and name]
+        if new_names:
+            for name in new_names:
+                self._add(name, name, OTHER, None)
+            codes = self._lookup_arrays()[0].get_indexer(names)
+        return codes.astype(np.int32)
+
+    def regions(self, codes) -> np.ndarray:
+        """
+        Regions of many codes at once (OTHER for NO_COUNTRY).
+        """
+        codes = np.asarray(codes)
+        regions = self._lookup_arrays()[1]
+        return np.where(codes == NO_COUNTRY, OTHER, regions[np.maximum(codes, 0)]) if len(regions) else np.full(len(codes), OTHER, dtype=np.int8)
+
+    def discovery_years(self, codes) -> np.ndarray:
+        """
+        Discovery years of many codes at once (NaN if unknown or NO_COUNTRY).
+        """
+        codes = np.asarray(codes)
+        discovery_years = self._lookup_arrays()[2]
+        return np.where(codes == NO_COUNTRY, np.nan, discovery_years[np.maximum(codes, 0)]) if len(discovery_years) else np.full(len(codes), np.nan)
+
+    # Categorical country columns
+
+    @property
+    def dtype(self) -> pd.CategoricalDtype:
+        """
+        Categorical dtype of the country columns: the category codes are the codes of the registry.
+        """
+        return pd.CategoricalDtype(self.names)
+
+    def categorical(self, names) -> pd.Categorical:
+        """
+        The country names as a categorical (missing and empty names are NaN, written as empty cells).
+        """
+        codes = self.codes(names)
+        return pd.Categorical.from_codes(codes, dtype=self.dtype)
@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 2026
+"""
+
+# Concurrent geocoding: the API calls run in a thread pool, limited by a token bucket set to the quota
+# (queries per second and daily cap) instead of a fixed time.sleep between calls.
+# Results come back in the order of the input, so the cache is written in the same order every run.
+# Failed calls are classified: throttling and transient errors are retried with exponential backoff
+# (throttling also slows down the rate limiter), permanent errors go to the negative cache.
+
+import os
+import json
+import time
+import random
+import datetime
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import googlemaps
+from geocode_metrics import api_call
+from geocode_backends import HIT
+from geocode_cache_store import cache_lock
+
+# Error classes (see classify_error)
+THROTTLED = 'throttled'    # OVER_QUERY_LIMIT, HTTP 429: retried and the rate limit is lowered
+TRANSIENT = 'transient'    # HTTP 5xx, timeouts, connection errors, UNKNOWN_ERROR: retried
+PERMANENT = 'permanent'    # the city name itself is bad (HTTP 400, INVALID_REQUEST...): negative cache
+FATAL = 'fatal'            # the run can not continue (REQUEST_DENIED: bad API key, daily quota of the key)
+
+
+class DailyQuotaExceeded(Exception):
+    """
+    Raised by TokenBucket.acquire when the daily cap of API calls is reached.
+    """
+
+
+class RecordedError(Exception):
+    """
+    An error of a geocoding call made in another process (e.g. a shard worker, see geocode_shards.py),
+    read back from its results file with the class and the negative cache reason of the original error.
+    """
+
+    def __init__(self, message: str, error_class: str, reason: str):
+        super().__init__(message)
+        self.error_class = error_class
+        self.reason = reason
+
+
+def classify_error(error: Exception) -> str:
+    """
+    Classifies an error raised by a geocoding call as THROTTLED, TRANSIENT, PERMANENT or FATAL.
+    """
+    if isinstance(error, DailyQuotaExceeded):
+        return FATAL
+    if isinstance(error, RecordedError):
+        return error.error_class
+    if isinstance(error, googlemaps.exceptions.HTTPError):
+        if error.status_code == 429:
+            return THROTTLED
+        if error.status_code >= 500:
+            return TRANSIENT
+        return PERMANENT
+    if isinstance(error, googlemaps.exceptions.ApiError):
+        if error.status == 'OVER_QUERY_LIMIT':
+            return THROTTLED
+        if error.status == 'UNKNOWN_ERROR':
+            return TRANSIENT
+        if error.status in ('REQUEST_DENIED', 'OVER_DAILY_LIMIT'):
+            return FATAL
+        return PERMANENT
+    if isinstance(error, (googlemaps.exceptions.Timeout, googlemaps.exceptions.TransportError, TimeoutError, ConnectionError)):
+        return TRANSIENT
+    return PERMANENT
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter for THROTTLED and TRANSIENT errors.
+    The n-th retry waits a random time between 0 and min(max_delay, base_delay * 2 ** n) seconds.
+
+    Args:
+        max_retries (int): Retries after the first attempt.
+        base_delay (float): Seconds of the first backoff.
+        max_delay (float): Maximum seconds of one backoff.
+    """
+
+    def __init__(self, max_retries: int = 5, base_delay: float = 1.0, max_delay: float = 60.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def should_retry(self, error_class: str, attempt: int) -> bool:
+        return error_class in (THROTTLED, TRANSIENT) and attempt < self.max_retries
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class TokenBucket:
+    """
+    Token-bucket rate limiter shared by all the threads that call the API.
+
+    Tokens are added at qps per second, up to burst. Every API call takes one token and waits if there is none.
+    The calls of the current day are counted, and acquire raises DailyQuotaExceeded once daily_cap is reached
+    (the count starts again on the next day). With usage_file the count of the day is kept in that file, under
+    cache_lock, so a restarted run (--resume) and the processes of a sharded run share the same daily cap.
+
+    The rate adapts to throttling: throttle() halves qps (down to min_qps), and after recover_after calls
+    without throttling qps goes up again by 25%, up to the qps it was created with.
+
+    Args:
+        qps (float): Queries per second allowed by the quota.
+        burst (int): Maximum number of calls made at once after an idle period (default: qps, at least 1).
+        daily_cap (int): Maximum number of calls per day. None: no daily cap.
+        min_qps (float): Lowest rate after throttling.
+        recover_after (int): Successful calls after which the rate goes up again.
+        usage_file (str): JSON file with the number of calls of the day ({"2026-10-18": 1200}), only used with a daily_cap.
+            None: the calls are only counted in memory.
+    """
+
+    def __init__(self, qps: float = 25.0, burst: int = None, daily_cap: int = None, min_qps: float = 0.5, recover_after: int = 50,
+                 usage_file: str = None):
+        if qps <= 0:
+            raise ValueError("qps must be greater than 0")
+        self.qps = qps
+        self.max_qps = qps
+        self.min_qps = min(min_qps, qps)
+        self.recover_after = recover_after
+        self.successes = 0
+        self.last_throttle = None
+        self.burst = burst if burst is not None else max(int(qps), 1)
+        self.daily_cap = daily_cap
+        self.tokens = float(self.burst)
+        self.last_refill = time.monotonic()
+        self.day = datetime.date.today()
+        self.calls_today = 0
+        self.usage_file = usage_file if daily_cap is not None else None
+        self.lock = threading.Lock()
+        if self.usage_file is not None:
+            self.calls_today = self._read_usage()
+
+    def _read_usage(self) -> int:
+        # Calls of today written by this run or by the previous ones (a day not in the file has no calls)
+        if not os.path.exists(self.usage_file):
+            return 0
+        with open(self.usage_file) as f:
+            return json.load(f).get(self.day.isoformat(), 0)
+
+    def _write_usage(self, calls: int) -> None:
+        # Only the current day is kept, the file is replaced at once so it is never half written
+        folder = os.path.dirname(os.path.abspath(self.usage_file))
+        fd, temp_path = tempfile.mkstemp(prefix='.tmp_', suffix='.json', dir=folder)
+        try:
+            with os.fdopen(fd, 'w') as temp_file:
+                json.dump({self.day.isoformat(): calls}, temp_file)
+            os.replace(temp_path, self.usage_file)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def _count_call(self) -> bool:
+        # Counts one call of the day, False if the daily cap is already reached
+        if self.usage_file is None:
+            if self.daily_cap is not None and self.calls_today >= self.daily_cap:
+                return False
+            self.calls_today += 1
+            return True
+        with cache_lock(self.usage_file):
+            self.calls_today = self._read_usage()  # other processes may have made calls since
+            if self.calls_today >= self.daily_cap:
+                return False
+            self.calls_today += 1
+            self._write_usage(self.calls_today)
+            return True
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.qps)
+        self.last_refill = now
+
+        today = datetime.date.today()
+        if today != self.day:
+            self.day, self.calls_today = today, 0
+
+    def remaining_today(self):
+        """
+        Number of calls left today (None if there is no daily cap).
+        """
+        if self.daily_cap is None:
+            return None
+        with self.lock:
+            self._refill()
+            if self.usage_file is not None:
+                with cache_lock(self.usage_file):
+                    self.calls_today = self._read_usage()
+            return max(self.daily_cap - self.calls_today, 0)
+
+    def acquire(self) -> None:
+        """
+        Takes one token, waiting until one is available.
+        """
+        while True:
+            with self.lock:
+                self._refill()
+                if self.daily_cap is not None and self.calls_today >= self.daily_cap:
+                    raise DailyQuotaExceeded(f"Daily cap of {self.daily_cap} API calls reached")
+                if self.tokens >= 1:
+                    if not self._count_call():
+                        raise DailyQuotaExceeded(f"Daily cap of {self.daily_cap} API calls reached")
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.qps
+            time.sleep(wait)
+
+    def throttle(self) -> None:
+        """
+        Halves the rate after the API answered that we are over the query limit. The calls already in flight
+        get the same answer, so the rate is lowered at most once per second.
+        """
+        with self.lock:
+            now = time.monotonic()
+            if self.last_throttle is not None and now - self.last_throttle < 1:
+                return
+            self.last_throttle = now
+            self.qps = max(self.min_qps, self.qps / 2)
+            self.tokens = min(self.tokens, 0)
+            self.successes = 0
+            print(f"(Throttled) Rate limit lowered to {self.qps:.2f} queries per second.")
+
+    def success(self) -> None:
+        # Goes back up slowly to the configured rate
+        with self.lock:
+            if self.qps >= self.max_qps:
+                return
+            self.successes += 1
+            if self.successes >= self.recover_after:
+                self.qps = min(self.max_qps, self.qps * 1.25)
+                self.successes = 0
+
+
+class GeocodeEngine:
+    """
+    Geocodes many city names concurrently with a shared rate limiter.
+
+    Args:
+        client: The geocoding client, anything with a geocode(address) method (googlemaps.Client or a fake client).
+        rate_limiter (TokenBucket): Shared limiter. Every call waits for a token.
+        max_workers (int): Number of calls in flight at the same time.
+        metrics (GeocodeMetrics): Optional, the API calls are counted and timed, and the errors counted per class.
+        retry_policy (RetryPolicy): Backoff of the THROTTLED and TRANSIENT errors (default: RetryPolicy()).
+        backends (list): Local backends (see geocode_backends.py) queried in order before the API.
+            The first HIT is used, misses and ambiguous names go to the API.
+    """
+
+    def __init__(self, client, rate_limiter: TokenBucket = None, max_workers: int = 8, metrics=None, retry_policy: RetryPolicy = None,
+                 backends: list = None):
+        self.client = client
+        self.backends = backends if backends is not None else []
+        self.rate_limiter = rate_limiter if rate_limiter is not None else TokenBucket()
+        self.max_workers = max_workers
+        self.metrics = metrics
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+
+    def geocode(self, city_name: str):
+        """
+        One geocoding request: asks the local backends first, then waits for the rate limiter, calls the API
+        and retries THROTTLED and TRANSIENT errors with backoff. The error of the last attempt is raised if all of them failed.
+        """
+        for backend in self.backends:
+            status, geocode_result = backend.lookup(city_name)
+            if self.metrics is not None:
+                self.metrics.backend_lookup(backend.name, status)
+            if status == HIT:
+                return geocode_result
+
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire()
+            try:
+                with api_call(self.metrics):
+                    geocode_result = self.client.geocode(city_name)
+            except Exception as e:
+                error_class = classify_error(e)
+                if self.metrics is not None:
+                    self.metrics.api_error(error_class)
+                if error_class == THROTTLED:
+                    self.rate_limiter.throttle()
+                if not self.retry_policy.should_retry(error_class, attempt):
+                    raise
+                delay = self.retry_policy.backoff(attempt)
+                attempt += 1
+                print(f"(Retry {attempt}/{self.retry_policy.max_retries}) {error_class} error geocoding {city_name}: {e}. Retrying in {delay:.1f} s.")
+                if self.metrics is not None:
+                    self.metrics.retry()
+                time.sleep(delay)
+            else:
+                self.rate_limiter.success()
+                return geocode_result
+
+    def _geocode_safe(self, city_name: str):
+        # Errors are returned with the city name instead of raised, so one bad name does not stop the others
+        try:
+            return city_name, self.geocode(city_name), None
+        except Exception as e:
+            return city_name, None, e
+
+    def geocode_many(self, city_names):
+        """
+        Geocodes the city names in parallel and yields (city_name, geocode_result, error) in the order of city_names.
+        error is None if the call succeeded, otherwise geocode_result is None.
+
+        At most max_workers * 4 names are submitted ahead of the one being yielded, so the results can be written
+        back while the next calls are running. When the daily cap is reached, no more names are submitted and the
+        generator stops after the names already submitted (the rest is geocoded in the next run).
+        A FATAL error (e.g. REQUEST_DENIED) is raised, since every other call would fail the same way.
+        """
+        city_names = iter(city_names)
+        window = self.max_workers * 4
+        pending = deque()
+        quota_exceeded = False
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            def submit_next():
+                for city_name in city_names:
+                    pending.append(executor.submit(self._geocode_safe, city_name))
+                    return True
+                return False
+
+            while len(pending) < window and submit_next():
+                pass
+
+            while pending:
+                city_name, geocode_result, error = pending.popleft().result()
+                if isinstance(error, DailyQuotaExceeded):
+                    if not quota_exceeded:
+                        print(f"{error}. The remaining cities are geocoded in the next run.")
+                    quota_exceeded = True
+                    continue
+                if error is not None and classify_error(error) == FATAL:
+                    for future in pending:
+                        future.cancel()
+                    raise error
+                if not quota_exceeded:
+                    submit_next()
+                yield city_name, geocode_result, error
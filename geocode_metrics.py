@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 2026
+"""
+
+# Metrics of the geocoding stage: cache hits and misses per city column, API calls made and avoided,
+# latency of the API calls, time spent saving the cache and cities_dict, and rows per second.
+# Written as a JSON summary at the end of the run (and every N rows), to plan the API quota.
+
+import os
+import math
+import json
+import time
+import tempfile
+import threading
+from contextlib import contextmanager
+
+# Upper bounds (milliseconds) of the latency histogram buckets, the last bucket has no upper bound
+LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+# The percentiles are read from fine logarithmic buckets, each 2% wider than the previous one (from 1 microsecond),
+# so a percentile is within 2% of the observed value and the histogram keeps a few hundred counters at most,
+# however long the run is
+PERCENTILE_BUCKET_MIN_MS = 0.001
+PERCENTILE_BUCKET_GROWTH = 1.02
+
+
+class LatencyHistogram:
+    """
+    Histogram of durations with fixed buckets (LATENCY_BUCKETS_MS), plus count, total, min, max and percentiles.
+    The durations themselves are not kept: the percentiles come from fine logarithmic buckets (see PERCENTILE_BUCKET_GROWTH).
+    """
+
+    def __init__(self, buckets_ms=LATENCY_BUCKETS_MS):
+        self.buckets_ms = tuple(buckets_ms)
+        self.bucket_counts = [0] * (len(self.buckets_ms) + 1)
+        self.fine_counts = {}  # fine bucket -> number of durations
+        self.count = 0
+        self.total_ms = 0.0
+        self.min_ms = None
+        self.max_ms = None
+
+    @staticmethod
+    def _fine_bucket(milliseconds: float) -> int:
+        # Bucket i holds the durations up to PERCENTILE_BUCKET_MIN_MS * PERCENTILE_BUCKET_GROWTH ** i
+        if milliseconds <= PERCENTILE_BUCKET_MIN_MS:
+            return 0
+        return math.ceil(math.log(milliseconds / PERCENTILE_BUCKET_MIN_MS) / math.log(PERCENTILE_BUCKET_GROWTH))
+
+    def observe(self, seconds: float) -> None:
+        milliseconds = seconds * 1000
+        self.count += 1
+        self.total_ms += milliseconds
+        self.min_ms = milliseconds if self.min_ms is None else min(self.min_ms, milliseconds)
+        self.max_ms = milliseconds if self.max_ms is None else max(self.max_ms, milliseconds)
+        fine_bucket = self._fine_bucket(milliseconds)
+        self.fine_counts[fine_bucket] = self.fine_counts.get(fine_bucket, 0) + 1
+        for i, upper_bound in enumerate(self.buckets_ms):
+            if milliseconds <= upper_bound:
+                self.bucket_counts[i] += 1
+                return
+        self.bucket_counts[-1] += 1
+
+    def percentile(self, q: float) -> float:
+        # Nearest-rank percentile (milliseconds): upper bound of the fine bucket of that rank, within min and max
+        if not self.count:
+            return None
+        rank = min(max(int(round(q / 100 * self.count)), 1), self.count)
+        seen = 0
+        for fine_bucket in sorted(self.fine_counts):
+            seen += self.fine_counts[fine_bucket]
+            if seen >= rank:
+                upper_bound = PERCENTILE_BUCKET_MIN_MS * PERCENTILE_BUCKET_GROWTH ** fine_bucket
+                return round(min(max(upper_bound, self.min_ms), self.max_ms), 3)
+
+    def to_dict(self) -> dict:
+        labels = [f"<={upper_bound}ms" for upper_bound in self.buckets_ms] + [f">{self.buckets_ms[-1]}ms"]
+        count = self.count
+        return {
+            'count': count,
+            'total_ms': round(self.total_ms, 3),
+            'mean_ms': round(self.total_ms / count, 3) if count else None,
+            'min_ms': round(self.min_ms, 3) if count else None,
+            'max_ms': round(self.max_ms, 3) if count else None,
+            'p50_ms': self.percentile(50),
+            'p95_ms': self.percentile(95),
+            'p99_ms': self.percentile(99),
+            'buckets': dict(zip(labels, self.bucket_counts)),
+        }
+
+
+class GeocodeMetrics:
+    """
+    Counters and timers of one geocoding run.
+
+    The main loop calls cache_hit / cache_miss / negative_cache_hit for every city looked up (with the city name,
+    so that the API calls avoided are counted once per distinct name), and row_done
+    for every author processed. API calls are timed with api_call(), the saves with timed('save_cache')
+    or timed('save_cities_dict_to_json'). The summary is written to summary_file by write_summary()
+    at the end of the run, and every write_every rows if write_every is set.
+
+    Args:
+        summary_file (str): Path of the JSON summary. None only keeps the metrics in memory.
+        write_every (int): Write the summary every write_every rows (None: only at the end of the run).
+    """
+
+    def __init__(self, summary_file: str = None, write_every: int = None):
+        self.summary_file = summary_file
+        self.write_every = write_every
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+
+        self.cache_hits = {}           # city column -> number of cities resolved from the cache
+        self.cache_misses = {}         # city column -> number of cities not in the cache (geocoded with the API)
+        self.negative_cache_hits = {}  # city column -> number of cities skipped because of the negative cache
+        self.cached_names = set()      # distinct names resolved from the cache or the negative cache
+        self.geocoded_names = set()    # distinct names geocoded in this run (their later hits avoided no call)
+        self.api_calls = 0
+        self.api_errors = 0
+        self.api_errors_by_class = {}  # error class (see geocode_engine.classify_error) -> number of errors
+        self.api_retries = 0
+        self.backend_lookups = {}      # backend name -> {'hit': n, 'ambiguous': n, 'miss': n} (see geocode_backends.py)
+        self.api_latency = LatencyHistogram()
+        self.timers = {}               # name -> LatencyHistogram of the durations of that step
+        self.rows = 0
+        self.lock = threading.Lock()   # API calls are made from several threads (see geocode_engine.py)
+
+    @staticmethod
+    def _increment(counter: dict, city_col: str) -> None:
+        counter[city_col] = counter.get(city_col, 0) + 1
+
+    def cache_hit(self, city_col: str, city_name: str = None) -> None:
+        self._increment(self.cache_hits, city_col)
+        if city_name is not None:
+            self.cached_names.add(city_name)
+
+    def cache_miss(self, city_col: str, city_name: str = None) -> None:
+        self._increment(self.cache_misses, city_col)
+        if city_name is not None:
+            self.geocoded_names.add(city_name)
+
+    def negative_cache_hit(self, city_col: str, city_name: str = None) -> None:
+        self._increment(self.negative_cache_hits, city_col)
+        if city_name is not None:
+            self.cached_names.add(city_name)
+
+    @contextmanager
+    def api_call(self):
+        """
+        Times one call to the geocoding API. An exception raised by the call is counted as an API error.
+        Can be used from several threads at the same time.
+        """
+        start = time.perf_counter()
+        failed = False
+        try:
+            yield
+        except Exception:
+            failed = True
+            raise
+        finally:
+            with self.lock:
+                self.api_calls += 1
+                self.api_errors += failed
+                self.api_latency.observe(time.perf_counter() - start)
+
+    def api_error(self, error_class: str) -> None:
+        with self.lock:
+            self._increment(self.api_errors_by_class, error_class)
+
+    def backend_lookup(self, backend_name: str, status: str) -> None:
+        with self.lock:
+            self._increment(self.backend_lookups.setdefault(backend_name, {}), status)
+
+    def retry(self) -> None:
+        with self.lock:
+            self.api_retries += 1
+
+    @contextmanager
+    def timed(self, name: str):
+        """
+        Times a step of the run (e.g. 'save_cache'), the durations are summed and kept in a histogram per name.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timers.setdefault(name, LatencyHistogram()).observe(time.perf_counter() - start)
+
+    def row_done(self) -> None:
+        self.rows += 1
+        if self.write_every and self.rows % self.write_every == 0:
+            self.write_summary()
+
+    def summary(self) -> dict:
+        elapsed = time.perf_counter() - self.started
+        city_columns = sorted(set(self.cache_hits) | set(self.cache_misses) | set(self.negative_cache_hits))
+        lookups = sum(self.cache_hits.values()) + sum(self.cache_misses.values())
+
+        return {
+            'started_at': self.started_at,
+            'elapsed_seconds': round(elapsed, 3),
+            'rows': self.rows,
+            'rows_per_second': round(self.rows / elapsed, 3) if elapsed > 0 else None,
+            'cache': {
+                city_col: {
+                    'hits': self.cache_hits.get(city_col, 0),
+                    'misses': self.cache_misses.get(city_col, 0),
+                    'negative_cache_hits': self.negative_cache_hits.get(city_col, 0),
+                } for city_col in city_columns
+            },
+            'cache_hit_rate': round(sum(self.cache_hits.values()) / lookups, 4) if lookups else None,
+            'api_calls': self.api_calls,
+            'api_errors': self.api_errors,
+            'api_errors_by_class': dict(self.api_errors_by_class),
+            'api_retries': self.api_retries,
+            # The API is called once per distinct name, so a call is avoided once per distinct name found in the cache
+            # or the negative cache (and not geocoded in this run), and once per name answered by a local backend
+            'api_calls_avoided': (len(self.cached_names - self.geocoded_names)
+                                  + sum(lookups.get('hit', 0) for lookups in self.backend_lookups.values())),
+            # Every cell of the authors answered by the cache or the negative cache (a name is counted once per author)
+            'cells_served_from_cache': sum(self.cache_hits.values()) + sum(self.negative_cache_hits.values()),
+            'backend_lookups': {name: dict(lookups) for name, lookups in self.backend_lookups.items()},
+            'api_latency': self.api_latency.to_dict(),
+            'timers': {name: histogram.to_dict() for name, histogram in self.timers.items()},
+        }
+
+    def write_summary(self) -> dict:
+        """
+        Writes the summary to summary_file (temporary file + rename, so it is never half written) and returns it.
+        """
+        summary = self.summary()
+        if self.summary_file is None:
+            return summary
+
+        folder = os.path.dirname(os.path.abspath(self.summary_file))
+        fd, temp_path = tempfile.mkstemp(prefix='.tmp_', suffix='.json', dir=folder)
+        try:
+            with os.fdopen(fd, 'w') as temp_file:
+                json.dump(summary, temp_file, indent=2)
+            os.replace(temp_path, self.summary_file)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return summary
+
+
+@contextmanager
+def timed(metrics: GeocodeMetrics, name: str):
+    """
+    Same as metrics.timed(name), but does nothing when metrics is None (metrics are optional everywhere).
+    """
+    if metrics is None:
+        yield
+    else:
+        with metrics.timed(name):
+            yield
+
+
+@contextmanager
+def api_call(metrics: GeocodeMetrics):
+    """
+    Same as metrics.api_call(), but does nothing when metrics is None.
+    """
+    if metrics is None:
+        yield
+    else:
+        with metrics.api_call():
+            yield
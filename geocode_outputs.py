@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 2026
+"""
+
+# Output layer of the pipeline stages. Every output table is written with an OutputWriter:
+#   formats   'parquet' and/or 'feather' (fast columnar files, typed: lat/lng floats, Int32...) and 'csv'
+#             (the legacy format of geocode_schema.legacy_view, read by the current consumers).
+#             The columnar files are written next to the CSV file, with the same name (output.csv -> output.parquet).
+#   excel     'background': the .xlsx is written by a worker thread, the stage does not wait for it (close() waits)
+#             'inline':     written before write() returns (as before)
+#             'deferred':   not written, export it later with: python geocode_outputs.py export-excel output.parquet output.xlsx
+#             'off':        not written
+#   csv_engine 'pandas' (default: same bytes as before) or 'pyarrow' (faster, numbers and quotes are written the arrow way).
+#
+# The columnar formats need pyarrow (pip install pyarrow). Without it they are skipped with a warning and the CSV is written.
+# Each stage owns its OutputWriter and closes it: close() waits for the Excel files written in the background and
+# raises their errors. write_outputs without a writer writes the table (and its Excel file) before returning.
+# Read the files back with geocode_schema.read_author_output (CSV, Parquet or Feather).
+
+import os
+import argparse
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from geocode_schema import legacy_view
+
+OUTPUT_FORMATS = ('parquet', 'feather', 'csv')
+COLUMNAR_EXTENSIONS = {'parquet': '.parquet', 'feather': '.feather'}
+EXCEL_MODES = ('background', 'inline', 'deferred', 'off')
+CSV_ENGINES = ('pandas', 'pyarrow')
+
+
+def _import_pyarrow():
+    # Returns None if pyarrow is not installed, the columnar formats are then skipped
+    try:
+        import pyarrow
+        import pyarrow.csv
+        import pyarrow.parquet
+    except ImportError:
+        return None
+    return pyarrow
+
+
+def output_path(csv_path: str, output_format: str) -> str:
+    """
+    Path of the file of an output format, next to the CSV file (output.csv -> output.parquet).
+    """
+    if output_format == 'csv':
+        return csv_path
+    return os.path.splitext(csv_path)[0] + COLUMNAR_EXTENSIONS[output_format]
+
+
+def _is_geodataframe(df) -> bool:
+    return hasattr(df, 'geometry') and type(df).__name__ == 'GeoDataFrame'
+
+
+def arrow_table(df: pd.DataFrame, schema=None):
+    """
+    The DataFrame as an arrow table. Categorical columns are stored as strings (Parquet dictionary-encodes them,
+    read_author_output makes them categorical again) and object columns with mixed types are stored as strings.
+
+    Args:
+        df (pd.DataFrame): The table.
+        schema (pyarrow.Schema): Schema of the table (the one of the first chunk in streaming mode).
+
+    Returns:
+        pyarrow.Table: The table.
+    """
+    pa = _import_pyarrow()
+    df = df.copy(deep=False)
+    for column in df.columns:
+        if isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype(object)
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        for column in df.columns:
+            if df[column].dtype == object:
+                df[column] = [None if pd.isna(value) else str(value) for value in df[column]]
+        table = pa.Table.from_pandas(df, preserve_index=False)
+
+    if schema is None:
+        # Columns without any value (e.g. activecity_country in the first chunk) are typed as strings, not null
+        schema = pa.schema([pa.field(field.name, pa.string()) if pa.types.is_null(field.type) else field for field in table.schema],
+                           metadata=table.schema.metadata)
+    return table.cast(schema) if not table.schema.equals(schema, check_metadata=False) else table
+
+
+def write_csv(df: pd.DataFrame, csv_path: str, engine: str = 'pandas', append: bool = False) -> None:
+    """
+    Writes a CSV file with pandas or with the multithreaded CSV writer of pyarrow.
+    """
+    if engine == 'pyarrow':
+        pa = _import_pyarrow()
+        if pa is not None:
+            table = arrow_table(df)
+            with open(csv_path, 'ab' if append else 'wb') as sink:
+                pa.csv.write_csv(table, sink, pa.csv.WriteOptions(include_header=not append))
+            return
+    df.to_csv(csv_path, mode='a' if append else 'w', header=not append, index=False)
+
+
+def write_excel(df: pd.DataFrame, excel_path: str) -> None:
+    df.to_excel(excel_path, index=False)
+
+
+class ExcelAppender:
+    """
+    Writes an Excel file chunk by chunk, for the streaming mode. The rows are written with an openpyxl
+    write-only workbook, which streams them to a temporary file instead of keeping the whole sheet in memory.
+
+    Args:
+        excel_file (str): Path of the Excel file, written by close().
+    """
+
+    def __init__(self, excel_file: str):
+        try:
+            from openpyxl import Workbook
+        except ImportError as e:
+            raise ImportError("Writing the Excel output chunk by chunk needs openpyxl (pip install openpyxl)") from e
+        self.excel_file = excel_file
+        self.workbook = Workbook(write_only=True)
+        self.sheet = self.workbook.create_sheet()
+        self.header_written = False
+
+    def append(self, df: pd.DataFrame) -> None:
+        if not self.header_written:
+            self.sheet.append(list(df.columns))
+            self.header_written = True
+        for row in df.itertuples(index=False):
+            self.sheet.append([None if pd.isna(value) else value for value in row])
+
+    def close(self) -> None:
+        self.workbook.save(self.excel_file)
+
+
+class OutputWriter:
+    """
+    Writes the output tables of a stage in the configured formats (see the top of this file).
+
+    Args:
+        formats (list): Output formats, from OUTPUT_FORMATS.
+        excel (str): Excel mode, from EXCEL_MODES.
+        csv_engine (str): 'pandas' or 'pyarrow'.
+    """
+
+    def __init__(self, formats=('parquet', 'csv'), excel: str = 'background', csv_engine: str = 'pandas'):
+        for output_format in formats:
+            if output_format not in OUTPUT_FORMATS:
+                raise ValueError(f"Unknown output format {output_format}, use one of {OUTPUT_FORMATS}")
+        if excel not in EXCEL_MODES:
+            raise ValueError(f"Unknown Excel mode {excel}, use one of {EXCEL_MODES}")
+        if csv_engine not in CSV_ENGINES:
+            raise ValueError(f"Unknown CSV engine {csv_engine}, use one of {CSV_ENGINES}")
+
+        self.formats = list(formats)
+        if _import_pyarrow() is None and any(output_format in COLUMNAR_EXTENSIONS for output_format in self.formats):
+            # The columnar default depends on pyarrow: without it the outputs fall back to the CSV file
+            self.formats = [output_format for output_format in self.formats if output_format not in COLUMNAR_EXTENSIONS] or ['csv']
+            warnings.warn("pyarrow is not installed (pip install pyarrow): the Parquet/Feather outputs are not written, "
+                          f"only {', '.join(self.formats)}.")
+        self.excel = excel
+        self.csv_engine = csv_engine
+        self.excel_worker = None
+        self.excel_jobs = []
+        self.streams = {}  # path -> (writer, schema) of the columnar files and Excel files written chunk by chunk
+
+    def _submit_excel(self, function, *args) -> None:
+        if self.excel == 'inline':
+            function(*args)
+            return
+        if self.excel_worker is None:
+            # One worker: the Excel files (and the chunks of a file) are written in order
+            self.excel_worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix='excel')
+        self.excel_jobs.append(self.excel_worker.submit(function, *args))
+
+    def _deferred_message(self, csv_path: str, excel_path: str) -> None:
+        source = next((output_path(csv_path, output_format) for output_format in self.formats), csv_path)
+        print(f"Excel export deferred, run: python geocode_outputs.py export-excel {source} {excel_path}")
+
+    def write(self, df: pd.DataFrame, csv_path: str, excel_path: str = None) -> list:
+        """
+        Writes one output table.
+
+        Args:
+            df (pd.DataFrame): The table (typed author data, or any DataFrame).
+            csv_path (str): Path of the CSV file (the columnar files are written next to it).
+            excel_path (str): Path of the Excel file (None: no Excel file).
+
+        Returns:
+            list: The paths of the files written (the Excel file of the background mode is written later).
+        """
+        written = []
+        legacy = None
+        for output_format in self.formats:
+            path = output_path(csv_path, output_format)
+            if output_format == 'csv':
+                legacy = legacy_view(df) if legacy is None else legacy
+                write_csv(legacy, path, self.csv_engine)
+            elif _is_geodataframe(df) and output_format == 'parquet':
+                df.to_parquet(path, index=False)  # GeoParquet, with the geometry (geopandas)
+            elif _is_geodataframe(df):
+                df.to_feather(path)
+            elif output_format == 'parquet':
+                _import_pyarrow().parquet.write_table(arrow_table(df), path)
+            else:
+                table = arrow_table(df)
+                with _import_pyarrow().ipc.new_file(path, table.schema) as writer:
+                    writer.write_table(table)
+            written.append(path)
+
+        if excel_path is not None and self.excel in ('background', 'inline'):
+            legacy = legacy_view(df) if legacy is None else legacy
+            # The background worker gets its own copy, the stage can go on changing df
+            self._submit_excel(write_excel, legacy.copy() if self.excel == 'background' else legacy, excel_path)
+            written.append(excel_path)
+        elif excel_path is not None and self.excel == 'deferred':
+            self._deferred_message(csv_path, excel_path)
+        return written
+
+    def append(self, df: pd.DataFrame, csv_path: str, excel_path: str = None, first: bool = False) -> None:
+        """
+        Appends one chunk to the output files (streaming mode). The first chunk creates the files.
+        The files are complete after close().
+        """
+        legacy = legacy_view(df)
+        for output_format in self.formats:
+            path = output_path(csv_path, output_format)
+            if output_format == 'csv':
+                write_csv(legacy, path, self.csv_engine, append=not first)
+                continue
+            pa = _import_pyarrow()
+            if path not in self.streams:
+                table = arrow_table(df)
+                if output_format == 'parquet':
+                    writer = pa.parquet.ParquetWriter(path, table.schema)
+                else:
+                    writer = pa.ipc.new_file(path, table.schema)
+                self.streams[path] = (writer, table.schema)
+            writer, schema = self.streams[path]
+            writer.write_table(arrow_table(df, schema))
+
+        if excel_path is not None and self.excel in ('background', 'inline'):
+            if excel_path not in self.streams:
+                self.streams[excel_path] = (ExcelAppender(excel_path), None)
+            self._submit_excel(self.streams[excel_path][0].append, legacy.copy() if self.excel == 'background' else legacy)
+        elif excel_path is not None and self.excel == 'deferred' and first:
+            self._deferred_message(csv_path, excel_path)
+
+    def close(self) -> None:
+        """
+        Finishes the files written chunk by chunk and waits for the Excel files of the background worker
+        (an error of the worker is raised here).
+        """
+        for path, (writer, schema) in list(self.streams.items()):
+            if schema is not None:
+                writer.close()
+            else:
+                self._submit_excel(writer.close)
+        self.streams = {}
+        jobs, self.excel_jobs = self.excel_jobs, []
+        for job in jobs:
+            job.result()
+        if self.excel_worker is not None:
+            self.excel_worker.shutdown()
+            self.excel_worker = None
+
+
+def write_outputs(df: pd.DataFrame, csv_path: str, excel_path: str = None, writer: OutputWriter = None) -> list:
+    """
+    Writes an output table of a stage with writer. The caller owns writer and closes it (an Excel file written
+    in the background is finished, and its error raised, by writer.close()).
+    Without a writer the table is written in the default formats (Parquet and CSV) and the Excel file inline,
+    so everything is written, or has failed, when write_outputs returns.
+    """
+    if writer is not None:
+        return writer.write(df, csv_path, excel_path)
+    writer = OutputWriter(excel='inline')
+    try:
+        return writer.write(df, csv_path, excel_path)
+    finally:
+        writer.close()
+
+
+def export_excel(source_file: str, excel_file: str, batch_size: int = 50000) -> int:
+    """
+    Writes the Excel file of an output table (Parquet, Feather or CSV) batch by batch, in the legacy format.
+
+    Returns:
+        int: Number of rows written.
+    """
+    extension = os.path.splitext(source_file)[1].lower()
+    if extension == '.parquet':
+        batches = (batch.to_pandas() for batch in _import_pyarrow().parquet.ParquetFile(source_file).iter_batches(batch_size))
+    elif extension == '.feather':
+        table = _import_pyarrow().ipc.open_file(source_file).read_all()
+        batches = (batch.to_pandas() for batch in table.to_batches(batch_size))
+    else:
+        batches = pd.read_csv(source_file, chunksize=batch_size)
+
+    appender = ExcelAppender(excel_file)
+    rows = 0
+    for batch in batches:
+        appender.append(legacy_view(batch))
+        rows += len(batch)
+    appender.close()
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Output files of the pipeline.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    export_parser = subparsers.add_parser('export-excel', help="write the Excel file of an output table (Parquet, Feather or CSV)")
+    export_parser.add_argument('source_file')
+    export_parser.add_argument('excel_file')
+    args = parser.parse_args()
+
+    rows = export_excel(args.source_file, args.excel_file)
+    print(f"Wrote {rows} rows to {args.excel_file}")
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 2026
+"""
+
+# Chooses the candidate of a city name for each author (the name can have several geocoding results).
+# The rule, with the countries of countries.json:
+#   use the first result, unless the name has a result in the Americas/Oceania and the author's year_map
+#   is before the discovery year of its country: then use a result in Europe, else a result outside
+#   Europe and the Americas/Oceania, else the result in the Americas/Oceania.
+# When a name has several results in the same region, the last one is used.
+#
+# resolve_candidates chooses for all the (author, city column) at once with joins and vectorized comparisons.
+# resolve_candidates_reference applies choose_candidate row by row, to check that both give the same choices.
+#
+# The americas_or_oceania_before_discovery flag of a chosen city is "yes" if its country is in the Americas/Oceania
+# and the author's year_map is before the discovery year of the country, otherwise "no" (see americas_or_oceania_flags).
+
+import numpy as np
+import pandas as pd
+from geocode_countries import CountryRegistry, EUROPE, AMERICAS_OR_OCEANIA
+
+
+def americas_or_oceania_flags(country, year, registry: CountryRegistry, no_discovery_flag: str = "no") -> np.ndarray:
+    """
+    The americas_or_oceania_before_discovery flag of many cities at once.
+
+    Args:
+        country (array-like): The country of each city (None or NaN if unknown).
+        year (array-like): The year_map of the author of each city (NaN if unknown).
+        registry (CountryRegistry): The countries of countries.json.
+        no_discovery_flag (str): Flag of a country without a discovery year: "no" in preprocessing_GoogleAPI.py,
+            "" in set_flag of funcs_prepr_GoogleAPI.py.
+
+    Returns:
+        np.ndarray: "yes" where the country is in the Americas/Oceania and the year is before its discovery year, otherwise "no".
+    """
+    codes = registry.codes(country)
+    discovery_year = registry.discovery_years(codes)
+    year = pd.to_numeric(pd.Series(np.asarray(year, dtype=object)), errors='coerce').to_numpy(dtype='float64')
+    with np.errstate(invalid='ignore'):
+        before_discovery = (registry.regions(codes) == AMERICAS_OR_OCEANIA) & (year < discovery_year)
+    return np.where(before_discovery, "yes", np.where(np.isnan(discovery_year), no_discovery_flag, "no"))
+
+
+def choose_candidate(candidates: list, year, registry: CountryRegistry) -> int:
+    """
+    Chooses the candidate of a city name for one author (row-by-row version of the rule).
+
+    Args:
+        candidates (list): The candidates of the city name (dictionaries with a 'country'), in the order returned by the API.
+        year (int): The year_map of the author (None, NaN or pd.NA if unknown: never before a discovery year,
+            the first candidate is used, as in resolve_candidates).
+        registry (CountryRegistry): The countries of countries.json.
+
+    Returns:
+        int: The position of the chosen candidate.
+    """
+    europe_location = None
+    america_oceania_location = None
+    other_location = None
+
+    for i, candidate in enumerate(candidates):
+        region = registry.region(candidate['country'])
+        if region == EUROPE:
+            europe_location = i
+        elif region == AMERICAS_OR_OCEANIA:
+            america_oceania_location = i
+        else:
+            other_location = i
+
+    if america_oceania_location is not None:
+        discovery_year = registry.discovery_year(candidates[america_oceania_location]['country'])
+
+        # The author died before the discovery year: Europe, else another location, else the Americas/Oceania
+        if discovery_year and pd.notna(year) and year < discovery_year:
+            for location in (europe_location, other_location, america_oceania_location):
+                if location is not None:
+                    return location
+    return 0
+
+
+def candidates_table(geocode_candidates: dict, city_names=None) -> pd.DataFrame:
+    """
+    The candidates of the city names as a table, one row per candidate.
+
+    Args:
+        geocode_candidates (dict): City name -> candidates (see load_geocode_candidates).
+        city_names (iterable): The city names to include (default: all of them).
+
+    Returns:
+        pd.DataFrame: Columns city, choice (position of the candidate), coordinates and country.
+    """
+    city_names = geocode_candidates if city_names is None else city_names
+    rows = [(city_name, i, candidate['coordinates'], candidate['country'])
+            for city_name in city_names if city_name in geocode_candidates
+            for i, candidate in enumerate(geocode_candidates[city_name])]
+    return pd.DataFrame(rows, columns=['city', 'choice', 'coordinates', 'country'])
+
+
+def authors_table(author_data: pd.DataFrame, city_columns: list) -> pd.DataFrame:
+    """
+    The city cells of the authors as a table, one row per (author, city column) with a city name.
+
+    Args:
+        author_data (pd.DataFrame): The author data, with year_map and the normalized city columns.
+        city_columns (list): The city columns.
+
+    Returns:
+        pd.DataFrame: Columns author, city_col, city and year_map.
+    """
+    units = author_data[city_columns + ['year_map']].rename_axis('author').reset_index().melt(
+        id_vars=['author', 'year_map'], value_vars=city_columns, var_name='city_col', value_name='city')
+    units = units[units['city'].notna() & (units['city'] != "")]
+    # A missing year_map is NaN (never before a discovery year), also when the column is a nullable integer
+    units['year_map'] = units['year_map'].astype('float64')
+    return units[['author', 'city_col', 'city', 'year_map']].reset_index(drop=True)
+
+
+def resolve_candidates(candidates: pd.DataFrame, authors: pd.DataFrame, registry: CountryRegistry) -> pd.Series:
+    """
+    Chooses the candidate of every (author, city column) at once.
+
+    Args:
+        candidates (pd.DataFrame): The candidates (see candidates_table).
+        authors (pd.DataFrame): The city cells with their year_map (see authors_table).
+        registry (CountryRegistry): The countries of countries.json.
+
+    Returns:
+        pd.Series: The position of the chosen candidate, aligned with authors (NaN for a city without candidates).
+    """
+    codes = registry.codes(candidates['country'])
+    region = registry.regions(codes)
+    is_europe = pd.Series(region == EUROPE, index=candidates.index)
+    is_americas = pd.Series(region == AMERICAS_OR_OCEANIA, index=candidates.index)
+
+    # Last candidate of each region, per city name
+    per_city = pd.DataFrame({
+        'city': candidates['city'],
+        'europe': candidates['choice'].where(is_europe),
+        'americas': candidates['choice'].where(is_americas),
+        'other': candidates['choice'].where(~is_europe & ~is_americas),
+    }).groupby('city', sort=False).max()
+
+    # Discovery year of the country of the last candidate in the Americas/Oceania
+    discovery_years = pd.Series(registry.discovery_years(codes), index=pd.MultiIndex.from_arrays([candidates['city'], candidates['choice']]))
+    per_city['discovery_year'] = discovery_years.reindex(
+        pd.MultiIndex.from_arrays([per_city.index, per_city['americas'].fillna(-1).astype(np.int64)])).to_numpy()
+    per_city['fallback'] = per_city['europe'].fillna(per_city['other']).fillna(per_city['americas'])
+
+    per_author = authors[['city', 'year_map']].join(per_city[['discovery_year', 'fallback']], on='city')
+    has_candidates = authors['city'].isin(per_city.index)
+    discovery_year = per_author['discovery_year']
+    # A missing year_map (NaN, or pd.NA of a nullable integer) is never before a discovery year
+    year = per_author['year_map'].astype('float64')
+    before_discovery = discovery_year.notna() & (year < discovery_year)
+
+    choice = pd.Series(np.where(before_discovery, per_author['fallback'], 0), index=authors.index, dtype='float64')
+    return choice.where(has_candidates)
+
+
+def resolve_candidates_reference(candidates: pd.DataFrame, authors: pd.DataFrame, registry: CountryRegistry) -> pd.Series:
+    """
+    Same as resolve_candidates, with choose_candidate applied to every (author, city column) one by one.
+    """
+    by_city = {city_name: group.to_dict('records') for city_name, group in candidates.groupby('city', sort=False)}
+    choices = [choose_candidate(by_city[city_name], year, registry) if city_name in by_city else np.nan
+               for city_name, year in zip(authors['city'], authors['year_map'])]
+    return pd.Series(choices, index=authors.index, dtype='float64')
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 2026
+"""
+
+# Typed schema of the geocoded author data. For each city column (borncity, deathcity, activecity):
+#   {city_col}_city_id                                   nullable Int32
+#   {city_col}                                           categorical (city name)
+#   {city_col}_country                                   categorical (codes of the country registry)
+#   {city_col}_lat, {city_col}_lng                       float64 (NaN if not geocoded)
+#   {city_col}_americas_or_oceania_before_discovery      categorical "no"/"yes"
+# and year_map as a nullable Int32.
+#
+# The geocoding keeps the coordinates as "lat, lng" strings (like the cache) until the end of each chunk,
+# then to_typed converts the result columns. legacy_view gives back the "lat, lng" coordinates column for the
+# CSV and Excel files, so the files read by the current consumers stay the same.
+# read_author_output reads such a file directly into the typed schema (e.g. in visualization.py).
+
+import numpy as np
+import pandas as pd
+
+CITY_COLUMNS = ['borncity', 'deathcity', 'activecity']
+
+FLAG_DTYPE = pd.CategoricalDtype(['no', 'yes'])
+
+
+def flag_column(city_col: str) -> str:
+    return f'{city_col}_americas_or_oceania_before_discovery'
+
+
+def init_result_columns(df: pd.DataFrame, city_columns: list = CITY_COLUMNS) -> pd.DataFrame:
+    """
+    Adds the empty result columns: year_map and city_id as nullable Int32, coordinates, country and flag
+    as missing values (the geocoding writes strings to them, to_typed converts them).
+
+    Args:
+        df (pd.DataFrame): The author data (or one chunk of it).
+        city_columns (list): The city columns.
+
+    Returns:
+        pd.DataFrame: The author data with the result columns.
+    """
+    df['year_map'] = pd.array([pd.NA] * len(df), dtype='Int32')
+    for city_col in city_columns:
+        df[f'{city_col}_coordinates'] = pd.Series(None, index=df.index, dtype=object)
+        df[f'{city_col}_country'] = pd.Series(None, index=df.index, dtype=object)
+        df[flag_column(city_col)] = pd.Series(None, index=df.index, dtype=object)
+        df[f'{city_col}_city_id'] = pd.array([pd.NA] * len(df), dtype='Int32')
+    return df
+
+
+def split_coordinates(coordinates):
+    """
+    Splits "lat, lng" strings into two float arrays (NaN for missing, empty or malformed coordinates).
+
+    Args:
+        coordinates (array-like): The coordinates strings.
+
+    Returns:
+        tuple: The latitudes and the longitudes (np.ndarray of float64).
+    """
+    parts = pd.Series(np.asarray(coordinates, dtype=object)).str.split(', ', n=1, expand=True)
+    if parts.shape[1] < 2:  # no coordinates with a ", "
+        return np.full(len(parts), np.nan), np.full(len(parts), np.nan)
+    lat = pd.to_numeric(parts[0], errors='coerce').to_numpy(dtype='float64', copy=True)
+    lng = pd.to_numeric(parts[1], errors='coerce').to_numpy(dtype='float64', copy=True)
+    missing = np.isnan(lat) | np.isnan(lng)
+    lat[missing] = np.nan
+    lng[missing] = np.nan
+    return lat, lng
+
+
+def format_coordinates(lat, lng) -> np.ndarray:
+    """
+    Formats the latitudes and longitudes as "lat, lng" strings, the same as f"{lat}, {lng}" ("" where missing).
+    """
+    lat = np.asarray(lat, dtype='float64')
+    lng = np.asarray(lng, dtype='float64')
+    missing = np.isnan(lat) | np.isnan(lng)
+    coordinates = np.char.add(np.char.add(lat.astype(str), ', '), lng.astype(str)).astype(object)
+    coordinates[missing] = ""
+    return coordinates
+
+
+def _categorical(values) -> pd.Categorical:
+    values = pd.Series(np.asarray(values, dtype=object))
+    return pd.Categorical(values.where(values.notna() & (values != ""), None))
+
+
+def to_typed(df: pd.DataFrame, city_columns: list = CITY_COLUMNS, registry=None) -> pd.DataFrame:
+    """
+    Converts the result columns of the author data to the typed schema. The "lat, lng" coordinates column
+    of each city column is replaced by the {city_col}_lat and {city_col}_lng float columns (at the same place).
+    Columns that are already typed are left as they are.
+
+    Args:
+        df (pd.DataFrame): The author data, with the result columns.
+        city_columns (list): The city columns.
+        registry (CountryRegistry): The country registry, for the country codes (default: categories of the names in df).
+
+    Returns:
+        pd.DataFrame: The typed author data.
+    """
+    if 'year_map' in df:
+        df['year_map'] = pd.to_numeric(df['year_map'], errors='coerce').astype('Int32')
+    for city_col in city_columns:
+        if not isinstance(df[city_col].dtype, pd.CategoricalDtype):
+            df[city_col] = _categorical(df[city_col])
+        if f'{city_col}_city_id' in df:
+            df[f'{city_col}_city_id'] = pd.to_numeric(df[f'{city_col}_city_id'], errors='coerce').astype('Int32')
+        if f'{city_col}_country' in df and not isinstance(df[f'{city_col}_country'].dtype, pd.CategoricalDtype):
+            country = df[f'{city_col}_country']
+            df[f'{city_col}_country'] = registry.categorical(country) if registry is not None else _categorical(country)
+        if flag_column(city_col) in df:
+            df[flag_column(city_col)] = df[flag_column(city_col)].astype(object).astype(FLAG_DTYPE)
+        if f'{city_col}_coordinates' in df:
+            lat, lng = split_coordinates(df[f'{city_col}_coordinates'])
+            position = df.columns.get_loc(f'{city_col}_coordinates')
+            df = df.drop(columns=f'{city_col}_coordinates')
+            df.insert(position, f'{city_col}_lat', lat)
+            df.insert(position + 1, f'{city_col}_lng', lng)
+    return df
+
+
+def legacy_view(df: pd.DataFrame, city_columns: list = CITY_COLUMNS) -> pd.DataFrame:
+    """
+    The typed author data with the "lat, lng" coordinates column of each city column instead of {city_col}_lat
+    and {city_col}_lng, to write the CSV and Excel files in the format of the current consumers.
+    The other typed columns are written the same way as strings (missing values are empty cells).
+    A frame that is not typed is returned as it is.
+    """
+    if not any(f'{city_col}_lat' in df for city_col in city_columns):
+        return df
+    df = df.copy(deep=False)
+    for city_col in city_columns:
+        if f'{city_col}_lat' in df:
+            position = df.columns.get_loc(f'{city_col}_lat')
+            coordinates = format_coordinates(df[f'{city_col}_lat'], df[f'{city_col}_lng'])
+            df = df.drop(columns=[f'{city_col}_lat', f'{city_col}_lng'])
+            df.insert(position, f'{city_col}_coordinates', coordinates)
+    return df
+
+
+def missing_coordinates(df: pd.DataFrame, city_col: str) -> pd.Series:
+    """
+    True where the city column has no coordinates, in a typed or a legacy (read from CSV) author data.
+    """
+    if f'{city_col}_lat' in df:
+        return df[f'{city_col}_lat'].isna()
+    return df[f'{city_col}_coordinates'].isna()
+
+
+def read_author_output(file_path: str, city_columns: list = CITY_COLUMNS, registry=None, **kwargs) -> pd.DataFrame:
+    """
+    Reads a geocoded author file into the typed schema: a CSV file (legacy format), or a Parquet/Feather file
+    (written typed by geocode_outputs.py, only the categoricals are made again).
+
+    Args:
+        file_path (str): The file written by preprocessing_GoogleAPI.py.
+        city_columns (list): The city columns.
+        registry (CountryRegistry): Optional, the country registry for the country codes.
+        **kwargs: Passed to pd.read_csv, pd.read_parquet or pd.read_feather.
+
+    Returns:
+        pd.DataFrame: The typed author data.
+    """
+    extension = file_path.lower().rsplit('.', 1)[-1]
+    if extension in ('parquet', 'feather'):
+        df = pd.read_parquet(file_path, **kwargs) if extension == 'parquet' else pd.read_feather(file_path, **kwargs)
+        return to_typed(df, [city_col for city_col in city_columns if city_col in df], registry)
+
+    dtype = {f'{city_col}_coordinates': str for city_col in city_columns}
+    dtype.update({f'{city_col}_country': 'category' for city_col in city_columns if registry is None})
+    dtype.update({flag_column(city_col): FLAG_DTYPE for city_col in city_columns})
+    dtype.update({f'{city_col}_city_id': 'Int32' for city_col in city_columns})
+    dtype.update({city_col: 'category' for city_col in city_columns})
+    df = pd.read_csv(file_path, dtype=dtype, **kwargs)
+    return to_typed(df, [city_col for city_col in city_columns if city_col in df], registry)
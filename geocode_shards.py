@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 2026
+"""
+
+# Sharded geocoding: the distinct city names are split in shards by a hash of the normalized name,
+# so all the occurrences of a name are in the same shard. Each shard runs in its own process
+# (preprocessing_GoogleAPI.py --shards N --shard I), geocodes its names and chooses the candidate
+# of each (author, city column) of its names, and writes its results to the shard folder:
+#   shard_I_of_N.jsonl      geocoding results of the names of the shard (written as they come, so a killed shard resumes)
+#   shard_I_of_N_units.csv  chosen candidate of each (author, city column), written when the shard is done
+#
+# The shard workers do not write the shared cache. The merge (preprocessing_GoogleAPI.py --shards N) reads
+# the results in the plan order, so the city_ids, the cache and the outputs are the same as in a
+# single-process run. Shards can also run on other machines that share the folder: run
+# --shards N --shard I on each of them, then --shards N merges (and runs the shards that are not done).
+
+import os
+import sys
+import json
+import hashlib
+import subprocess
+import pandas as pd
+from geocode_engine import RecordedError, classify_error, PERMANENT
+from geocode_cache_store import write_csv_atomic
+from funcs_prepr_GoogleAPI import failure_reason
+
+
+def shard_of(city_name: str, n_shards: int) -> int:
+    # Stable across processes and machines (the built-in hash() of a string changes in every process)
+    return int.from_bytes(hashlib.sha1(city_name.encode('utf-8')).digest()[:8], 'big') % n_shards
+
+
+def shard_files(shard_dir: str, shard: int, n_shards: int):
+    """
+    Returns the paths of the results file and the units file of a shard.
+    """
+    name = os.path.join(shard_dir, f"shard_{shard}_of_{n_shards}")
+    return f"{name}.jsonl", f"{name}_units.csv"
+
+
+def encode_error(error: Exception) -> dict:
+    return {'message': str(error), 'class': classify_error(error), 'reason': failure_reason(error)}
+
+
+def decode_error(record: dict) -> RecordedError:
+    return RecordedError(record['message'], record['class'], record['reason'])
+
+
+def candidates_from_result(geocode_result: list) -> list:
+    """
+    The candidates (coordinates and country) of a geocoding result, in the order returned by the API.
+    The city_id is not known in a shard, it is assigned by the merge.
+    """
+    candidates = []
+    for result in geocode_result:
+        location = result['geometry']['location']
+        country_name = None
+        for component in result['address_components']:
+            if "country" in component['types']:
+                country_name = component['long_name']
+                break
+        candidates.append({'coordinates': f"{location['lat']}, {location['lng']}", 'country': country_name, 'city_id': None})
+    return candidates
+
+
+class ShardResults:
+    """
+    Geocoding results of one shard, one JSON line per city name: {"city": ..., "results": [...]} or {"city": ..., "error": {...}}.
+    The first line is the header of the run (input file and number of shards): the results of another run are not used.
+
+    Args:
+        results_file (str): Path of the JSON-Lines file.
+        header (dict): Header of the run.
+    """
+
+    def __init__(self, results_file: str, header: dict):
+        self.results_file = results_file
+        self.header = header
+        self.results = {}  # city -> (geocode_result, error)
+
+        if os.path.exists(results_file):
+            self._read()
+        if not self.results:
+            with open(results_file, 'w', encoding='utf-8') as f:
+                f.write(json.dumps(header) + '\n')
+
+    def _read(self) -> None:
+        valid_size = 0
+        with open(self.results_file, 'rb') as f:
+            for i, line in enumerate(f):
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                except (json.JSONDecodeError, UnicodeDecodeError):
+                    break  # last line was cut by a crash
+                if i == 0 and record != self.header:
+                    self.results = {}
+                    return
+                if i > 0:
+                    error = decode_error(record['error']) if 'error' in record else None
+                    self.results[record['city']] = (record.get('results'), error)
+                valid_size += len(line)
+
+        if valid_size < os.path.getsize(self.results_file):
+            with open(self.results_file, 'r+b') as f:
+                f.truncate(valid_size)
+
+    def __contains__(self, city_name) -> bool:
+        return city_name in self.results
+
+    def is_final(self, city_name) -> bool:
+        # Geocoded, or failed with a permanent error. Throttled and transient errors are tried again.
+        return city_name in self.results and (self.results[city_name][1] is None or classify_error(self.results[city_name][1]) == PERMANENT)
+
+    def record(self, city_name: str, geocode_result: list, error: Exception = None) -> None:
+        record = {'city': city_name, 'error': encode_error(error)} if error is not None else {'city': city_name, 'results': geocode_result}
+        with open(self.results_file, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record) + '\n')
+        self.results[city_name] = (geocode_result, decode_error(record['error']) if error is not None else None)
+
+
+def shard_done(shard_dir: str, shard: int, n_shards: int, header: dict) -> bool:
+    # The units file is written last (and renamed into place), so it marks a finished shard of this run
+    results_file, units_file = shard_files(shard_dir, shard, n_shards)
+    if not os.path.exists(units_file) or not os.path.exists(results_file):
+        return False
+    with open(results_file, 'r', encoding='utf-8') as f:
+        try:
+            return json.loads(f.readline()) == header
+        except json.JSONDecodeError:
+            return False
+
+
+def run_shard(shard: int, n_shards: int, shard_dir: str, header: dict, author_data: pd.DataFrame, city_columns: list,
+              plan: pd.DataFrame, geocode_candidates: dict, engine, resolve_units) -> pd.DataFrame:
+    """
+    Runs one shard: geocodes the names of the shard that are not in the cache (skipping the ones already geocoded
+    by a previous attempt of the shard), then chooses the candidate of every (author, city column) with a name of the shard.
+
+    Args:
+        shard (int): The shard to run, from 0 to n_shards - 1.
+        n_shards (int): Number of shards.
+        shard_dir (str): Folder of the shard files.
+        header (dict): Header of the run (see ShardResults).
+        author_data (pd.DataFrame): The author data, with year_map and normalized city columns.
+        city_columns (list): The city columns.
+        plan (pd.DataFrame): The plan of the run (see plan_unique_cities).
+        geocode_candidates (dict): City name -> cached candidates.
+        engine (GeocodeEngine): The geocoding engine of this shard.
+        resolve_units (callable): resolve_units(author_data, candidates) returns (author, city_col) -> position of the
+            chosen candidate, for every city cell with candidates (see geocode_resolver.py).
+
+    Returns:
+        pd.DataFrame: The units of the shard (author, city_col, choice).
+    """
+    results_file, units_file = shard_files(shard_dir, shard, n_shards)
+    shard_plan = plan[plan['city'].map(lambda city_name: shard_of(city_name, n_shards)) == shard]
+
+    results = ShardResults(results_file, header)
+    cities_to_geocode = [city_name for city_name in shard_plan.loc[shard_plan['status'] == 'to_geocode', 'city'] if not results.is_final(city_name)]
+    print(f"Shard {shard} of {n_shards}: {len(shard_plan)} distinct city names, {len(cities_to_geocode)} to geocode.")
+    for city_name, geocode_result, error in engine.geocode_many(cities_to_geocode):
+        results.record(city_name, geocode_result, error)
+
+    candidates = {}
+    for city_name in shard_plan['city']:
+        if city_name in geocode_candidates:
+            candidates[city_name] = geocode_candidates[city_name]
+        elif city_name in results and results.results[city_name][0]:
+            candidates[city_name] = candidates_from_result(results.results[city_name][0])
+
+    shard_rows = author_data[city_columns].isin(list(candidates)).any(axis=1)
+    choices = resolve_units(author_data[shard_rows], candidates)
+    units_df = pd.DataFrame([(author, city_col, choice) for (author, city_col), choice in choices.items()],
+                            columns=['author', 'city_col', 'choice'])
+    write_csv_atomic(units_df, units_file)
+    print(f"Shard {shard} of {n_shards} done: {len(units_df)} city cells resolved.")
+    return units_df
+
+
+def run_shard_processes(script: str, argv: list, shards: list, n_shards: int, shard_dir: str) -> None:
+    """
+    Runs the shards in parallel, one process per shard (script with the same arguments, argv, and --shard I).
+    The output of each shard goes to shard_I_of_N.log in the shard folder.
+    """
+    processes = []
+    for shard in shards:
+        log_file = open(os.path.join(shard_dir, f"shard_{shard}_of_{n_shards}.log"), 'w')
+        command = [sys.executable, script] + list(argv) + ['--shard', str(shard)]
+        processes.append((shard, subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT), log_file))
+
+    failed = []
+    for shard, process, log_file in processes:
+        if process.wait() != 0:
+            failed.append(shard)
+        log_file.close()
+    if failed:
+        raise RuntimeError(f"Shards {failed} failed, see the logs in {shard_dir}. Run again to retry them.")
+
+
+def read_shards(shard_dir: str, n_shards: int, header: dict):
+    """
+    Reads the results of all the shards.
+
+    Returns:
+        tuple: city -> (geocode_result, error) of all the names geocoded by the shards, and
+            (author, city_col) -> choice of all the units.
+    """
+    results = {}
+    units = {}
+    for shard in range(n_shards):
+        results_file, units_file = shard_files(shard_dir, shard, n_shards)
+        results.update(ShardResults(results_file, header).results)
+        units_df = pd.read_csv(units_file, usecols=['author', 'city_col', 'choice'], dtype={'city_col': str})
+        units.update({(author, city_col): choice for author, city_col, choice in units_df.itertuples(index=False)})
+    return results, units
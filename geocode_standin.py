@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 2026
+"""
+
+# Local stand-in for the Google Maps geocode API, to test and benchmark the geocoding offline.
+# It speaks the same HTTP protocol as maps.googleapis.com (GET /maps/api/geocode/json?address=...),
+# so googlemaps.Client only needs base_url pointing to it:
+#   gmaps = googlemaps.Client(key="AIza-stand-in", base_url="http://127.0.0.1:8765")
+#
+# Two modes:
+# - replay: answers from a cassette (JSON-Lines file of recorded responses, keyed by the query).
+#   Responses are recorded with RecordingClient (--record-cassette in preprocessing_GoogleAPI.py).
+# - synthetic: generates 0 to max_results results per city name (the same ones for the same name),
+#   with tunable latency and rates of OVER_QUERY_LIMIT and HTTP 500 errors.
+#
+#   python geocode_standin.py serve --mode synthetic --latency-ms 50 --throttle-rate 0.01 --port 8765
+#   python geocode_standin.py serve --mode replay --cassette geocode_cassette.jsonl --port 8765
+#   python geocode_standin.py make-authors --authors 300000 --cities 100000 authors_offline.csv
+
+import os
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pandas as pd
+from geocode_backends import google_result, normalize_key
+
+GEOCODE_PATH = '/maps/api/geocode/json'
+
+# Countries of the synthetic results: Europe, Americas/Oceania and elsewhere, so every branch of the disambiguation is used
+SYNTHETIC_COUNTRIES = ['France', 'Italy', 'Germany', 'Spain', 'United Kingdom', 'United States', 'Brazil', 'Mexico',
+                       'Australia', 'Canada', 'India', 'China', 'Egypt', 'Turkey', 'Japan']
+
+
+class CassetteStore:
+    """
+    Recorded API responses, one JSON line per query: {"query": ..., "status": ..., "results": [...]}.
+    HTTP errors are recorded as {"query": ..., "http_status": 400}. The last line of a query wins.
+
+    Args:
+        cassette_file (str): Path of the JSON-Lines file (created when the first response is recorded).
+    """
+
+    def __init__(self, cassette_file: str):
+        self.cassette_file = cassette_file
+        self.responses = {}
+        self.lock = threading.Lock()
+        if os.path.exists(cassette_file):
+            with open(cassette_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        self.responses[normalize_key(record['query'])] = record
+
+    def __len__(self):
+        return len(self.responses)
+
+    def get(self, query: str):
+        return self.responses.get(normalize_key(query))
+
+    def record(self, query: str, **response) -> None:
+        record = dict(query=query, **response)
+        with self.lock:
+            self.responses[normalize_key(query)] = record
+            with open(self.cassette_file, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record) + '\n')
+
+
+class RecordingClient:
+    """
+    Wraps a geocoding client (googlemaps.Client) and records every response in a cassette,
+    to replay the same run later with the stand-in server. Transient errors are not recorded.
+    """
+
+    def __init__(self, client, cassette: CassetteStore):
+        self.client = client
+        self.cassette = cassette
+
+    def geocode(self, address, **kwargs):
+        try:
+            results = self.client.geocode(address, **kwargs)
+        except Exception as e:
+            status_code = getattr(e, 'status_code', None)
+            status = getattr(e, 'status', None)
+            if status_code is not None and status_code < 500 and status_code != 429:
+                self.cassette.record(address, http_status=status_code)
+            elif status is not None and status not in ('OVER_QUERY_LIMIT', 'UNKNOWN_ERROR'):
+                self.cassette.record(address, status=status, results=[])
+            raise
+        self.cassette.record(address, status='OK' if results else 'ZERO_RESULTS', results=results)
+        return results
+
+
+class ReplayResponder:
+    """
+    Answers from a cassette. A query that is not in the cassette gets INVALID_REQUEST, so it is visible in the run.
+    """
+
+    def __init__(self, cassette: CassetteStore, latency_ms: float = 0.0):
+        self.cassette = cassette
+        self.latency_ms = latency_ms
+
+    def respond(self, address: str):
+        """
+        Returns (HTTP status code, JSON body) for one geocode request.
+        """
+        time.sleep(self.latency_ms / 1000)
+        record = self.cassette.get(address)
+        if record is None:
+            return 200, {'status': 'INVALID_REQUEST', 'error_message': f"{address} is not in the cassette", 'results': []}
+        if 'http_status' in record:
+            return record['http_status'], {}
+        return 200, {'status': record['status'], 'results': record['results']}
+
+
+class SyntheticResponder:
+    """
+    Generates responses: the results of a name depend only on the name and the seed (same answer on every run),
+    the latency and the errors are random on every request.
+
+    Args:
+        latency_ms (float): Mean latency of a request.
+        latency_jitter_ms (float): The latency is uniform in latency_ms +/- latency_jitter_ms.
+        max_results (int): Maximum number of results of a name.
+        zero_rate (float): Share of the names with no results (ZERO_RESULTS).
+        throttle_rate (float): Share of the requests answered with OVER_QUERY_LIMIT.
+        server_error_rate (float): Share of the requests answered with HTTP 500.
+        seed (int): Seed of the generated results.
+    """
+
+    def __init__(self, latency_ms: float = 50.0, latency_jitter_ms: float = 10.0, max_results: int = 3, zero_rate: float = 0.02,
+                 throttle_rate: float = 0.0, server_error_rate: float = 0.0, seed: int = 0):
+        self.latency_ms = latency_ms
+        self.latency_jitter_ms = latency_jitter_ms
+        self.max_results = max_results
+        self.zero_rate = zero_rate
+        self.throttle_rate = throttle_rate
+        self.server_error_rate = server_error_rate
+        self.seed = seed
+
+    def results(self, address: str) -> list:
+        digest = hashlib.sha256(f"{self.seed}:{normalize_key(address)}".encode('utf-8')).digest()
+        name_random = random.Random(digest)
+        if name_random.random() < self.zero_rate:
+            return []
+        return [google_result(round(name_random.uniform(-60, 70), 6), round(name_random.uniform(-180, 180), 6),
+                              name_random.choice(SYNTHETIC_COUNTRIES))
+                for _ in range(name_random.randint(1, self.max_results))]
+
+    def respond(self, address: str):
+        time.sleep(max(0.0, random.uniform(self.latency_ms - self.latency_jitter_ms, self.latency_ms + self.latency_jitter_ms)) / 1000)
+        draw = random.random()
+        if draw < self.throttle_rate:
+            return 200, {'status': 'OVER_QUERY_LIMIT', 'error_message': "Synthetic throttling", 'results': []}
+        if draw < self.throttle_rate + self.server_error_rate:
+            return 500, {}
+        results = self.results(address)
+        return 200, {'status': 'OK' if results else 'ZERO_RESULTS', 'results': results}
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != GEOCODE_PATH:
+            self.send_error(404)
+            return
+        address = parse_qs(url.query).get('address', [''])[0]
+        status_code, body = self.server.responder.respond(address)
+        self.server.count_request()
+
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass  # one line per request would flood the console at 100k cities
+
+
+class StandInServer(ThreadingHTTPServer):
+    """
+    Threaded HTTP server answering geocode requests with a ReplayResponder or a SyntheticResponder.
+    """
+    daemon_threads = True
+
+    def __init__(self, responder, host: str = '127.0.0.1', port: int = 8765):
+        super().__init__((host, port), StandInHandler)
+        self.responder = responder
+        self.requests = 0
+        self.requests_lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count_request(self) -> None:
+        with self.requests_lock:
+            self.requests += 1
+
+
+def start_standin(responder, host: str = '127.0.0.1', port: int = 0) -> StandInServer:
+    """
+    Starts the stand-in server in a background thread (port 0: any free port, see server.base_url).
+    Stop it with server.shutdown().
+    """
+    server = StandInServer(responder, host, port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def make_authors(n_authors: int, n_cities: int, output_file: str, seed: int = 0) -> pd.DataFrame:
+    """
+    Writes a synthetic author file with the columns of the VIAF data, to run preprocessing_GoogleAPI.py at scale.
+    City names are drawn from n_cities names with a long tail (a few names are very common), like the real data.
+    """
+    rng = random.Random(seed)
+    city_names = [f"Synthetic City {i}" for i in range(n_cities)]
+    weights = [1 / (i + 1) ** 0.8 for i in range(n_cities)]
+
+    def cities(empty_share):
+        drawn = rng.choices(city_names, weights=weights, k=n_authors)
+        return [None if rng.random() < empty_share else city for city in drawn]
+
+    birthyears = [rng.randint(800, 1780) for _ in range(n_authors)]
+    authors_df = pd.DataFrame({
+        'indexauthor': range(1, n_authors + 1),
+        'starturl': [f"https://viaf.org/viaf/{i}" for i in range(n_authors)],
+        'birthyear': birthyears,
+        'deathyear': [year + rng.randint(20, 90) if rng.random() < 0.8 else None for year in birthyears],
+        'nameandbirthdeathyear': [f"Author {i}" for i in range(n_authors)],
+        'georeferenceurl': [''] * n_authors,
+        'borncity': cities(0.1),
+        'deathcity': cities(0.3),
+        'activecity': cities(0.6),
+    })
+    # Every name is used at least once, so the run has n_cities distinct names
+    n_named = min(n_cities, n_authors)
+    authors_df.loc[:n_named - 1, 'borncity'] = city_names[:n_named]
+    authors_df.to_csv(output_file, index=False)
+    return authors_df
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local stand-in for the Google Maps geocode API.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = subparsers.add_parser('serve', help="serve geocode requests")
+    serve_parser.add_argument('--mode', choices=['replay', 'synthetic'], default='synthetic')
+    serve_parser.add_argument('--cassette', default='geocode_cassette.jsonl', help="recorded responses (replay mode)")
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8765)
+    serve_parser.add_argument('--latency-ms', type=float, default=50.0)
+    serve_parser.add_argument('--latency-jitter-ms', type=float, default=10.0)
+    serve_parser.add_argument('--max-results', type=int, default=3)
+    serve_parser.add_argument('--zero-rate', type=float, default=0.02)
+    serve_parser.add_argument('--throttle-rate', type=float, default=0.0)
+    serve_parser.add_argument('--server-error-rate', type=float, default=0.0)
+    serve_parser.add_argument('--seed', type=int, default=0)
+
+    authors_parser = subparsers.add_parser('make-authors', help="write a synthetic author file")
+    authors_parser.add_argument('--authors', type=int, default=300000)
+    authors_parser.add_argument('--cities', type=int, default=100000)
+    authors_parser.add_argument('--seed', type=int, default=0)
+    authors_parser.add_argument('output_file')
+    args = parser.parse_args()
+
+    if args.command == 'make-authors':
+        make_authors(args.authors, args.cities, args.output_file, args.seed)
+        print(f"Wrote {args.authors} authors with {args.cities} distinct city names to {args.output_file}")
+    else:
+        if args.mode == 'replay':
+            responder = ReplayResponder(CassetteStore(args.cassette), latency_ms=args.latency_ms)
+        else:
+            responder = SyntheticResponder(args.latency_ms, args.latency_jitter_ms, args.max_results, args.zero_rate,
+                                           args.throttle_rate, args.server_error_rate, args.seed)
+        server = StandInServer(responder, args.host, args.port)
+        print(f"Geocode stand-in ({args.mode}) listening on {server.base_url}{GEOCODE_PATH}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.server_close()
@@ -11,10 +11,72 @@ import googlemaps
 import time
 import os
 import json
-
-# Initialize Google Maps Client
+import argparse
+import math
+import shutil
+import sys
+from geocode_metrics import GeocodeMetrics
+from geocode_engine import GeocodeEngine, TokenBucket, RetryPolicy, classify_error, PERMANENT
+from geocode_backends import GeoNamesBackend
+from geocode_standin import CassetteStore, RecordingClient
+from geocode_cache_store import is_sqlite_cache, load_geocode_cache_db, save_cache_db, CacheWriteBehind, CitiesDictLog, load_geocode_candidates, load_negative_cache, CityIdAllocator, is_snapshot_cache, load_geocode_cache_snapshot, save_snapshot_entries, ProgressJournal, ResultBuffer, assign_units, map_cache_columns, input_fingerprint, api_usage_file
+from geocode_shards import run_shard, run_shard_processes, shard_done, read_shards
+from geocode_resolver import authors_table, candidates_table, resolve_candidates, resolve_candidates_reference, americas_or_oceania_flags
+from geocode_countries import CountryRegistry
+from geocode_schema import init_result_columns, to_typed, missing_coordinates
+from geocode_outputs import OutputWriter, write_outputs
+from funcs_prepr_GoogleAPI import failure_reason, normalize_city_name, compute_year_map, plan_unique_cities, plan_report, read_author_chunks
+
+# Command line options (unknown arguments are ignored, so the script still runs from Spyder)
+parser = argparse.ArgumentParser(description="Geocode the authors' born, death and active cities with the Google Maps API.")
+parser.add_argument('--force-retry', action='store_true', help="geocode again the cities in the negative cache")
+parser.add_argument('--negative-ttl-days', type=float, default=30, help="days before a city that could not be geocoded is tried again")
+parser.add_argument('--metrics-file', default='geocode_metrics.json', help="JSON summary of cache hits, API calls and timings")
+parser.add_argument('--metrics-every', type=int, default=None, help="also write the metrics summary every N rows")
+parser.add_argument('--workers', type=int, default=8, help="API calls in flight at the same time")
+parser.add_argument('--qps', type=float, default=25, help="API calls per second allowed by the quota")
+parser.add_argument('--max-retries', type=int, default=5, help="retries of throttled and transient API errors (with exponential backoff)")
+parser.add_argument('--daily-cap', type=int, default=None, help="maximum API calls per day, the rest is geocoded in the next run")
+parser.add_argument('--geonames-index', default=None,
+                    help="offline GeoNames index (.npz, or the GeoNames cities .csv to build it) queried before Google")
+parser.add_argument('--api-base-url', default=None,
+                    help="send the geocode requests to a stand-in server (see geocode_standin.py), e.g. http://127.0.0.1:8765")
+parser.add_argument('--record-cassette', default=None, help="record every API response in this JSON-Lines cassette, to replay the run offline")
+parser.add_argument('--dry-run', action='store_true', help="only report how many distinct cities and API calls the run will make")
+parser.add_argument('--plan-file', default=None, help="save the plan (one row per distinct city name) to this CSV file")
+parser.add_argument('--resume', action='store_true', help="continue a run that was killed: skip the authors' cities already resolved (progress journal)")
+parser.add_argument('--shards', type=int, default=None,
+                    help="split the city names in N shards geocoded by N processes, then merge them (same output as one process)")
+parser.add_argument('--chunk-size', type=int, default=None,
+                    help="streaming mode: read, geocode and write the author file in chunks of N rows (memory bounded by the chunk size)")
+parser.add_argument('--shard', type=int, default=None,
+                    help="with --shards, only run this shard (0 to N-1) and exit, e.g. on another machine sharing the folder")
+parser.add_argument('--resolver', choices=['vectorized', 'reference'], default='vectorized',
+                    help="how the candidate of each author's city is chosen: all at once (vectorized) or row by row (reference)")
+parser.add_argument('--output-formats', default='parquet,csv',
+                    help="comma-separated formats of the output table: parquet, feather, csv (the columnar files are written next to the CSV)")
+parser.add_argument('--excel', choices=['background', 'inline', 'deferred', 'off'], default='background',
+                    help="Excel output: written by a background worker, inline, deferred (python geocode_outputs.py export-excel) or not at all")
+parser.add_argument('--csv-engine', choices=['pandas', 'pyarrow'], default='pandas',
+                    help="CSV writer: pandas (same format as before) or pyarrow (faster)")
+args, _ = parser.parse_known_args()
+if args.shard is not None and not (args.shards and 0 <= args.shard < args.shards):
+    parser.error("--shard must be between 0 and --shards - 1")
+if args.chunk_size and args.shards:
+    parser.error("--chunk-size can not be used with --shards")
+
+# Initialize Google Maps Client. OVER_QUERY_LIMIT is retried by the geocoding engine, which also lowers the rate limit.
+# The rate is limited by the engine (--qps), the client's own limit is set to the same value.
 API_KEY = "YOUR_GOOGLE_API_KEY"
-gmaps = googlemaps.Client(key=API_KEY)
+client_qps = max(int(math.ceil(args.qps)), 1)
+if args.api_base_url:
+    # Offline run against the stand-in server, it does not check the key
+    gmaps = googlemaps.Client(key="AIza-stand-in", base_url=args.api_base_url, retry_over_query_limit=False,
+                              queries_per_second=client_qps, queries_per_minute=client_qps * 60)
+else:
+    gmaps = googlemaps.Client(key=API_KEY, retry_over_query_limit=False, queries_per_second=client_qps, queries_per_minute=client_qps * 60)
+if args.record_cassette:
+    gmaps = RecordingClient(gmaps, CassetteStore(args.record_cassette))
 
 with open('countries.json') as countries_file:
     countries = json.load(countries_file)
@@ -22,16 +84,40 @@ with open('countries.json') as countries_file:
 #Load your data
 file_path = 'path/to/your/input_file.csv' 
 # author_data = pd.read_csv(file_path)
-author_data = pd.read_csv(file_path, dtype={2: str, 6: str}, low_memory=False)
+# In streaming mode (--chunk-size) the file is read chunk by chunk later, it is never in memory as a whole
+author_data = pd.read_csv(file_path, dtype={2: str, 6: str}, low_memory=False) if not args.chunk_size else None
 
-cache_file = 'path/to/your/geocode_cache.csv'
+# Geocode cache: SQLite (.sqlite) keeps the cache indexed by city. A .csv path still works with the old CSV cache,
+# and an .arrow/.parquet snapshot can be used for a fast warm start.
+cache_file = 'path/to/your/geocode_cache.sqlite'
+legacy_cache_csv = 'path/to/your/geocode_cache.csv'  # imported into the SQLite cache the first time it is created
 dict_file =  './path/to/your/cities_dict.json'
 
 output_file_csv = 'path/to/your/output_file.csv'  # Save CSV
 output_file_excel = 'path/to/your/output_file.xlsx'  # Save Excel
+progress_file = f"{os.path.splitext(output_file_csv)[0]}_progress.jsonl"  # Resolved (author, city column) units, for --resume
+shard_dir = f"{os.path.splitext(output_file_csv)[0]}_shards"  # Results of the shards (--shards), see geocode_shards.py
+# Output table: Parquet next to the CSV by default, Excel written in the background (see geocode_outputs.py)
+output_writer = OutputWriter([output_format.strip() for output_format in args.output_formats.split(',')], excel=args.excel, csv_engine=args.csv_engine)
+
+if args.shard is not None:
+    # A shard worker only writes its own files in the shard folder, the merge writes the cache and the outputs
+    os.makedirs(shard_dir, exist_ok=True)
+    progress_file = os.path.join(shard_dir, f"shard_{args.shard}_of_{args.shards}_progress.jsonl")
+    args.metrics_file = os.path.join(shard_dir, f"shard_{args.shard}_of_{args.shards}_metrics.json")
+
+# Cache hits/misses, API calls and latencies, save timings and rows per second (see geocode_metrics.py)
+metrics = GeocodeMetrics(args.metrics_file, write_every=args.metrics_every)
 
 # Check for existing geocoded cache file
-if os.path.exists(cache_file):
+if is_sqlite_cache(cache_file):
+    geocode_cache, unique_id = load_geocode_cache_db(cache_file, import_csv=legacy_cache_csv)
+
+elif is_snapshot_cache(cache_file):
+    # Columnar snapshot (see geocode_cache_store.py export-snapshot): memory-mapped, nothing is parsed up front
+    geocode_cache, unique_id = load_geocode_cache_snapshot(cache_file)
+
+elif os.path.exists(cache_file):
     # geocode_cache = pd.read_csv(cache_file).set_index('city').to_dict(orient='index')
     geocode_cache_df = pd.read_csv(cache_file)
     # Drop duplicates based on a unique combination of columns
@@ -45,12 +131,29 @@ if os.path.exists(cache_file):
 else:
     geocode_cache = {}
     unique_id = 0 # moved here to stoped the counting reinitializing
+
+# All geocoding results of each city name (city name -> list of candidates), so a name is geocoded only once
+geocode_candidates = load_geocode_candidates(cache_file, geocode_cache)
+
+# Negative cache: cities that could not be geocoded (no results, HTTP 400, other errors) in the last negative_ttl_days.
+# They are skipped, unless --force-retry is used.
+negative_cache = load_negative_cache(cache_file, args.negative_ttl_days)
+run_started_at = time.time()
       
 def save_cache(): #source - Lucas Koren
     """
     Saves the current geocode cache to a CSV file incrementally.
     Only appends new entries to the file to avoid complete overwriting.
     """
+    if is_sqlite_cache(cache_file):
+        save_cache_db(geocode_cache, cache_file)
+        return
+
+    if is_snapshot_cache(cache_file):
+        # Only the new entries, appended to the log of the snapshot (merged into it at the end of the run)
+        save_snapshot_entries(geocode_cache, cache_file)
+        return
+
     # Convert the cache to a DataFrame
     cache_df = pd.DataFrame.from_dict(geocode_cache, orient='index')
     cache_df.reset_index(inplace=True)
@@ -73,74 +176,85 @@ def save_cache(): #source - Lucas Koren
     else:
         # If the file does not exist, write the entire DataFrame as the initial cache
         cache_df.to_csv(cache_file, index=False, encoding='utf-8')
-      
+
+# cities_dict is kept as a JSON snapshot (dict_file) plus an append-only JSON-Lines log (same name, .jsonl)
+cities_dict_log = CitiesDictLog(dict_file, compact_every=1000)
+
 # Initialize or load the cities dictionary
-def load_or_initialize_cities_dict(filename=dict_file):
-    if os.path.exists(filename):
-        with open(filename, 'r') as f:
-            return json.load(f)
-    else:
-        return {}  # Start with an empty dictionary if file does not exist
+def load_or_initialize_cities_dict():
+    """
+    Loads the JSON snapshot and replays the log written since the last compaction (empty dictionary if there is none).
+    """
+    return cities_dict_log.load()
 
 cities_dict = load_or_initialize_cities_dict()
 
 # Function to save the cities dictionary incrementally
-def save_cities_dict_to_json(cities_dict, filename=dict_file) -> None:
+def save_city_to_cities_dict(city_name) -> None:
     """
-    Saves the current cities dictionary to a JSON file.
+    Appends only the new city to the cities_dict log instead of rewriting the whole JSON file after every city.
+    The log is compacted into dict_file every 1000 lines and at the end of the run.
     
     Args:
-        cities_dict (dict): Dictionary with city data.
+        city_name (str): The city added or updated in cities_dict.
     Returns:
         None
     """
-    with open(filename, 'w') as f:
-        json.dump(cities_dict, f)
-    print(f"Added {city_name} to {filename}")
-    print(f"The file has been saved to: {os.path.abspath(filename)}")
+    with metrics.timed('save_cities_dict_to_json'):
+        cities_dict_log.append(cities_dict, city_name)
+    print(f"Added {city_name} to {cities_dict_log.log_file}")
 
+# Code, region and discovery year of every country (and alias), compiled once (see geocode_countries.py)
+country_registry = CountryRegistry(countries)
 
-cities_dict = load_or_initialize_cities_dict()    
 
-americas_or_oceania_countries = countries["americas_or_oceania_countries"]
-european_countries = countries["european_countries"]
-year_discovery = countries["year_discovery"]
+# Add the result columns to the author data (the whole file, or one chunk in streaming mode)
+def add_result_columns(author_data):
+    """
+    Adds the empty result columns (year_map, coordinates, country, flag and city_id of each city column, see init_result_columns),
+    converts the city columns to UTF-8 and reorders the columns, placing city_id before coordinates.
+
+    Args:
+        author_data (pandas.DataFrame): The author data (or one chunk of it).
+
+    Returns:
+        pandas.DataFrame: The author data with the result columns.
+    """
+    author_data = init_result_columns(author_data)
 
+    # UTF-8 encoding for city columns 
+    author_data['borncity'] = author_data['borncity'].apply(lambda x: str(x).encode('utf-8').decode('utf-8') if isinstance(x, str) else x)
+    author_data['deathcity'] = author_data['deathcity'].apply(lambda x: str(x).encode('utf-8').decode('utf-8') if isinstance(x, str) else x)
+    author_data['activecity'] = author_data['activecity'].apply(lambda x: str(x).encode('utf-8').decode('utf-8') if isinstance(x, str) else x)
 
-# Add necessary columns
-author_data['year_map'] = ""
-author_data['borncity_coordinates'] = ""
-author_data['deathcity_coordinates'] = ""
-author_data['activecity_coordinates'] = ""
-author_data['borncity_country'] = ""
-author_data['deathcity_country'] = ""
-author_data['activecity_country'] = ""
-author_data['borncity_americas_or_oceania_before_discovery'] = ""
-author_data['deathcity_americas_or_oceania_before_discovery'] = ""
-author_data['activecity_americas_or_oceania_before_discovery'] = ""
-author_data['borncity_city_id'] = ""
-author_data['deathcity_city_id'] = ""
-author_data['activecity_city_id'] = ""
+    # Reorder the columns, placing city_id before coordinates
+    cols = ['borncity_city_id','borncity', 'borncity_country', 'borncity_coordinates',  'borncity_americas_or_oceania_before_discovery',  'deathcity_city_id', "deathcity", 
+           'deathcity_country', 'deathcity_coordinates', 'deathcity_americas_or_oceania_before_discovery', 'activecity_city_id', "activecity",
+            'activecity_country', 'activecity_coordinates', 'activecity_americas_or_oceania_before_discovery']
 
-# UTF-8 encoding for city columns 
-author_data['borncity'] = author_data['borncity'].apply(lambda x: str(x).encode('utf-8').decode('utf-8') if isinstance(x, str) else x)
-author_data['deathcity'] = author_data['deathcity'].apply(lambda x: str(x).encode('utf-8').decode('utf-8') if isinstance(x, str) else x)
-author_data['activecity'] = author_data['activecity'].apply(lambda x: str(x).encode('utf-8').decode('utf-8') if isinstance(x, str) else x)
+    # Reorder DataFrame columns
+    author_data = author_data[['indexauthor', 'starturl', 'birthyear', 'deathyear',"year_map", 'nameandbirthdeathyear', 
+                                   'georeferenceurl'] + cols]
+    return author_data
 
-# Reorder the columns, placing city_id before coordinates
-cols = ['borncity_city_id','borncity', 'borncity_country', 'borncity_coordinates',  'borncity_americas_or_oceania_before_discovery',  'deathcity_city_id', "deathcity", 
-       'deathcity_country', 'deathcity_coordinates', 'deathcity_americas_or_oceania_before_discovery', 'activecity_city_id', "activecity",
-        'activecity_country', 'activecity_coordinates', 'activecity_americas_or_oceania_before_discovery']
+if not args.chunk_size:
+    author_data = add_result_columns(author_data)
 
-# Reorder DataFrame columns
-author_data = author_data[['indexauthor', 'starturl', 'birthyear', 'deathyear',"year_map", 'nameandbirthdeathyear', 
-                               'georeferenceurl'] + cols]
 
+# Progress journal: every resolved (author, city column) is recorded, so a killed run can be continued with --resume
+journal = ProgressJournal(progress_file, file_path, resume=args.resume)
+if args.resume and not args.chunk_size:
+    print(f"(Resume) Restored {journal.restore(author_data)} resolved cities from {progress_file}")
+
+# Write-behind for the cache: entries are written every 200 items or 30 seconds (one checkpoint per flush).
+# The journal is written at the same checkpoints, after the cache.
+cache_writer = CacheWriteBehind(cache_file, geocode_cache, None, flush_every=200, flush_interval=30.0, metrics=metrics, journal=journal)
 
 # Define a function to save city data and assign city_id
 def save_city_data_and_assign_city_id_column(city_col, author, cache_key, coordinates, country, unique_id):
     """
     Saves city data in the geocode cache, assigns city_id to respective columns, and updates the cache.
+    The cache entry and the city_id are only enqueued in cache_writer, they are written at the next checkpoint.
     
     Args:
         city_col (str): The column representing the type of city (e.g., 'borncity', 'deathcity', 'activecity').
@@ -154,452 +268,351 @@ def save_city_data_and_assign_city_id_column(city_col, author, cache_key, coordi
         None
     """
     geocode_cache[cache_key] = {'coordinates': coordinates, 'country': country, 'city_id': unique_id}
-    if city_col == 'borncity':
-        author_data.at[author, 'borncity_city_id'] = unique_id
-    elif city_col == 'deathcity':
-        author_data.at[author, 'deathcity_city_id'] = unique_id
-    elif city_col == 'activecity':
-        author_data.at[author, 'activecity_city_id'] = unique_id
-    save_cache()
-        
-
-def set_flag(city_col, author, country, row):
-    """
-    Sets the flag 'yes' or 'no' in the column {city_col}_americas_or_oceania_before_discovery
-    based on the country's location and its year of discovery.
-
-    Args:
-        city_col (str): The column representing the type of city (e.g., 'borncity', 'deathcity', 'activecity').
-        author (int): The row index of the author in the dataset.
-        country (str): The country where the city is located.
-        row (pandas.Series): The row of the DataFrame corresponding to the current author being processed.
-
-    Returns:
-        None
-    """
-    # Check if country is valid (not NaN)
-    if isinstance(country, str):
-        is_in_americas_or_oceania = country in americas_or_oceania_countries 
-    else:
-        is_in_americas_or_oceania = False  # Treat NaN or non-string as not in Americas or Oceania - to avoid AttributeError: 'float' object has no attribute 'isin'
-
-    # Get the year of discovery from the dictionary
-    year_discovery_value = year_discovery.get(country, None)
-
-    # Ensure the year discovery is available and compare with the year_map
-    if year_discovery_value:
-        before_year_discovery = row['year_map'] < year_discovery_value
-        if before_year_discovery and is_in_americas_or_oceania:
-            author_data.at[author, f'{city_col}_americas_or_oceania_before_discovery'] = "yes"
-        else:
-            author_data.at[author, f'{city_col}_americas_or_oceania_before_discovery'] = "no"
-    else:
-        # If no year of discovery is available, set the flag as 'no'
-        author_data.at[author, f'{city_col}_americas_or_oceania_before_discovery'] = "no"
-
-
+    cache_writer.enqueue_entry(cache_key, coordinates, country, unique_id)
+    cache_writer.enqueue_city_id(author, city_col, unique_id)
         
-# Define a function to assign unique ID
-def assign_unique_id(city_col, author, coordinates, id_cache):
-    """
-    Assigns a unique ID to a city based on its coordinates. If the coordinates are already in the cache, 
-    the cached ID is assigned, otherwise a new ID is generated.
-    
-    Args:
-        city_col (str): The column representing the type of city (e.g., 'borncity', 'deathcity', 'activecity').
-        author (int): The row index of the author in the dataset.
-        coordinates (str): The geocoded coordinates of the city.
-        id_cache (dict): Cache mapping coordinates to unique IDs.
-    
-    Returns:
-        unique_id (int): The assigned or cached unique ID.
-    """
-    global unique_id  # Access the global unique ID counter
 
-    if coordinates not in id_cache:
-        id_cache[coordinates] = unique_id
-        author_data.at[author, f'{city_col}_city_id'] = unique_id
-        unique_id += 1  # Increment the ID counter for the next city
-    else:
-        author_data.at[author, f'{city_col}_city_id'] = id_cache[coordinates]
-
-    return unique_id  # Return the unique_id (either new or cached)
-         
-# Modify the geocode_city function to return both coordinates and country
-def geocode_city(city_name, year):
+# Modify the geocode_city function to return all the geocoding results of a city name
+def geocode_city(city_name, geocode_result, error=None):
      """
-     Geocodes a city using the Google Maps API.
+     Saves all the geocoding results (candidates) of a city name in the cache. The API call itself is made
+     by the geocoding engine (see geocode_engine.py), this function runs in the main thread in the plan order.
+     Which candidate is used for each author is decided later from the candidates (see resolve_units),
+     because it depends on the author's year_map.
      
      Args:
-         city_name (str): The name of the city to geocode.
-         year (int): The year for historical context (not used directly in this function).
+         city_name (str): The name of the city that was geocoded.
+         geocode_result (list): The results returned by the Google Maps API.
+         error (Exception): The error raised by the API call, if it failed.
      
      Returns:
-         tuple: The city name, latitude, longitude, and country code.
+         list: The candidates (coordinates, country and city_id) in the order returned by the API, or None if not geocoded.
      """
-     time.sleep(0.03)  # To avoid hitting API limits
-     
      try: # to avoid HTTPError 400 - Bad request
      
-         geocode_result = gmaps.geocode(city_name)
+         if error is not None:
+             raise error
          
          # Check if there are no geocoding results
          if len(geocode_result) == 0:
             print(f"(Not geocoded) City {city_name} could not be geocoded. No coordinates were returned.")
-            
-            # attempt 1 -  empty cache, just column names and comas in the fist row. when run the code again, Rio Tinto shows up.
-            
-            # geocode_cache[city_name] = {'coordinates': None, 'country': None, 'city_id': None} # ADDING THE CITIES NOT GEOCODED IN CACHE TOO
-            # save_cache()  # Save the cache immediately after adding an unsuccessful attempt # ADDING THE CITIES NOT GEOCODED IN CACHE TOO
-            #return city_name, None, None, None
-            
-            # attempt 2 - shows in the cache only the comas of the first row and id 1. 
-        
-            # coordinates = None
-            # country_name = None            
-            # unique_id = assign_unique_id(city_col, author, coordinates, id_cache)
-            # save_city_data_and_assign_city_id_column(city_col, author, cache_key, coordinates, country_name, unique_id)
-            # return city_name, None, None, None
+
+            # Save it in the negative cache, so it is not geocoded again until it expires
+            negative_cache[city_name] = {'reason': 'zero_results', 'failed_at': time.time()}
+            cache_writer.enqueue_failure(city_name, 'zero_results')
    
             return None
 
-                    
-         # Initialize variables before condition checks
-         europe_location = None
-         america_oceania_location = None
-         
-         #If there is only one result for the city:
-         if len(geocode_result) == 1:
-             
-             location = geocode_result[0]['geometry']['location']
+         candidates = []
+         for i, result in enumerate(geocode_result):
+             location = result['geometry']['location']
              country_name = None
-             for component in geocode_result[0]['address_components']:
+             for component in result['address_components']:
                 if "country" in component['types']:
                     country_name = component['long_name']  # long_name for full country name
                     break
              coordinates = f"{location['lat']}, {location['lng']}"
-             
-             coordinates = f"{location['lat']}, {location['lng']}"
-             
-             # Generate a unique city_id based on coordinates and assign it
-             unique_id = assign_unique_id(city_col, author, coordinates, id_cache)
-             
-             # Save the city and set the flag based on the discovery year
-             print(f"(Geocoded) Saving city {city_name} to cache. It has only 1 geocoding result. Coordinates: {coordinates}, country: {country_name}, city_id: {unique_id}")
-             save_city_data_and_assign_city_id_column(city_col, author, cache_key, coordinates, country_name, unique_id)
-             set_flag(city_col, author, country_name, row)
-                              
-            # Check if city_name is already in cities_dict before adding
-             if city_name not in cities_dict:
-                 
-                # Add the city to the dictionary           
-                cities_dict[city_name] = {
-                    "coordinates": [coordinates],
-                    "country": [country_name],
-                    "city_id": [unique_id]
-                }
-            
-                # Save the updated dictionary to the JSON file
-                save_cities_dict_to_json(cities_dict)
-                print(f"Added {city_name} with ID {unique_id} to the dictionary.")
+
+             # The same coordinates get the same city_id in every run
+             unique_id = id_allocator.get_id(coordinates)
+
+             # Only one result: cached under the city name. More than one: each result under a unique key "{city}_{coordinates}"
+             cache_key = city_name if len(geocode_result) == 1 else f"{city_name}_{coordinates}"
+             print(f"(Geocoded) Saving city {city_name} to cache, result {i+1} of {len(geocode_result)}. Coordinates: {coordinates}, country: {country_name}, city_id: {unique_id}")
+             geocode_cache[cache_key] = {'coordinates': coordinates, 'country': country_name, 'city_id': unique_id}
+             cache_writer.enqueue_entry(cache_key, coordinates, country_name, unique_id)
+             candidates.append({'coordinates': coordinates, 'country': country_name, 'city_id': unique_id})
+
+         # Index all candidates under the city name, every author with this city is resolved from them
+         geocode_candidates[city_name] = candidates
+         cache_writer.enqueue_candidates(city_name, candidates)
+
+         # Check if city_name is already in cities_dict before adding
+         if city_name not in cities_dict:
+             if len(candidates) == 1:
+                 cities_dict[city_name] = {
+                     "coordinates": [candidates[0]['coordinates']],
+                     "country": [candidates[0]['country']],
+                     "city_id": [candidates[0]['city_id']]
+                 }
              else:
-                print(f"{city_name} already exists in the dictionary. Skipping addition.")
-           
-             return city_name, location['lat'], location['lng'], country_name
-         
-         #If there are multiple results for the city name
-         elif len(geocode_result) > 1:
-             europe_location = None
-             americas_oceania_location = None
-             
-             if city_name not in cities_dict:
-                 cities_dict[city_name] = []
-               
-            #Loop through the results to check country codes     
-             for i, result in enumerate(geocode_result):
-                  location = result['geometry']['location']
-                  country_name = None
-                  for component in geocode_result[0]['address_components']:
-                     if "country" in component['types']:
-                         country_name = component['long_name']  # long_name for full country name
-                         break
-                  coordinates = f"{location['lat']}, {location['lng']}"
-         
-                   # Print debugging information
-                  print(f"(Geocoded) Multiple geocoding results for {city_name}, result {i+1}: Coordinates: {coordinates}, Country: {country_name}")
-             
-                   # Create a unique cache key for each location
-                  unique_cache_key = f"{city_name}_{coordinates}"
-         
-                   # Assign a unique ID for each result
-                  unique_id = assign_unique_id(city_col, author, coordinates, id_cache)
-             
-                  # Store each result in the cache with a unique city_id
-                  print(f"Saving city {city_name} with more than 1 result to cache with coordinates: {coordinates}, country: {country_name}, city_id: {unique_id}")
-                  save_city_data_and_assign_city_id_column(city_col, author, unique_cache_key, coordinates, country_name, unique_id)
-                  
-                  ###############################
-                  ##########
-                  set_flag(city_col, author, country_name, row)
-                  
-                  # Add each location to the list under the city_name key in cities_dict
-                  if coordinates not in cities_dict:   
-                      
-                      cities_dict[city_name].append({
-                          "coordinates": [coordinates],
-                          "country": [country_name],
-                          "city_id": [unique_id]
-                      })
-                                                   
-                  # Save the updated dictionary to the JSON file
-                      save_cities_dict_to_json(cities_dict)
-                      print(f"Added {city_name} with ID {unique_id} to the dictionary.")
-                  else:
-                        print(f"{city_name} already exists in the dictionary. Skipping addition.")
-          
-                 
-                 #Check if the country is in Europe
-                  if country_name in european_countries:
-                      europe_location = (city_name, location["lat"], location["lng"], country_name)
-                     
-                  #Check if the country is in Americas or Oceania
-                  if country_name in americas_or_oceania_countries:
-                      america_oceania_location = (city_name, location['lat'], location['lng'], country_name)
-             
-             # Check the discovery year for countries in the Americas or Oceania
-             if america_oceania_location:
-                 country_name = america_oceania_location[3]
-                 discovery_year = year_discovery.get(country_name, None)
-                 
-                 #If the author died before the discovery year, prioritize Europe
-                 if discovery_year and year < discovery_year:
-                     if europe_location:
-                         
-                         unique_id = assign_unique_id(city_col, author, f"{europe_location[1]}, {europe_location[2]}", id_cache)
-                         print(f"(Geocoded) Saving city {city_name} to cache. It has more than 1 result for this name. Geocoded in Europe with coordinates: {coordinates}, country: {country_name}, city_id: {unique_id}")
-                         save_city_data_and_assign_city_id_column(city_col, author, cache_key, f"{europe_location[1]}, {europe_location[2]}", europe_location[3], unique_id)
-                         set_flag(city_col, author, europe_location[3], row)
-                         
-                                            
-                         return europe_location
-                     
-                     else:
-                         #If no European location, prioritize any other non-Americas/Oceania location
-                         other_location = None
-                         
-                         for result in geocode_result:
-                             location = result["geometry"]["location"]
-                             country_name = None
-                             for component in geocode_result[0]['address_components']:
-                                if "country" in component['types']:
-                                    country_name = component['long_name']  # long_name for full country name
-                                    break
-                                                 
-                             #Prioritize non-Americas/Oceania countries first
-                             if country_name not in americas_or_oceania_countries and country_name not in european_countries:
-                                 other_location = (city_name, location["lat"], location["lng"], country_name)
-                                 break
-                             
-                         # If there is another location outuside Americas/Oceania, use it 
-                         if other_location:
-                             
-                             unique_id = assign_unique_id(city_col, author, f"{other_location[1]}, {other_location[2]}", id_cache)
-                             print(f" (Geocoded) Saving city {city_name} to cache.  It has more than 1 result for this name. Geocoded outside Europe and Americas/Oceania with coordinates: {coordinates}, country: {country_name}, city_id: {unique_id}")
-                             save_city_data_and_assign_city_id_column(city_col, author, cache_key, f"{other_location[1]}, {other_location[2]}", other_location[3], unique_id)
-                             set_flag(city_col, author, other_location[3], row)                       
-                                                      
-                             return other_location
-                                 
-                         # If no other location is found, use Americas/Oceania location
-                         if america_oceania_location:
-                             
-                             unique_id = assign_unique_id(city_col, author, f"{america_oceania_location[1]}, {america_oceania_location[2]}", id_cache)
-                             print(f" (Geocoded) Saving city {city_name} with more than 1 result in Americas/Oceania (no option in Europe or other location) to cache with coordinates: {coordinates}, country: {country_name}, city_id: {unique_id}")
-                             save_city_data_and_assign_city_id_column(city_col, author, cache_key, f"{america_oceania_location[1]}, {america_oceania_location[2]}", america_oceania_location[3], unique_id)
-                             set_flag(city_col, author, america_oceania_location[3], row)
-                                                      
-                             return america_oceania_location
-                         
-                # If the year is greater than or equal to the discovery year, use the first geocoded result
-                 elif discovery_year and year >= discovery_year:
-                   first_result = geocode_result[0]
-                   location = first_result["geometry"]["location"]
-                   country_name = None
-                   for component in first_result['address_components']:
-                       if "country" in component['types']:
-                           country_name = component['long_name']
-                           break
-           
-                   unique_id = assign_unique_id(city_col, author, f"{location['lat']}, {location['lng']}", id_cache)
-                   print(f"(Geocoded) Using first geocoded result for {city_name} with multiple results as year >= discovery year. Coordinates: {location['lat']}, {location['lng']}, country: {country_name}, city_id: {unique_id}")
-                   save_city_data_and_assign_city_id_column(city_col, author, cache_key, f"{location['lat']}, {location['lng']}", country_name, unique_id)
-                   set_flag(city_col, author, country_name, row)
-           
-                   return city_name, location["lat"], location["lng"], country_name
+                 # Add each location to the list under the city_name key in cities_dict
+                 cities_dict[city_name] = [
+                     {"coordinates": [candidate['coordinates']], "country": [candidate['country']], "city_id": [candidate['city_id']]}
+                     for candidate in candidates
+                 ]
+
+             # Save the updated dictionary to the JSON file
+             save_city_to_cities_dict(city_name)
+             print(f"Added {city_name} with {len(candidates)} result(s) to the dictionary.")
+         else:
+             print(f"{city_name} already exists in the dictionary. Skipping addition.")
+
+         return candidates
+
      except Exception as e:
          print(f"Error geocoding {city_name}: {e}")
+
+         # Throttling and transient errors (still failing after the retries) are not a bad city name:
+         # the city is not saved in the negative cache and is geocoded again in the next run
+         if classify_error(e) != PERMANENT:
+             print(f"{city_name} will be geocoded again in the next run ({classify_error(e)} error).")
+             return None
+
+         reason = failure_reason(e)
+         negative_cache[city_name] = {'reason': reason, 'failed_at': time.time()}
+         cache_writer.enqueue_failure(city_name, reason)
          
          return None  # Skip to next city if an error occurs
 
-# Define a function to map coordinates, country, and city_id to the author_data
-def map_coordinates(df, city_col):
+
+def resolve_units(author_data, candidates):
     """
-    Maps the geocoded coordinates, country, and city_id information back to the DataFrame 
-    based on previously cached geocode results.
-    
+    Chooses the candidate of every city of author_data, based on the authors' year_map (see geocode_resolver.py):
+    if the author died before the discovery year of a candidate in the Americas/Oceania, a candidate in Europe
+    is used (or outside the Americas/Oceania). Otherwise the first result is used.
+
     Args:
-        df (pandas.DataFrame): The DataFrame containing the city data.
-        city_col (str): The column name for the city (e.g., 'borncity', 'deathcity', or 'activecity').
-    
+        author_data (pandas.DataFrame): The author data (or one chunk of it), with year_map and the normalized city columns.
+        candidates (dict): City name -> candidates (see geocode_candidates).
+
     Returns:
-        pandas.DataFrame: Updated DataFrame with the coordinates, country, and city_id mapped.
-        
+        dict: (author, city_col) -> position of the chosen candidate, for the cities with candidates.
     """
-    
-    df[f'{city_col}_coordinates'] = df[city_col].map(lambda city: geocode_cache.get(city, {}).get('coordinates', ""))
-    df[f'{city_col}_country'] = df[city_col].map(lambda city: geocode_cache.get(city, {}).get('country', ""))
-    df[f'{city_col}_city_id'] = df[city_col].map(lambda city: geocode_cache.get(city, {}).get('city_id', ""))
-    return df
+    authors = authors_table(author_data, city_columns)
+    resolver = resolve_candidates_reference if args.resolver == 'reference' else resolve_candidates
+    authors['choice'] = resolver(candidates_table(candidates, authors['city'].unique()), authors, country_registry)
+    authors = authors[authors['choice'].notna()]
+    return dict(zip(zip(authors['author'], authors['city_col']), authors['choice'].astype(int)))
+
 
 # Initialize a counter for unique IDs
 #unique_id = 0
 
-# Process rows for year_map. For each row, if the death year is not empty, add it to the "year_map" column, if it is empty, add the "birth_year"+ 60
-for author, row in author_data.iterrows():
-    if pd.notna(row['deathyear']):
-        author_data.at[author, "year_map"] = int(row['deathyear'])
-    else:
-        author_data.at[author, "year_map"] = int(row['birthyear']) + 60
-author_data['year_map'] = pd.to_numeric(author_data['year_map'], errors='coerce')
+city_columns = ['borncity', 'deathcity', 'activecity']
+
+def prepare_cities_and_year_map(author_data):
+    """
+    Adds year_map and normalizes the city names (the normalized name is the cache key).
+
+    Args:
+        author_data (pandas.DataFrame): The author data (or one chunk of it).
+
+    Returns:
+        pandas.DataFrame: The author data with year_map and the normalized city columns.
+    """
+    # year_map: the death year, if it is empty the birth year + 60
+    author_data['year_map'] = compute_year_map(author_data)
 
+    # Normalize the city names (spaces), the normalized name is the cache key
+    for city_col in city_columns:
+        author_data[city_col] = author_data[city_col].map(normalize_city_name)
+    return author_data
 
-id_cache = {}
+if not args.chunk_size:
+    author_data = prepare_cities_and_year_map(author_data)
+    plan_source = author_data
+else:
+    # Streaming mode: the plan only needs the city columns and the years, read chunk by chunk
+    plan_source = (prepare_cities_and_year_map(chunk).loc[:, city_columns + ['year_map']]
+                   for chunk in read_author_chunks(file_path, args.chunk_size, usecols=['birthyear', 'deathyear'] + city_columns))
+
+# Persisted coordinate -> city_id index (city_ids are kept between runs and handed out in blocks)
+id_allocator = CityIdAllocator(cache_file, geocode_cache)
+
+# Planning stage: the distinct city names of the three columns, before any API call.
+# Each name is geocoded once, then every author is resolved from its candidates.
+plan = plan_unique_cities(plan_source, city_columns, geocode_candidates, negative_cache, force_retry=args.force_retry,
+                          run_started_at=run_started_at, countries=country_registry)
+plan_report(plan)
+if args.plan_file:
+    plan.to_csv(args.plan_file, index=False)
+    print(f"The plan has been saved to: {os.path.abspath(args.plan_file)}")
+if args.dry_run:
+    raise SystemExit(0)
+
+city_status = dict(zip(plan['city'], plan['status']))
+shard_header = {'input': input_fingerprint(file_path), 'shards': args.shards}
 
        ######## GEOCODE LIMIT TO TEST THE CODE - uncoment to test it #####
 # geocode_limit = 20  
-# geocode_count = 0
-# geocode_limit_reached = False
 
-# In each row, go through each city in each column (born, death and active). If empty return None
-for author, row in author_data.iterrows():
-          
-       ######## GEOCODE LIMIT TO TEST THE CODE - uncoment to test it #####
+# API calls in parallel (--workers), limited by a token bucket set to the quota (--qps, --daily-cap)
+# Throttled and transient errors are retried with exponential backoff (--max-retries).
+# With --geonames-index the offline GeoNames geocoder is asked first, only its misses and ambiguous names go to Google.
+backends = [GeoNamesBackend.from_file(args.geonames_index)] if args.geonames_index else []
+# A shard worker gets its share of the rate. The calls of the day are counted in a file next to the cache,
+# shared by the shards and by the next runs of the day, so all of them stop at the same daily cap.
+shard_qps = args.qps / args.shards if args.shard is not None else args.qps
+rate_limiter = TokenBucket(qps=shard_qps, daily_cap=args.daily_cap, usage_file=api_usage_file(cache_file))
+engine = GeocodeEngine(gmaps, rate_limiter, max_workers=args.workers, metrics=metrics,
+                       retry_policy=RetryPolicy(max_retries=args.max_retries), backends=backends)
+
+if args.shard is not None:
+    run_shard(args.shard, args.shards, shard_dir, shard_header, author_data, city_columns, plan, geocode_candidates, engine, resolve_units)
+    metrics.write_summary()
+    raise SystemExit(0)
+
+# Geocode each city name that is not in the cache (or in the negative cache) once.
+# The results come back in the plan order, so the cache and the city_ids are written in the same order every run.
+cities_to_geocode = plan.loc[plan['status'] == 'to_geocode', 'city']
+# cities_to_geocode = cities_to_geocode[:geocode_limit]
+shard_units = {}
+if args.shards:
+    # Sharded run: the shards that are not done yet run in parallel processes, then their results are read in the plan order
+    os.makedirs(shard_dir, exist_ok=True)
+    missing_shards = [shard for shard in range(args.shards) if not shard_done(shard_dir, shard, args.shards, shard_header)]
+    if missing_shards:
+        print(f"Running shards {missing_shards} of {args.shards}, logs in {shard_dir}")
+        run_shard_processes(os.path.abspath(__file__), sys.argv[1:], missing_shards, args.shards, shard_dir)
+    shard_results, shard_units = read_shards(shard_dir, args.shards, shard_header)
+    geocode_results = ((city_name,) + shard_results[city_name] for city_name in cities_to_geocode if city_name in shard_results)
+else:
+    geocode_results = engine.geocode_many(cities_to_geocode)
 
-    # if geocode_limit_reached: 
-    #     break  # Exit the outer loop if the limit is reached
-    
-    for city_col in ['borncity', 'deathcity', 'activecity']:
-        city_name = row[city_col]
-        
-        # Skip processing if the city name is empty or NaN
-        if not city_name or pd.isna(city_name):
-            continue
-        
-        # # Check if the geocode limit was reached
-        # if geocode_count >= geocode_limit:
-        #     print(f"Geocode limit of {geocode_limit} reached. Stopping geocoding.")
-        #     geocode_limit_reached = True  
-        #     break
-        
-        # geocode_count += 1
-        
-        ######## END GEOCODE LIMIT ######## 
-                
-        # Create a composite key for the cache using city_name
-        cache_key = city_name
-        
-        # Check if the city is not in the cache
-        if city_name not in geocode_cache:
-                                   
-            #geocode using GooGle Maps API
-            print(f"Geocoding city: {city_name}")  # Add a print statement to see the cities being geocoded
-                        
-                        # Call geocode_city and check if it returns None
-            result = geocode_city(city_name, row['year_map'])
-            
-            if result is not None:
-                # Unpack result if it’s not None
-                city_name, lat, lng, country_name = result
-               
+for city_name, geocode_result, error in geocode_results:
+
+    #geocode using GooGle Maps API
+    print(f"Geocoding city: {city_name}")  # Add a print statement to see the cities being geocoded
+    if geocode_city(city_name, geocode_result, error) is None:
+        print(f"Geocoding failed for {city_name}. No data was returned.")
+
+# Names geocoded in this run: the first cell of each one is a cache miss, the next ones are cache hits
+geocoded_this_run = set(plan.loc[plan['status'] == 'to_geocode', 'city'])
+
+# Resolved cells written to author_data (and to the journal) at once
+RESULT_BATCH = 1000
+
+def write_results(author_data, results):
+    """
+    Computes the americas_or_oceania_before_discovery flags of the resolved cells in results (all at once, from the
+    country registry and year_map), records them in the progress journal and writes them to author_data.
+
+    Args:
+        author_data (pandas.DataFrame): The author data (or one chunk of it).
+        results (ResultBuffer): The resolved cells, emptied.
+
+    Returns:
+        None
+    """
+    units = results.take()
+    units['flag'] = americas_or_oceania_flags(units['country'], author_data['year_map'].reindex(units['author']).to_numpy(), country_registry)
+    journal.record_units(units)
+    assign_units(author_data, units)
+
+def process_rows(author_data):
+    """
+    Resolves the cities of every author of author_data (the whole file, or one chunk in streaming mode)
+    from the candidates of their names, and sets the coordinates, country, flag and city_id columns.
+    The resolved cells are collected in a ResultBuffer and written to author_data in bulk at the end,
+    the cache entries and city_ids are enqueued in cache_writer.
+
+    Args:
+        author_data (pandas.DataFrame): The author data (or one chunk of it).
+
+    Returns:
+        None
+    """
+    # The candidate of every city of the authors, chosen all at once
+    choices = resolve_units(author_data, geocode_candidates)
+    results = ResultBuffer()
+
+    # In each row, go through each city in each column (born, death and active). If empty return None
+    for author, *city_names in author_data[city_columns].itertuples():
+
+        for city_col, city_name in zip(city_columns, city_names):
+
+            # Skip processing if the city name is empty or NaN
+            if not city_name or pd.isna(city_name):
+                continue
+
+            # Already resolved before the previous run was killed (restored from the journal)
+            if journal.is_done(author, city_col):
+                continue
+
+            # Cities in the negative cache, or that could not be geocoded in this run
+            if city_name not in geocode_candidates:
+                if city_status.get(city_name) == 'negative':
+                    print(f"(Negative cache) Skipping {city_name}, it could not be geocoded before ({negative_cache[city_name]['reason']}).")
+                    metrics.negative_cache_hit(city_col, city_name)
+                continue
+
+            if city_name in geocoded_this_run:
+                geocoded_this_run.discard(city_name)
+                metrics.cache_miss(city_col, city_name)
             else:
-                print(f"Geocoding failed for {city_name}. No data was returned.")
-                                           
-       # If there is a city with the same name in the cache:
-        else:
-            
-            # Retrieve all cached results for cities with the same name
-            cached_results = geocode_cache[cache_key]
-            
-            # Check if cached_results is a single dictionary or a list
-            if isinstance(cached_results, dict):
-                cached_results = [cached_results]  # Convert to list if it's a single dictionary
-                       
-            europe_location = None
-            america_oceania_location = None
-            other_location = None
-            
-            # Loop through cached results
-            for cached_data in cached_results:
-                country = cached_data['country']
-                coordinates = cached_data['coordinates']
-                city_id = cached_data.get('city_id', None)
-                # city_id = cached_data.get['city_id']
-        
-                # Check if the country is in Europe
-                if country in european_countries:
-                    europe_location = cached_data
-                
-                # Check if the country is in Americas or Oceania
-                if country in americas_or_oceania_countries:
-                    america_oceania_location = cached_data
-                
-                # If country is not in Europe or Americas/Oceania, consider it as another option
-                if country not in americas_or_oceania_countries and country not in european_countries:
-                    other_location = cached_data
-        
-            # Check the discovery year for countries in the Americas or Oceania
-            if america_oceania_location:
-                discovery_year = year_discovery.get(america_oceania_location['country'], None)
-                
-                # If the author died before the discovery year, prioritize Europe
-                if discovery_year and row['year_map'] < discovery_year:
-                    print(f"(Cache) Using {city_name}. The Author died in {row['year_map']}, before discovery year {discovery_year} for country {america_oceania_location['country']}")
-                    
-                    if europe_location:
-                        print(f" (Cache) Using {city_name} located in Europe with coordinates: {europe_location['coordinates']}")
-                        cached_data = europe_location
-                    elif other_location:
-                        print(f"(Cache) Using {city_name} located outside Americas/Oceania with coordinates: {other_location['coordinates']}")
-                        cached_data = other_location
-                    else:
-                        print(f"(Cache)  Using {city_name} located in Americas/Oceania with coordinates: {america_oceania_location['coordinates']}")
-                        cached_data = america_oceania_location
-                else:
-                    # If the author died after the discovery year, use the first result
-                    print(f" (Cache) Using first cached result for {city_name}. Author died in {row['year_map']}, after discovery year {discovery_year} of {country}. ")
-                    cached_data = cached_results[0]
-            
-            # Add the cached data to the authors dataframe
-            author_data.at[author, f'{city_col}_coordinates'] = cached_data['coordinates']
-            author_data.at[author, f'{city_col}_country'] = cached_data['country']
-            author_data.at[author, f'{city_col}_city_id'] = cached_data['city_id']
-            # author_data.at[author, f'{city_col}_city_id'] = cached_data.get('city_id', None)
-            set_flag(city_col, author, cached_data['country'], row)
-            
-# Apply mapping to all city columns (borncity, deathcity, activecity)
-city_columns = ['borncity', 'deathcity', 'activecity']
-for city_col in city_columns:
-    author_data = map_coordinates(author_data, city_col)
+                metrics.cache_hit(city_col, city_name)
+
+            # The candidate chosen for this author. In a sharded run the shard already chose it.
+            choice = shard_units[(author, city_col)] if (author, city_col) in shard_units else choices[(author, city_col)]
+            cached_data = geocode_candidates[city_name][choice]
 
-author_data.to_csv(output_file_csv, index=False)
-author_data.to_excel(output_file_excel, index=False)
+            # The first author of a city name with several results saves the chosen result under the city name
+            if city_name not in geocode_cache:
+                save_city_data_and_assign_city_id_column(city_col, author, city_name, cached_data['coordinates'], cached_data['country'], cached_data['city_id'])
+            else:
+                cache_writer.enqueue_city_id(author, city_col, cached_data['city_id'])
+
+            # Add the cached data to the authors dataframe (written in bulk below, with the flag)
+            results.add(author, city_col, cached_data['coordinates'], cached_data['country'], cached_data['city_id'], None)
+
+        metrics.row_done()
+        if len(results) >= RESULT_BATCH:
+            write_results(author_data, results)
+
+    write_results(author_data, results)
+
+if not args.chunk_size:
+    process_rows(author_data)
+else:
+    # Streaming mode: each chunk is enriched and appended to the outputs, then dropped.
+    # author_data is the current chunk, the functions above write to it.
+    for i, chunk in enumerate(read_author_chunks(file_path, args.chunk_size)):
+        author_data = prepare_cities_and_year_map(add_result_columns(chunk))
+        if args.resume:
+            journal.restore(author_data)
+
+        process_rows(author_data)
+        cache_writer.flush()  # the cache entries of the chunk are saved before it is written
+
+        author_data = map_cache_columns(author_data, city_columns, geocode_cache)
+        author_data = to_typed(author_data, city_columns, country_registry)
+        output_writer.append(author_data, output_file_csv, output_file_excel, first=i == 0)
+        print(f"(Streaming) Chunk {i + 1} written: {metrics.rows} authors so far.")
+
+# Last checkpoint: write what is still enqueued (a snapshot cache is compacted, see CacheWriteBehind.close)
+cache_writer.close()
+
+# Write the final cities_dict JSON once (compacts the log into the snapshot)
+with metrics.timed('save_cities_dict_to_json'):
+    cities_dict_log.compact(cities_dict)
+print(f"The file has been saved to: {os.path.abspath(dict_file)}")
+
+summary = metrics.write_summary()
+print(f"Metrics: {summary['rows']} rows ({summary['rows_per_second']} rows/s), {summary['api_calls']} API calls, "
+      f"{summary['api_calls_avoided']} API calls avoided by the cache ({summary['cells_served_from_cache']} cells served from it). Saved to {os.path.abspath(args.metrics_file)}")
+
+if not args.chunk_size:
+    # Apply mapping to all city columns (borncity, deathcity, activecity)
+    author_data = map_cache_columns(author_data, city_columns, geocode_cache)
+    # Typed columns (lat/lng floats, categoricals, Int32), the CSV and Excel files have the "lat, lng" coordinates of the current files
+    author_data = to_typed(author_data, city_columns, country_registry)
+    output_writer.write(author_data, output_file_csv, output_file_excel)
+
+# The outputs are saved, the next run starts from the beginning
+journal.remove()
+if args.shards:
+    shutil.rmtree(shard_dir, ignore_errors=True)
+
+# Wait for the Excel file written in the background
+output_writer.close()
 
 print("Geocoding completed and files saved.")
 
 
 # Remove from the df the authors who were wrongly geocoded and makes one spreadsheet of the results wrongly geocoded and one without it:
     
-def filter_authors_without_yes_flag(author_data, csv_path_without_flag, excel_path_without_flag, csv_path_with_flag, excel_path_with_flag):
+def filter_authors_without_yes_flag(author_data, csv_path_without_flag, excel_path_without_flag, csv_path_with_flag, excel_path_with_flag, writer=None):
     """
     Filters out rows with a 'yes' flag for locations in the Americas or Oceania before discovery 
     and saves the result to both CSV and Excel formats.
@@ -610,6 +623,7 @@ def filter_authors_without_yes_flag(author_data, csv_path_without_flag, excel_pa
     - excel_path_without_flag (str): File path for saving Excel output of authors without 'yes' flags.
     - csv_path_with_flag (str): File path for saving CSV output of authors with 'yes' flags.
     - excel_path_with_flag (str): File path for saving Excel output of authors with 'yes' flags.
+    - writer (OutputWriter): Optional, writes the files (the caller closes it). None: written before returning.
     
     Returns:
     - tuple of pd.DataFrame: DataFrames excluding rows with 'yes' flags and only rows with 'yes' flags.
@@ -626,11 +640,8 @@ def filter_authors_without_yes_flag(author_data, csv_path_without_flag, excel_pa
     authors_yes_flag = author_data.loc[yes_flag]
 
     # Save the filtered results to separate CSV and Excel files
-    authors_without_yes_flag.to_csv(csv_path_without_flag, index=False)
-    authors_without_yes_flag.to_excel(excel_path_without_flag, index=False)
-    
-    authors_yes_flag.to_csv(csv_path_with_flag, index=False)
-    authors_yes_flag.to_excel(excel_path_with_flag, index=False)
+    write_outputs(authors_without_yes_flag, csv_path_without_flag, excel_path_without_flag, writer)
+    write_outputs(authors_yes_flag, csv_path_with_flag, excel_path_with_flag, writer)
 
     # Print the number of remaining rows
     print(f"Number of authors without 'yes' flag: {authors_without_yes_flag.shape[0]}")
@@ -640,7 +651,7 @@ def filter_authors_without_yes_flag(author_data, csv_path_without_flag, excel_pa
 
 # Remove from the df the authors with locations wrongly geocoded or not geocoded:
 
-def filter_authors_with_flag_or_not_geocoded(author_data, csv_path_cleaned, excel_path_cleaned, csv_path_bad, excel_path_bad):
+def filter_authors_with_flag_or_not_geocoded(author_data, csv_path_cleaned, excel_path_cleaned, csv_path_bad, excel_path_bad, writer=None):
     """
     Filters out rows with a 'yes' flag for locations in the Americas or Oceania before discovery
     and rows with cities that are not geocoded, then saves the results to both CSV and Excel formats.
@@ -651,6 +662,7 @@ def filter_authors_with_flag_or_not_geocoded(author_data, csv_path_cleaned, exce
     - excel_path_cleaned (str): File path for saving Excel output of cleaned data.
     - csv_path_bad (str): File path for saving CSV output of bad results.
     - excel_path_bad (str): File path for saving Excel output of bad results.
+    - writer (OutputWriter): Optional, writes the files (the caller closes it). None: written before returning.
     
     Returns:
     - tuple of pd.dataframe: df with authors geocoded and authors flagged or not geocoded.
@@ -664,9 +676,9 @@ def filter_authors_with_flag_or_not_geocoded(author_data, csv_path_cleaned, exce
 
     # Create a boolean mask for rows not geocoded in born, death, or active cities ( with missing coordinates)
     not_geocoded = (
-        ((author_data["borncity"].notna()) & (author_data["borncity_coordinates"].isna())) |
-        ((author_data["deathcity"].notna()) & (author_data["deathcity_coordinates"].isna())) |
-        ((author_data["activecity"].notna()) & (author_data["activecity_coordinates"].isna()))
+        ((author_data["borncity"].notna()) & missing_coordinates(author_data, "borncity")) |
+        ((author_data["deathcity"].notna()) & missing_coordinates(author_data, "deathcity")) |
+        ((author_data["activecity"].notna()) & missing_coordinates(author_data, "activecity"))
     )
     
     # Combine both conditions
@@ -676,11 +688,8 @@ def filter_authors_with_flag_or_not_geocoded(author_data, csv_path_cleaned, exce
     authors_cleaned = author_data.loc[~bad_results]
     authors_bad_results = author_data.loc[bad_results]
 
-    authors_cleaned.to_csv(csv_path_cleaned, index=False)
-    authors_cleaned.to_excel(excel_path_cleaned, index=False)
-    
-    authors_bad_results.to_csv(csv_path_bad, index=False)
-    authors_bad_results.to_excel(excel_path_bad, index=False)
+    write_outputs(authors_cleaned, csv_path_cleaned, excel_path_cleaned, writer)
+    write_outputs(authors_bad_results, csv_path_bad, excel_path_bad, writer)
 
     print(f"Number of authors geocoded: {authors_cleaned.shape[0]}")
     print(f"Number of authors in flagged or not geocoded: {authors_bad_results.shape[0]}")
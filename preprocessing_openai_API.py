@@ -15,6 +15,7 @@ import time
 import logging
 from googlemaps import Client as GoogleMaps
 import os
+from geocode_outputs import write_outputs
 
 
 # Load the GeoNames whitelist - https://public.opendatasoft.com/explore/dataset/geonames-all-cities-with-a-population-500/information/?disjunctive.country
@@ -159,13 +160,9 @@ def correct_and_geocode(df, openai_api_key, output_file_csv, output_file_excel):
     if 'Unnamed: 0' in df.columns:
         df = df.drop(columns=['Unnamed: 0'])
 
-    # Save the updated DataFrame to a CSV file
-    df.to_csv(output_file_csv, index=False)
-    logging.info(f"Saved the updated DataFrame to {output_file_csv}")
-
-    # Save the updated DataFrame to an Excel file
-    df.to_excel(output_file_excel, index=False)
-    logging.info(f"Saved the updated DataFrame to {output_file_excel}")
+    # Save the updated DataFrame to CSV, Parquet and Excel files (see geocode_outputs.py)
+    write_outputs(df, output_file_csv, output_file_excel)
+    logging.info(f"Saved the updated DataFrame to {output_file_csv} (Excel file: {output_file_excel})")
 
 
 
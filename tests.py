@@ -8,7 +8,32 @@ Created on Thu Aug 29 15:59:24 2024
 #source: chatGPT 4.0
 
 
+import os
+import sys
+import math
+import json
+import time
+import datetime
+import random
+import shutil
+import tempfile
+import subprocess
+import threading
+import multiprocessing
 import pandas as pd
+import googlemaps
+from geocode_cache_store import CACHE_COLUMNS, CacheWriteBehind, CitiesDictLog, ProgressJournal, ResultBuffer, map_cache_columns, is_sqlite_cache, read_cache_db, read_cache_frame, is_snapshot_cache, write_cache_snapshot, snapshot_log_file, load_geocode_cache_snapshot
+from funcs_prepr_GoogleAPI import load_geocode_cache, save_cache, failure_reason, plan_unique_cities, read_author_chunks, compute_year_map
+from geocode_engine import GeocodeEngine, TokenBucket, RetryPolicy, classify_error
+from geocode_metrics import GeocodeMetrics, LatencyHistogram
+from geocode_backends import GeocoderBackend, GeoNamesBackend, GeoNamesIndex, HIT, AMBIGUOUS, MISS
+from geocode_shards import ShardResults, shard_of
+from geocode_resolver import choose_candidate, candidates_table, authors_table, resolve_candidates, resolve_candidates_reference, americas_or_oceania_flags
+from geocode_countries import CountryRegistry
+from geocode_schema import init_result_columns, to_typed, legacy_view, read_author_output
+from geocode_outputs import OutputWriter, export_excel, write_outputs
+import funcs_prepr_GoogleAPI
+from geocode_standin import CassetteStore, RecordingClient, ReplayResponder, SyntheticResponder, start_standin, make_authors
 
 def check_ungeocoded_locations(file_path):
     # Load the csv file into a DataFrame
@@ -62,8 +87,890 @@ def check_ungeocoded_locations(file_path):
     
     return ungeocoded_borncity, ungeocoded_deathcity, ungeocoded_activecity
 
-# Add your file
-file_path = 'path/to/your/file.csv'
-check_ungeocoded_locations(file_path)
 
+def _stress_worker(cache_file, worker, n_entries, n_shared):
+    # Each worker writes its own cities and the same shared cities as the other workers, like shards of one run
+    geocode_cache, _ = load_geocode_cache(cache_file)
+    cache_writer = CacheWriteBehind(cache_file, geocode_cache, flush_every=10, flush_interval=3600)
+    cities_log = CitiesDictLog(f"{os.path.splitext(cache_file)[0]}_cities_dict.json", compact_every=25)
+    cities_dict = cities_log.load()
 
+    for i in range(n_entries):
+        city = f"Worker{worker}_City{i}"
+        geocode_cache[city] = {'coordinates': f"{worker}.{i}, {i}", 'country': 'Testland', 'city_id': worker * n_entries + i + 1}
+        cache_writer.enqueue_entry(city, f"{worker}.{i}, {i}", 'Testland', worker * n_entries + i + 1)
+        cities_dict[city] = {'count': 1}
+        cities_log.append(cities_dict, city)
+
+        # The shared cities go through save_cache, the read-merge-append path
+        if i < n_shared:
+            shared = f"Shared_City{i}"
+            geocode_cache[shared] = {'coordinates': f"0.{i}, {i}", 'country': 'Testland', 'city_id': 10**6 + i}
+            save_cache({shared: geocode_cache[shared]}, cache_file)
+
+    cache_writer.close()
+    cities_log.compact(cities_dict)
+
+
+def stress_test_shared_cache(cache_name, n_processes=4, n_entries=100, n_shared=20):
+    """
+    Runs n_processes workers against the same cache file at the same time and checks
+    that no entry of the cache or of cities_dict is duplicated or lost.
+    The cache and its side files are created in a temporary folder that is removed at the end.
+
+    Args:
+        cache_name (str): File name of the cache to create (.sqlite, .csv or .arrow).
+        n_processes (int): Number of worker processes.
+        n_entries (int): Cities written by each worker.
+        n_shared (int): Cities written by all workers.
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        cache_file = os.path.join(folder, cache_name)
+        cities_dict_file = f"{os.path.splitext(cache_file)[0]}_cities_dict.json"
+        if is_snapshot_cache(cache_file):
+            write_cache_snapshot(pd.DataFrame(columns=CACHE_COLUMNS), cache_file)
+
+        workers = [multiprocessing.Process(target=_stress_worker, args=(cache_file, worker, n_entries, n_shared)) for worker in range(n_processes)]
+        for process in workers:
+            process.start()
+        for process in workers:
+            process.join()
+        failed_workers = [process.exitcode for process in workers if process.exitcode != 0]
+
+        if is_sqlite_cache(cache_file):
+            cache_df = read_cache_db(cache_file)
+        elif is_snapshot_cache(cache_file):
+            cache_df = read_cache_frame(cache_file)
+        else:
+            cache_df = pd.read_csv(cache_file)
+        expected = {f"Worker{worker}_City{i}" for worker in range(n_processes) for i in range(n_entries)}
+        expected |= {f"Shared_City{i}" for i in range(n_shared)}
+
+        duplicated = cache_df[cache_df.duplicated(subset=CACHE_COLUMNS, keep=False)]
+        lost = expected - set(read_cache_frame(cache_file)['city'])
+        lost_cities = expected - set(CitiesDictLog(cities_dict_file).load()) - {f"Shared_City{i}" for i in range(n_shared)}
+
+    print(f"{cache_name}: {n_processes} workers, {len(cache_df)} rows, {len(duplicated)} duplicated rows, "
+          f"{len(lost)} lost entries, {len(lost_cities)} lost cities_dict entries, {len(failed_workers)} failed workers")
+    assert not failed_workers, f"workers failed with exit codes {failed_workers}"
+    assert duplicated.empty, f"{len(duplicated)} duplicated rows in {cache_name}"
+    assert not lost and not lost_cities, f"lost entries {sorted(lost)[:5]}, lost cities_dict entries {sorted(lost_cities)[:5]}"
+
+
+def test_shared_cache():
+    """
+    Several workers sharing one SQLite, CSV and snapshot cache (see stress_test_shared_cache).
+    """
+    for cache_name in ['geocode_cache.sqlite', 'geocode_cache.csv', 'geocode_cache.arrow']:
+        stress_test_shared_cache(cache_name)
+
+
+class FakeGeocodeClient:
+    """
+    Offline stand-in for googlemaps.Client: geocode() waits latency seconds (plus a random jitter)
+    and returns one result built from the city name. Names in fail_on raise ValueError.
+    errors maps a city name to a list of exceptions raised by its first calls (one per call), then it succeeds.
+    """
+
+    def __init__(self, latency=0.05, jitter=0.0, fail_on=(), errors=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.fail_on = set(fail_on)
+        self.errors = {city_name: list(city_errors) for city_name, city_errors in (errors or {}).items()}
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def geocode(self, address):
+        with self.lock:
+            self.calls += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+            with self.lock:
+                error = self.errors[address].pop(0) if self.errors.get(address) else None
+            if error is not None:
+                raise error
+            if address in self.fail_on:
+                raise ValueError(f"Fake error for {address}")
+            number = sum(map(ord, address))
+            return [{'geometry': {'location': {'lat': number % 90, 'lng': number % 180}},
+                     'address_components': [{'types': ['country'], 'long_name': 'Testland'}]}]
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+def test_concurrent_engine(n_cities=100, latency=0.02, qps=200, workers=16):
+    """
+    Geocodes n_cities with the fake client and checks that the results come back in the input order,
+    that the calls run in parallel without going over qps, and that the daily cap stops the calls.
+    """
+    city_names = [f"City{i}" for i in range(n_cities)]
+
+    client = FakeGeocodeClient(latency=latency, jitter=latency, fail_on={'City7'})
+    engine = GeocodeEngine(client, TokenBucket(qps=qps, burst=1), max_workers=workers)
+    start = time.perf_counter()
+    results = list(engine.geocode_many(city_names))
+    elapsed = time.perf_counter() - start
+
+    in_order = [city_name for city_name, _, _ in results] == city_names
+    errors = [city_name for city_name, _, error in results if error is not None]
+    # With burst=1 the calls can not go faster than qps, and in parallel they should be close to it
+    within_quota = elapsed >= (n_cities - 1) / qps
+    sequential_time = n_cities * latency
+    parallel = client.max_in_flight > 1 and elapsed < sequential_time
+
+    capped_client = FakeGeocodeClient(latency=0.001)
+    capped = list(GeocodeEngine(capped_client, TokenBucket(qps=1000, daily_cap=10), max_workers=4).geocode_many(city_names))
+
+    # The count of the day is kept in the usage file: a restarted run only gets what is left of the cap,
+    # the calls of another day do not count
+    with tempfile.TemporaryDirectory() as folder:
+        usage_file = os.path.join(folder, 'geocode_cache_api_calls.json')
+        with open(usage_file, 'w') as f:
+            json.dump({(datetime.date.today() - datetime.timedelta(days=1)).isoformat(): 10}, f)
+        first_client, restarted_client = FakeGeocodeClient(latency=0.001), FakeGeocodeClient(latency=0.001)
+        first = list(GeocodeEngine(first_client, TokenBucket(qps=1000, daily_cap=10, usage_file=usage_file), max_workers=4).geocode_many(city_names[:6]))
+        restarted_limiter = TokenBucket(qps=1000, daily_cap=10, usage_file=usage_file)
+        left = restarted_limiter.remaining_today()
+        restarted = list(GeocodeEngine(restarted_client, restarted_limiter, max_workers=4).geocode_many(city_names))
+
+    print(f"Engine: {n_cities} cities in {elapsed:.2f} s ({n_cities / elapsed:.1f}/s, quota {qps}/s, sequential {sequential_time:.2f} s), "
+          f"max {client.max_in_flight} calls in flight, in order: {in_order}, errors: {errors}, "
+          f"daily cap of 10: {capped_client.calls} calls, {len(capped)} results, after a restart: {restarted_client.calls} calls")
+    assert in_order, "the results are not in the input order"
+    assert errors == ['City7'], f"unexpected errors {errors}"
+    assert within_quota, f"{n_cities} calls in {elapsed:.2f} s, faster than {qps} qps"
+    assert parallel, f"the calls did not run in parallel ({client.max_in_flight} in flight, {elapsed:.2f} s)"
+    assert capped_client.calls == 10 and len(capped) == 10, f"daily cap of 10: {capped_client.calls} calls, {len(capped)} results"
+    assert len(first) == 6 and left == 4 and restarted_client.calls == 4 and len(restarted) == 4, \
+        f"after a restart: {left} calls left, {restarted_client.calls} calls made"
+
+
+def test_retry_policy():
+    """
+    Checks that throttled and transient errors are retried until they succeed, that throttling lowers
+    the rate limit, and that a permanent error is not retried. The errors are counted per class.
+    """
+    over_query_limit = googlemaps.exceptions.ApiError('OVER_QUERY_LIMIT')
+    client = FakeGeocodeClient(latency=0.001, errors={
+        'Throttled': [over_query_limit, over_query_limit],
+        'Unavailable': [googlemaps.exceptions.HTTPError(503), googlemaps.exceptions.Timeout()],
+        'Bad': [googlemaps.exceptions.HTTPError(400)],
+        'Flaky': [googlemaps.exceptions.HTTPError(500)] * 5,
+    })
+    metrics = GeocodeMetrics()
+    rate_limiter = TokenBucket(qps=200)
+    engine = GeocodeEngine(client, rate_limiter, max_workers=4, metrics=metrics,
+                           retry_policy=RetryPolicy(max_retries=3, base_delay=0.01, max_delay=0.05))
+    results = {city_name: error for city_name, _, error in engine.geocode_many(['Throttled', 'Unavailable', 'Bad', 'Flaky', 'Fine'])}
+
+    recovered = results['Throttled'] is None and results['Unavailable'] is None and results['Fine'] is None
+    permanent_not_retried = isinstance(results['Bad'], googlemaps.exceptions.HTTPError) and len(client.errors['Bad']) == 0
+    gave_up = isinstance(results['Flaky'], googlemaps.exceptions.HTTPError) and len(client.errors['Flaky']) == 1  # 1 call + 3 retries
+    by_class = metrics.summary()['api_errors_by_class']
+
+    print(f"Retry: errors by class {by_class}, {metrics.api_retries} retries, rate limit {rate_limiter.qps} qps (from 200), "
+          f"recovered: {recovered}, permanent not retried: {permanent_not_retried}, gave up after the retries: {gave_up}")
+    assert recovered and permanent_not_retried and gave_up
+    assert rate_limiter.qps < 200, "throttling did not lower the rate limit"
+    assert by_class == {'throttled': 2, 'transient': 6, 'permanent': 1}, f"errors by class {by_class}"
+
+
+def test_geonames_backend():
+    """
+    Builds a GeoNames index from a small dump in the opendatasoft format, saves and loads it, and checks
+    the lookups (names, alternate names, homonyms answered by population dominance, ambiguous names and misses), their speed, and that only the names
+    the index can not answer are sent to the API.
+    """
+    geonames_df = pd.DataFrame({
+        'Geoname ID': range(9),
+        'Name': ['Paris', 'Paris', 'Lyon', 'Rome'] + ['Springfield'] * 5,
+        'ASCII Name': ['Paris', 'Paris', 'Lyon', 'Rome'] + ['Springfield'] * 5,
+        'Alternate Names': ['Lutetia,Parigi', None, 'Lugdunum,Lione', 'Roma', None, None, None, None, None],
+        'Country name EN': ['France', 'United States', 'France', 'Italy'] + ['United States'] * 5,
+        'Population': [2138551, 24782, 522969, 2318895, 116250, 167882, 60608, 30720, 17000],
+        'Coordinates': ['48.85341, 2.3488', '33.66094, -95.55551', '45.74846, 4.84671', '41.89193, 12.51133',
+                        '39.80172, -89.64371', '37.21533, -93.29824', '39.92423, -83.80882', '44.04624, -123.02203', '42.10148, -72.58981'],
+    })
+
+    with tempfile.TemporaryDirectory() as folder:
+        csv_path = os.path.join(folder, 'geonames.csv')
+        geonames_df.to_csv(csv_path, sep=';', index=False)
+        backend = GeoNamesBackend.from_file(csv_path)  # builds and saves geonames.npz
+        backend = GeoNamesBackend(GeoNamesIndex.load(os.path.join(folder, 'geonames.npz')))
+
+        status_paris, paris = backend.lookup('  paris ')
+        checks = {
+            # Paris, France has more than 10 times the inhabitants of Paris, Texas: only Paris, France is answered
+            'paris': status_paris == HIT and [result['address_components'][0]['long_name'] for result in paris] == ['France'],
+            'alternate name': backend.lookup('Lugdunum')[0] == HIT and backend.lookup('Roma')[1][0]['geometry']['location']['lat'] == 41.89193,
+            # No Springfield has 10 times the inhabitants of the next one: Google answers it
+            'ambiguous': backend.lookup('Springfield')[0] == AMBIGUOUS and GeoNamesBackend(backend.index, dominance=1.4).lookup('Springfield')[0] == HIT,
+            'miss': backend.lookup('Atlantis') == (MISS, []),
+        }
+
+        start = time.perf_counter()
+        for _ in range(10000):
+            backend.lookup('Lyon')
+        microseconds = (time.perf_counter() - start) / 10000 * 1e6
+
+        client = FakeGeocodeClient(latency=0.001)
+        metrics = GeocodeMetrics()
+        engine = GeocodeEngine(client, TokenBucket(qps=1000), max_workers=2, metrics=metrics, backends=[backend])
+        results = list(engine.geocode_many(['Paris', 'Lyon', 'Springfield', 'Atlantis', 'Roma']))
+        checks['only misses sent to the API'] = client.calls == 2 and all(error is None for _, _, error in results)
+
+        # A backend that does not implement lookup fails when it is created
+        class NoLookupBackend(GeocoderBackend):
+            name = 'no_lookup'
+        try:
+            NoLookupBackend()
+            checks['backend without lookup refused'] = False
+        except TypeError:
+            checks['backend without lookup refused'] = True
+
+    print(f"GeoNames: {checks}, {microseconds:.1f} microseconds per lookup, lookups {metrics.summary()['backend_lookups']}")
+    assert all(checks.values()), f"failed checks: {[name for name, passed in checks.items() if not passed]}"
+
+
+def test_standin_server(n_cities=200, workers=16):
+    """
+    Geocodes n_cities with the real googlemaps.Client against the synthetic stand-in server (with latency,
+    throttling and server errors) while recording a cassette, then replays the cassette and checks that
+    the replayed results are the same.
+    """
+    city_names = [f"Synthetic City {i}" for i in range(n_cities)]
+
+    with tempfile.TemporaryDirectory() as folder:
+        cassette = CassetteStore(os.path.join(folder, 'cassette.jsonl'))
+        server = start_standin(SyntheticResponder(latency_ms=20, latency_jitter_ms=10, zero_rate=0.05, throttle_rate=0.02, server_error_rate=0.01))
+        try:
+            client = googlemaps.Client(key="AIza-stand-in", base_url=server.base_url, retry_over_query_limit=False, queries_per_second=1000)
+            engine = GeocodeEngine(RecordingClient(client, cassette), TokenBucket(qps=500), max_workers=workers,
+                                   retry_policy=RetryPolicy(base_delay=0.01, max_delay=0.1))
+            start = time.perf_counter()
+            recorded = {city_name: (geocode_result, error) for city_name, geocode_result, error in engine.geocode_many(city_names)}
+            elapsed = time.perf_counter() - start
+            requests = server.requests
+        finally:
+            server.shutdown()
+
+        server = start_standin(ReplayResponder(CassetteStore(cassette.cassette_file)))
+        try:
+            client = googlemaps.Client(key="AIza-stand-in", base_url=server.base_url, queries_per_second=1000)
+            replayed = {city_name: geocode_result for city_name, geocode_result, _ in GeocodeEngine(client, TokenBucket(qps=1000)).geocode_many(city_names)}
+        finally:
+            server.shutdown()
+
+    errors = [city_name for city_name, (_, error) in recorded.items() if error is not None]
+    same = all(replayed[city_name] == geocode_result for city_name, (geocode_result, _) in recorded.items())
+    print(f"Stand-in: {n_cities} cities in {elapsed:.2f} s ({n_cities / elapsed:.1f}/s) with {requests} requests, "
+          f"{len(errors)} errors after retries, {len(cassette)} recorded, replay identical: {same}")
+    assert not errors, f"{len(errors)} errors after the retries, e.g. {errors[:5]}"
+    assert len(cassette) == n_cities, f"{len(cassette)} of {n_cities} responses recorded"
+    assert same, "the replayed results are not the recorded ones"
+
+
+def test_progress_journal(n_authors=1000):
+    """
+    Records the resolved cities of half the authors, cuts the last journal line (as a killed run would)
+    and checks that --resume restores the units written before the cut, and that another input file is not resumed.
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        input_file = os.path.join(folder, 'input.csv')
+        journal_file = os.path.join(folder, 'output_progress.jsonl')
+        pd.DataFrame({'borncity': [f"City {i}" for i in range(n_authors)]}).to_csv(input_file, index=False)
+        columns = ['borncity_coordinates', 'borncity_country', 'borncity_city_id', 'borncity_americas_or_oceania_before_discovery']
+        author_data = pd.DataFrame("", index=range(n_authors), columns=columns, dtype=object)
+
+        journal = ProgressJournal(journal_file, input_file)
+        for author in range(n_authors // 2):
+            journal.record(author, 'borncity', f"{author}.0, 1.0", 'France', author, 'no')
+        journal.flush()
+        with open(journal_file, 'rb+') as f:
+            f.truncate(os.path.getsize(journal_file) - 10)
+
+        resumed = ProgressJournal(journal_file, input_file, resume=True)
+        restored = resumed.restore(author_data)
+        values_ok = (author_data.loc[:restored - 1, 'borncity_city_id'].tolist() == list(range(restored))
+                     and (author_data.loc[restored:, 'borncity_coordinates'] == "").all())
+
+        with open(input_file, 'a') as f:
+            f.write("Another city\n")
+        other_input = ProgressJournal(journal_file, input_file, resume=True)
+
+    print(f"Progress journal: {restored} of {n_authors // 2} units restored after the cut line, values restored: {values_ok}, "
+          f"another input resumed: {len(other_input) > 0}")
+    assert restored == n_authors // 2 - 1, f"{restored} units restored, {n_authors // 2 - 1} written before the cut line"
+    assert values_ok, "the restored values are not the recorded ones"
+    assert len(other_input) == 0, "the journal of another input file was resumed"
+
+
+def test_shard_results(n_cities=1000, n_shards=4):
+    """
+    Checks that the shard of a city name is stable and balanced, and that the results of a shard
+    (results and errors) are read back the same after the shard is killed, so it resumes where it stopped.
+    """
+    city_names = [f"City {i}" for i in range(n_cities)]
+    shards = [shard_of(city_name, n_shards) for city_name in city_names]
+    stable = shards == [shard_of(city_name, n_shards) for city_name in city_names]
+    sizes = [shards.count(shard) for shard in range(n_shards)]
+
+    errors = {'City 1': googlemaps.exceptions.HTTPError(400), 'City 2': googlemaps.exceptions.ApiError('UNKNOWN_ERROR'),
+              'City 3': googlemaps.exceptions.Timeout()}
+    header = {'input': 'input.csv', 'shards': n_shards}
+    with tempfile.TemporaryDirectory() as folder:
+        results_file = os.path.join(folder, 'shard_0_of_4.jsonl')
+        results = ShardResults(results_file, header)
+        results.record('City 0', [{'geometry': {'location': {'lat': 1.0, 'lng': 2.0}}, 'address_components': []}])
+        for city_name, error in errors.items():
+            results.record(city_name, None, error)
+        with open(results_file, 'a') as f:
+            f.write('{"city": "City 4", "res')  # killed while writing
+
+        resumed = ShardResults(results_file, header)
+        errors_same = all(classify_error(resumed.results[city_name][1]) == classify_error(error)
+                          and failure_reason(resumed.results[city_name][1]) == failure_reason(error) for city_name, error in errors.items())
+        final = [city_name for city_name in ['City 0', 'City 1', 'City 2', 'City 3', 'City 4'] if resumed.is_final(city_name)]
+        other_run = ShardResults(results_file, dict(header, shards=n_shards + 1))
+
+    print(f"Shards: stable: {stable}, sizes {sizes}. Resumed results: {len(resumed.results)}, errors read back the same: {errors_same}, "
+          f"not geocoded again: {final}, results of another run used: {len(other_run.results) > 0}")
+    assert stable and min(sizes) > n_cities / n_shards * 0.8, f"shard sizes {sizes}"
+    assert len(resumed.results) == 4 and errors_same, "the results of the shard are not read back the same"
+    assert final == ['City 0', 'City 1'], f"not geocoded again: {final}"
+    assert not other_run.results, "the results of another run were used"
+
+
+def test_chunked_plan(n_authors=2000, n_cities=400, chunk_size=300):
+    """
+    Checks that the plan built from the author file read in chunks (streaming mode) is the same as the plan
+    of the whole file, in the same order (the order of the API calls, so of the new city_ids).
+    """
+    city_columns = ['borncity', 'deathcity', 'activecity']
+
+    def with_year_map(author_data):
+        return author_data.assign(year_map=compute_year_map(author_data))
+
+    with tempfile.TemporaryDirectory() as folder:
+        author_file = os.path.join(folder, 'authors.csv')
+        make_authors(n_authors, n_cities, author_file)
+        whole_plan = plan_unique_cities(with_year_map(pd.read_csv(author_file, dtype={2: str, 6: str})), city_columns, {}, {})
+        chunks = read_author_chunks(author_file, chunk_size)
+        chunked_plan = plan_unique_cities((with_year_map(chunk) for chunk in chunks), city_columns, {}, {})
+
+    same = whole_plan.equals(chunked_plan)
+    print(f"Chunked plan: {len(chunked_plan)} distinct names from chunks of {chunk_size} rows, same as the whole file: {same}")
+    assert same, "the plan of the chunks is not the plan of the whole file"
+
+
+def _script_in(folder):
+    """
+    Copies preprocessing_GoogleAPI.py to folder with its input, cache, cities_dict and output paths set to files of folder.
+    """
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'preprocessing_GoogleAPI.py'), encoding='utf-8') as f:
+        source = f.read()
+    for path, name in [('path/to/your/input_file.csv', 'authors.csv'), ('path/to/your/geocode_cache.sqlite', 'geocode_cache.sqlite'),
+                       ('path/to/your/geocode_cache.csv', 'legacy_cache.csv'), ('./path/to/your/cities_dict.json', 'cities_dict.json'),
+                       ('path/to/your/output_file.csv', 'output.csv'), ('path/to/your/output_file.xlsx', 'output.xlsx')]:
+        source = source.replace(f"'{path}'", f"'{name}'")
+    with open(os.path.join(folder, 'preprocessing_GoogleAPI.py'), 'w', encoding='utf-8') as f:
+        f.write(source)
+    shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'countries.json'), folder)
+
+
+def test_streaming_run(n_authors=1000, chunk_size=300):
+    """
+    Runs preprocessing_GoogleAPI.py end to end against the stand-in server: on the whole file, in streaming mode
+    (--chunk-size), and in streaming mode killed after the second chunk then continued with --resume.
+    Checks that the output CSV, cities_dict and cache of the streaming runs are the same as the ones of the whole file.
+    """
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    with tempfile.TemporaryDirectory() as folder:
+        make_authors(n_authors, n_authors // 5, os.path.join(folder, 'authors.csv'))
+        server = start_standin(SyntheticResponder(latency_ms=1, latency_jitter_ms=0.5))
+        try:
+            options = ['--api-base-url', server.base_url, '--qps', '2000', '--workers', '16', '--excel', 'off', '--output-formats', 'csv']
+            runs = {'whole': [], 'streaming': ['--chunk-size', str(chunk_size)], 'resumed': ['--chunk-size', str(chunk_size)]}
+            for name, run_options in runs.items():
+                run_folder = os.path.join(folder, name)
+                os.makedirs(run_folder)
+                shutil.copy(os.path.join(folder, 'authors.csv'), run_folder)
+                _script_in(run_folder)
+                command = [sys.executable, '-u', 'preprocessing_GoogleAPI.py'] + options + run_options
+                if name == 'resumed':
+                    # Killed once the second chunk is written, the journal has the units of the first two chunks
+                    process = subprocess.Popen(command, cwd=run_folder, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+                    for line in process.stdout:
+                        if line.startswith("(Streaming) Chunk 2 written"):
+                            process.kill()
+                            break
+                    process.wait()
+                    with open(os.path.join(run_folder, 'output_progress.jsonl')) as f:
+                        journaled = sum(1 for _ in f) - 1
+                    command = command + ['--resume']
+                subprocess.run(command, cwd=run_folder, env=env, check=True, capture_output=True)
+        finally:
+            server.shutdown()
+
+        def outputs(name):
+            run_folder = os.path.join(folder, name)
+            with open(os.path.join(run_folder, 'output.csv'), 'rb') as f:
+                output = f.read()
+            with open(os.path.join(run_folder, 'cities_dict.json')) as f:
+                cities_dict = json.load(f)
+            return output, cities_dict, read_cache_db(os.path.join(run_folder, 'geocode_cache.sqlite')).sort_values('city').reset_index(drop=True)
+
+        whole = outputs('whole')
+        same = {name: [whole[0] == run[0], whole[1] == run[1], whole[2].equals(run[2])]
+                for name, run in [(name, outputs(name)) for name in ['streaming', 'resumed']]}
+
+    print(f"Streaming run: chunks of {chunk_size} rows, {journaled} units journaled before the kill, "
+          f"[output, cities_dict, cache] same as the whole file: {same}")
+    assert journaled > 0, "the killed run did not journal any unit"
+    assert all(all(checks) for checks in same.values()), f"[output, cities_dict, cache] same as the whole file: {same}"
+
+
+def test_flags(n_cells=2000, seed=0):
+    """
+    Checks that the americas_or_oceania_before_discovery flags computed at once from the country registry
+    are the same as set_flag of funcs_prepr_GoogleAPI.py, one cell at a time.
+    """
+    with open('countries.json', 'r') as countries_file:
+        countries = json.load(countries_file)
+    rng = random.Random(seed)
+    country_names = countries['european_countries'][:5] + countries['americas_or_oceania_countries'] + ['India', None, float('nan')]
+    # year_map is a nullable Int32 column like compute_year_map gives, with missing years (pd.NA)
+    cells = pd.DataFrame({'country': [rng.choice(country_names) for _ in range(n_cells)],
+                          'year_map': pd.array([rng.choice([None, rng.randint(800, 1900)]) for _ in range(n_cells)], dtype='Int32')})
+    # An author without year_map in the Americas/Oceania gets "no"
+    cells.loc[0, ['country', 'year_map']] = [countries['americas_or_oceania_countries'][0], pd.NA]
+
+    # set_flag uses the globals of the original script
+    funcs_prepr_GoogleAPI.americas_or_oceania_countries = countries['americas_or_oceania_countries']
+    funcs_prepr_GoogleAPI.year_discovery = countries['year_discovery']
+    funcs_prepr_GoogleAPI.author_data = pd.DataFrame({'borncity_americas_or_oceania_before_discovery': ""}, index=cells.index)
+    start = time.perf_counter()
+    for cell in cells.index:
+        row = cells.loc[cell]  # keeps pd.NA (iterrows would turn it into NaN)
+        funcs_prepr_GoogleAPI.set_flag('borncity', cell, row['country'], row)
+    cell_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    flags = americas_or_oceania_flags(cells['country'], cells['year_map'], CountryRegistry(countries), no_discovery_flag="")
+    vectorized_seconds = time.perf_counter() - start
+
+    same = (flags.tolist() == funcs_prepr_GoogleAPI.author_data['borncity_americas_or_oceania_before_discovery'].tolist()
+            and flags[0] == "no")
+    # An alias has the region and discovery year of its country, and keeps its own name in the country columns
+    registry = CountryRegistry(dict(countries, country_aliases={'Brasil': 'Brazil'}))
+    alias_ok = (registry.is_americas_or_oceania('Brasil') and registry.discovery_year('Brasil') == registry.discovery_year('Brazil')
+                and list(registry.categorical(['Brasil', None, 'India'])[[0, 2]]) == ['Brasil', 'India'])
+    print(f"Flags: {int((flags == 'yes').sum())} of {n_cells} 'yes', same as set_flag: {same}, aliases: {alias_ok}. "
+          f"set_flag {cell_seconds:.3f} s, country registry {vectorized_seconds:.4f} s")
+    assert same, "the flags of the country registry are not the ones of set_flag"
+    assert alias_ok, "an alias does not have the region and discovery year of its country"
+
+
+def test_year_map(n_authors=2000):
+    """
+    Checks that the vectorized year_map is the same as the row-by-row loop it replaced
+    (death year, else birth year + 60) on a synthetic author file, and that it is a compact integer column.
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        author_file = os.path.join(folder, 'authors.csv')
+        make_authors(n_authors, n_authors // 5, author_file)
+        author_data = pd.read_csv(author_file, dtype={2: str, 6: str})
+
+    start = time.perf_counter()
+    by_row = {}
+    for author, row in author_data.iterrows():
+        by_row[author] = int(row['deathyear']) if pd.notna(row['deathyear']) else int(row['birthyear']) + 60
+    row_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    year_map = compute_year_map(author_data)
+    vectorized_seconds = time.perf_counter() - start
+
+    same = year_map.tolist() == [by_row[author] for author in author_data.index]
+    print(f"year_map: same as the row loop: {same}, dtype {year_map.dtype}. Row loop {row_seconds:.3f} s, vectorized {vectorized_seconds:.4f} s")
+    assert same, "the vectorized year_map is not the one of the row loop"
+    assert str(year_map.dtype) == 'Int32', f"year_map is {year_map.dtype}"
+
+
+def test_result_buffer(n_authors=2000, seed=0):
+    """
+    Checks that the resolved cells written in bulk by ResultBuffer give the same author data as
+    one author_data.at per cell (the last value of a cell wins).
+    """
+    rng = random.Random(seed)
+    city_columns = ['borncity', 'deathcity', 'activecity']
+    result_columns = [f'{city_col}_{name}' for city_col in city_columns
+                      for name in ['coordinates', 'country', 'city_id', 'americas_or_oceania_before_discovery']]
+    by_cell = pd.DataFrame("", index=range(10, 10 + n_authors), columns=result_columns, dtype=object)
+    in_bulk = by_cell.copy()
+
+    buffer = ResultBuffer()
+    for _ in range(n_authors * 2):
+        author, city_col = rng.randrange(10, 10 + n_authors), rng.choice(city_columns)
+        coordinates, country, city_id, flag = f"{rng.random()}, {rng.random()}", rng.choice(['Italy', 'Peru', None]), rng.randint(1, 999), rng.choice(['yes', 'no'])
+        by_cell.at[author, f'{city_col}_coordinates'] = coordinates
+        by_cell.at[author, f'{city_col}_country'] = country
+        by_cell.at[author, f'{city_col}_city_id'] = city_id
+        by_cell.at[author, f'{city_col}_americas_or_oceania_before_discovery'] = flag
+        buffer.add(author, city_col, coordinates, country, city_id, flag)
+
+    written = buffer.apply(in_bulk)
+    same = by_cell.equals(in_bulk)
+    print(f"Result buffer: {written} cells written in bulk, same as one author_data.at per cell: {same}, buffer emptied: {len(buffer) == 0}")
+    assert same, "the cells written in bulk are not the ones written one by one"
+    assert len(buffer) == 0, "the buffer was not emptied"
+
+
+def test_resolver(n_cities=500, n_authors=5000, seed=0):
+    """
+    Checks that the vectorized resolver chooses the same candidate as the row-by-row reference for every
+    (author, city column), on random candidates from Europe, the Americas/Oceania and elsewhere.
+    """
+    with open('countries.json', 'r') as countries_file:
+        countries = json.load(countries_file)
+    registry = CountryRegistry(countries)
+    rng = random.Random(seed)
+    country_names = (countries['european_countries'][:5] + countries['americas_or_oceania_countries'][:5]
+                     + ['India', 'China', 'Egypt', None])
+    city_columns = ['borncity', 'deathcity', 'activecity']
+
+    geocode_candidates = {f"City {i}": [{'coordinates': f"{i}, {j}", 'country': rng.choice(country_names), 'city_id': None}
+                                        for j in range(rng.randint(1, 4))] for i in range(n_cities)}
+    author_data = pd.DataFrame({city_col: [rng.choice([None, f"City {rng.randrange(n_cities + 100)}"]) for _ in range(n_authors)]
+                                for city_col in city_columns})
+    # Nullable integer like compute_year_map, with missing years (pd.NA)
+    author_data['year_map'] = pd.array([rng.choice([None, rng.randint(800, 1900)]) for _ in range(n_authors)], dtype='Int32')
+
+    authors = authors_table(author_data, city_columns)
+    candidates = candidates_table(geocode_candidates, authors['city'].unique())
+    start = time.perf_counter()
+    vectorized = resolve_candidates(candidates, authors, registry)
+    vectorized_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    reference = resolve_candidates_reference(candidates, authors, registry)
+    reference_seconds = time.perf_counter() - start
+
+    same = vectorized.equals(reference)
+    not_first = int((vectorized > 0).sum())
+    # Europe first, then elsewhere, then the Americas/Oceania, for an author who died before the discovery
+    americas = countries['americas_or_oceania_countries'][0]
+    rule = ([choose_candidate([{'country': americas}, {'country': 'India'}, {'country': countries['european_countries'][0]}], 1000, registry),
+             choose_candidate([{'country': americas}, {'country': 'India'}], 1000, registry),
+             choose_candidate([{'country': 'India'}, {'country': americas}], 1000, registry),
+             choose_candidate([{'country': 'India'}, {'country': americas}], 1900, registry),
+             # A missing year_map keeps the first candidate, in the row-by-row and the vectorized resolver
+             choose_candidate([{'country': americas}, {'country': 'India'}], pd.NA, registry),
+             choose_candidate([{'country': americas}, {'country': 'India'}], None, registry),
+             resolve_candidates(pd.DataFrame({'city': 'Missing', 'choice': [0, 1], 'coordinates': '0, 0', 'country': [americas, 'India']}),
+                                pd.DataFrame({'city': ['Missing'], 'year_map': pd.array([pd.NA], dtype='Int32')}), registry).tolist()[0]]
+            == [2, 1, 0, 0, 0, 0, 0])
+    print(f"Resolver: {len(authors)} city cells, {not_first} not the first candidate, same as the reference: {same}, "
+          f"rule checks: {rule}. Vectorized {vectorized_seconds:.3f} s, row by row {reference_seconds:.3f} s")
+    assert same, "the vectorized resolver did not choose the candidates of the reference"
+    assert rule, "the choices do not follow the rule (Europe, then elsewhere, then the Americas/Oceania)"
+    assert not_first > 0, "every choice is the first candidate, the rule was not exercised"
+
+
+def test_cache_mapping(n_cities=2000, n_authors=20000, seed=0):
+    """
+    Checks that map_cache_columns (one reindex per city column) gives the same columns as the three
+    geocode_cache.get(city, {}).get(...) maps per city column, from the cache dictionary and from a columnar cache.
+    """
+    rng = random.Random(seed)
+    city_columns = ['borncity', 'deathcity', 'activecity']
+    geocode_cache = {f"City {i}": {'coordinates': f"{i}, {i}", 'country': rng.choice(['Italy', 'Peru', None]), 'city_id': i + 1}
+                     for i in range(n_cities)}
+    author_data = pd.DataFrame({city_col: [rng.choice([None, f"City {rng.randrange(n_cities + 1000)}"]) for _ in range(n_authors)]
+                                for city_col in city_columns})
+
+    start = time.perf_counter()
+    by_lambda = author_data.copy()
+    for city_col in city_columns:
+        for name in ['coordinates', 'country', 'city_id']:
+            by_lambda[f'{city_col}_{name}'] = by_lambda[city_col].map(lambda city: geocode_cache.get(city, {}).get(name, ""))
+    lambda_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    by_reindex = map_cache_columns(author_data.copy(), city_columns, geocode_cache)
+    reindex_seconds = time.perf_counter() - start
+
+    cache_df = pd.DataFrame([[city, data['coordinates'], data['country'], data['city_id']] for city, data in geocode_cache.items()],
+                            columns=CACHE_COLUMNS)
+    from_columnar = map_cache_columns(author_data.copy(), city_columns, cache_df)
+
+    # A None in the cache is written as an empty cell, like ""
+    expected = by_lambda.fillna("")
+    same = expected.equals(by_reindex.fillna("")) and expected.equals(from_columnar.fillna(""))
+    print(f"Cache mapping: {n_authors} authors, same as the lambda maps: {same}. "
+          f"Lambda maps {lambda_seconds:.3f} s, one index lookup per city column {reindex_seconds:.3f} s")
+    assert same, "the mapped columns are not the ones of the lambda maps"
+
+
+def test_typed_schema(n_authors=5000, n_cities=1000, seed=0):
+    """
+    Checks that the typed author data (lat/lng floats, categoricals, Int32) written through legacy_view gives
+    the same CSV as the string columns, that read_author_output reads it back to the same typed data,
+    and compares the memory of both.
+    """
+    with open('countries.json', 'r') as countries_file:
+        registry = CountryRegistry(json.load(countries_file))
+    rng = random.Random(seed)
+    city_columns = ['borncity', 'deathcity', 'activecity']
+    cities = {f"City {i}": (f"{round(rng.uniform(-60, 70), 6)}, {round(rng.uniform(-180, 180), 6)}", rng.choice(['Italy', 'Peru', 'India', None]), i + 1)
+              for i in range(n_cities)}
+
+    author_data = pd.DataFrame({'indexauthor': range(1, n_authors + 1), 'deathyear': [rng.choice([None, rng.randint(900, 1800)]) for _ in range(n_authors)]})
+    for city_col in city_columns:
+        author_data[city_col] = [rng.choice([None, f"City {rng.randrange(n_cities + 100)}"]) for _ in range(n_authors)]
+    author_data = init_result_columns(author_data, city_columns)
+    author_data['year_map'] = pd.array(author_data['deathyear'], dtype='Int32')
+    for city_col in city_columns:
+        found = [cities.get(city, ("", "", "")) for city in author_data[city_col]]
+        author_data[f'{city_col}_coordinates'] = [entry[0] for entry in found]
+        author_data[f'{city_col}_country'] = [entry[1] for entry in found]
+        author_data[f'{city_col}_city_id'] = [entry[2] for entry in found]
+        author_data[f'{city_col}_americas_or_oceania_before_discovery'] = [rng.choice(['yes', 'no', None]) if entry[0] else None for entry in found]
+
+    with tempfile.TemporaryDirectory() as folder:
+        strings_csv, typed_csv = os.path.join(folder, 'strings.csv'), os.path.join(folder, 'typed.csv')
+        author_data.to_csv(strings_csv, index=False)
+        strings_memory = author_data.memory_usage(deep=True).sum()
+
+        typed = to_typed(author_data.copy(), city_columns, registry)
+        typed_memory = typed.memory_usage(deep=True).sum()
+        legacy_view(typed).to_csv(typed_csv, index=False)
+        with open(strings_csv, 'rb') as f1, open(typed_csv, 'rb') as f2:
+            same_csv = f1.read() == f2.read()
+
+        read_back = read_author_output(typed_csv, city_columns)
+        same_typed = all(read_back[column].astype(object).fillna("").equals(typed[column].astype(object).fillna("")) for column in typed.columns)
+
+    print(f"Typed schema: same CSV: {same_csv}, read back the same: {same_typed}. "
+          f"Memory {strings_memory / 1e6:.1f} MB with strings, {typed_memory / 1e6:.1f} MB typed ({strings_memory / typed_memory:.1f}x less)")
+    assert same_csv, "the CSV of the typed data is not the CSV of the string columns"
+    assert same_typed, "the typed data read back is not the same"
+
+
+def test_output_writer(n_authors=2000, chunk_size=700, seed=0):
+    """
+    Checks that the OutputWriter files are the same in every mode: Parquet and Feather (written at once and chunk by chunk)
+    read back to the same typed data as the CSV, the Excel file of the background worker, of the streaming mode and of export-excel are the same
+    as the inline one. Compares the time a stage waits in write() with the Excel file inline and in the background.
+    """
+    rng = random.Random(seed)
+    city_columns = ['borncity', 'deathcity', 'activecity']
+    author_data = init_result_columns(pd.DataFrame({'indexauthor': range(1, n_authors + 1),
+                                                    'nameandbirthdeathyear': [f"Author {i}" for i in range(n_authors)]}), city_columns)
+    for city_col in city_columns:
+        has_city = [rng.random() < 0.7 for _ in range(n_authors)]
+        author_data[city_col] = [f"City {rng.randrange(500)}" if has else None for has in has_city]
+        author_data[f'{city_col}_coordinates'] = [f"{round(rng.uniform(-60, 70), 6)}, {round(rng.uniform(-180, 180), 6)}" if has else "" for has in has_city]
+        author_data[f'{city_col}_country'] = [rng.choice(['Italy', 'Peru']) if has else None for has in has_city]
+        author_data[f'{city_col}_city_id'] = [rng.randint(1, 500) if has else None for has in has_city]
+    typed = to_typed(author_data, city_columns)
+
+    with tempfile.TemporaryDirectory() as folder:
+        waited = {}
+        for excel in ['inline', 'background']:
+            writer = OutputWriter(formats=['parquet', 'feather', 'csv'], excel=excel)
+            start = time.perf_counter()
+            writer.write(typed, os.path.join(folder, f'{excel}.csv'), os.path.join(folder, f'{excel}.xlsx'))
+            waited[excel] = time.perf_counter() - start
+            writer.close()
+
+        streaming = OutputWriter(formats=['parquet', 'feather', 'csv'], excel='background')
+        for i, start_row in enumerate(range(0, n_authors, chunk_size)):
+            streaming.append(typed.iloc[start_row:start_row + chunk_size], os.path.join(folder, 'streaming.csv'), os.path.join(folder, 'streaming.xlsx'), first=i == 0)
+        streaming.close()
+        export_excel(os.path.join(folder, 'inline.parquet'), os.path.join(folder, 'exported.xlsx'))
+
+        from_csv = read_author_output(os.path.join(folder, 'inline.csv'))
+        same_columnar = all(
+            all(read_back[column].astype(object).fillna("").astype(str).equals(from_csv[column].astype(object).fillna("").astype(str)) for column in from_csv)
+            for read_back in [read_author_output(os.path.join(folder, name)) for name in ['inline.parquet', 'inline.feather', 'streaming.parquet', 'streaming.feather']])
+        inline_excel = pd.read_excel(os.path.join(folder, 'inline.xlsx'))
+        same_excel = all(pd.read_excel(os.path.join(folder, name)).equals(inline_excel) for name in ['background.xlsx', 'streaming.xlsx', 'exported.xlsx'])
+        with open(os.path.join(folder, 'inline.csv'), 'rb') as f1, open(os.path.join(folder, 'streaming.csv'), 'rb') as f2:
+            same_csv = f1.read() == f2.read()
+
+        # Without a writer, write_outputs has written the Excel file when it returns, and an Excel error is raised by the call
+        write_outputs(typed.head(100), os.path.join(folder, 'stage.csv'), os.path.join(folder, 'stage.xlsx'))
+        written_on_return = os.path.exists(os.path.join(folder, 'stage.xlsx')) and os.path.exists(os.path.join(folder, 'stage.parquet'))
+        try:
+            write_outputs(typed.head(100), os.path.join(folder, 'stage.csv'), os.path.join(folder, 'missing_folder', 'stage.xlsx'))
+            error_raised = False
+        except OSError:
+            error_raised = True
+
+    print(f"Output writer: columnar files same as the CSV: {same_columnar}, Excel files the same: {same_excel}, streaming CSV the same: {same_csv}. "
+          f"write() waited {waited['inline']:.2f} s with the Excel file inline, {waited['background']:.2f} s in the background. "
+          f"write_outputs without a writer: written on return {written_on_return}, Excel error raised {error_raised}")
+    assert same_columnar, "the Parquet/Feather files are not read back to the data of the CSV"
+    assert same_excel, "the Excel files are not the same as the inline one"
+    assert same_csv, "the streaming CSV is not the same"
+    assert written_on_return and error_raised, "write_outputs without a writer did not write the files (or raise the error) before returning"
+
+
+def test_csv_checkpoints(n_cache=5000, n_checkpoints=20, entries_per_checkpoint=50):
+    """
+    Checks that the checkpoints of a CSV cache append the new rows without rewriting the file, and that
+    close() keeps the rows of a city with several entries (only rows duplicated in every column are dropped).
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        cache_file = os.path.join(folder, 'geocode_cache.csv')
+        legacy_rows = pd.DataFrame([['Springfield', '39.8, -89.6', 'United States', 1], ['Springfield', '42.1, -72.6', 'United States', 2]],
+                                   columns=CACHE_COLUMNS)
+        pd.concat([legacy_rows, pd.DataFrame({'city': [f"City {i}" for i in range(n_cache)], 'coordinates': [f"{i}, {i}" for i in range(n_cache)],
+                                              'country': 'Testland', 'city_id': range(3, n_cache + 3)})]).to_csv(cache_file, index=False)
+        with open(cache_file, 'rb') as f:
+            original = f.read()
+
+        cache_writer = CacheWriteBehind(cache_file, {}, flush_every=entries_per_checkpoint, flush_interval=3600)
+        start = time.perf_counter()
+        for i in range(n_checkpoints * entries_per_checkpoint):
+            cache_writer.enqueue_entry(f"New City {i}", f"-{i}, {i}", 'Testland', n_cache + i + 3)
+            cache_writer.enqueue_city_id(i, 'borncity', n_cache + i + 3)
+        cache_writer.flush()
+        checkpoint_seconds = time.perf_counter() - start
+        with open(cache_file, 'rb') as f:
+            appended = f.read().startswith(original)
+
+        cache_writer.enqueue_entry('New City 0', '-0, 0', 'Testland', n_cache + 3)  # the same row again
+        cache_writer.close()
+        cache_df = pd.read_csv(cache_file)
+        compacted = (len(cache_df) == n_cache + 2 + n_checkpoints * entries_per_checkpoint
+                     and (cache_df['city'] == 'Springfield').sum() == 2)
+
+    print(f"CSV cache: {n_checkpoints} checkpoints in {checkpoint_seconds:.3f} s appended without rewriting the file: {appended}, "
+          f"compacted on close with the rows of a city with several entries kept: {compacted}")
+    assert appended, "a checkpoint rewrote the CSV cache"
+    assert compacted, "close() did not keep the rows of the cache, or kept a duplicated row"
+
+
+def test_snapshot_checkpoints(n_snapshot=10000, n_checkpoints=20, entries_per_checkpoint=50):
+    """
+    Checks that the checkpoints of a snapshot cache append the new entries to its log without rewriting the
+    snapshot, that the entries are found after a reload, and that close() merges the log into the snapshot
+    while the cache is open (the snapshot is unmapped before it is replaced).
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        cache_file = os.path.join(folder, 'geocode_cache.arrow')
+        write_cache_snapshot(pd.DataFrame({'city': [f"City {i}" for i in range(n_snapshot)], 'coordinates': [f"{i}, {i}" for i in range(n_snapshot)],
+                                           'country': 'Testland', 'city_id': range(1, n_snapshot + 1)}), cache_file)
+        snapshot_state = os.stat(cache_file).st_mtime_ns, os.path.getsize(cache_file)
+
+        geocode_cache, _ = load_geocode_cache_snapshot(cache_file)
+        cache_writer = CacheWriteBehind(cache_file, geocode_cache, flush_every=entries_per_checkpoint, flush_interval=3600)
+        start = time.perf_counter()
+        for i in range(n_checkpoints * entries_per_checkpoint):
+            city = f"New City {i}"
+            geocode_cache[city] = {'coordinates': f"-{i}, {i}", 'country': 'Testland', 'city_id': n_snapshot + i + 1}
+            cache_writer.enqueue_entry(city, f"-{i}, {i}", 'Testland', n_snapshot + i + 1)
+        cache_writer.flush()
+        checkpoint_seconds = time.perf_counter() - start
+
+        not_rewritten = (os.stat(cache_file).st_mtime_ns, os.path.getsize(cache_file)) == snapshot_state
+        reloaded, max_city_id = load_geocode_cache_snapshot(cache_file)
+        reloaded_ok = reloaded.get('New City 7', {}).get('coordinates') == '-7, 7' and max_city_id == n_snapshot + n_checkpoints * entries_per_checkpoint
+        reloaded.close()
+
+        start = time.perf_counter()
+        cache_writer.close()
+        close_seconds = time.perf_counter() - start
+        compacted = (not os.path.exists(snapshot_log_file(cache_file)) and len(read_cache_frame(cache_file)) == n_snapshot + n_checkpoints * entries_per_checkpoint
+                     and geocode_cache['City 5']['city_id'] == 6 and geocode_cache['New City 3']['coordinates'] == '-3, 3')
+        geocode_cache.close()
+
+    print(f"Snapshot cache: {n_checkpoints} checkpoints in {checkpoint_seconds:.3f} s without rewriting the snapshot: {not_rewritten}, "
+          f"entries found after a reload: {reloaded_ok}, log merged on close ({close_seconds:.3f} s): {compacted}")
+    assert not_rewritten, "a checkpoint rewrote the snapshot"
+    assert reloaded_ok, "the entries of the checkpoints were not found after a reload"
+    assert compacted, "close() did not merge the log into the snapshot"
+
+
+def test_latency_percentiles(n_observations=50000, seed=0):
+    """
+    Checks that the percentiles of LatencyHistogram, read from its fine buckets, are within 2% of the exact
+    nearest-rank percentiles, and that the histogram does not grow with the number of observations.
+    """
+    rng = random.Random(seed)
+    durations = [rng.lognormvariate(math.log(0.08), 0.8) for _ in range(n_observations)]  # seconds, around 80 ms
+    histogram = LatencyHistogram()
+    for seconds in durations:
+        histogram.observe(seconds)
+
+    start = time.perf_counter()
+    summary = histogram.to_dict()
+    summary_seconds = time.perf_counter() - start
+    ordered = sorted(seconds * 1000 for seconds in durations)
+    errors = {q: abs(summary[f'p{q}_ms'] - ordered[max(int(round(q / 100 * n_observations)) - 1, 0)]) / ordered[max(int(round(q / 100 * n_observations)) - 1, 0)]
+              for q in (50, 95, 99)}
+    close = all(error <= 0.02 for error in errors.values()) and summary['max_ms'] == round(ordered[-1], 3)
+    small = len(histogram.fine_counts) < 1000
+    print(f"Latency percentiles: relative errors {', '.join(f'p{q} {error:.4f}' for q, error in errors.items())}, "
+          f"{len(histogram.fine_counts)} fine buckets for {n_observations} observations, summary in {summary_seconds * 1000:.2f} ms")
+    assert close, f"relative errors of the percentiles {errors}"
+    assert small, f"{len(histogram.fine_counts)} fine buckets"
+
+
+def test_calls_avoided():
+    """
+    Checks that the API calls avoided are counted once per distinct name found in the cache, not once per cell,
+    and that the later cells of a name geocoded in this run do not count as avoided calls.
+    """
+    metrics = GeocodeMetrics()
+    for author in range(100):  # 100 authors born in Paris (cached) and dead in Atlantis (negative cache)
+        metrics.cache_hit('borncity', 'Paris')
+        metrics.negative_cache_hit('deathcity', 'Atlantis')
+    metrics.cache_miss('borncity', 'Lyon')  # geocoded in this run, then found in the cache for the other authors
+    for author in range(50):
+        metrics.cache_hit('borncity', 'Lyon')
+
+    summary = metrics.summary()
+    print(f"Calls avoided: {summary['api_calls_avoided']} API calls avoided, {summary['cells_served_from_cache']} cells served from the cache")
+    assert summary['api_calls_avoided'] == 2, f"{summary['api_calls_avoided']} API calls avoided, 2 distinct names were in the caches"
+    assert summary['cells_served_from_cache'] == 250, f"{summary['cells_served_from_cache']} cells served from the cache"
+
+
+# The checks of python tests.py <name> (an AssertionError tells which check failed)
+CHECKS = {
+    'metrics': [test_latency_percentiles, test_calls_avoided],  # latency histogram percentiles and API calls avoided
+    'csv_cache': [test_csv_checkpoints],                         # append-only checkpoints of a CSV cache
+    'snapshot': [test_snapshot_checkpoints],                     # checkpoints of a memory-mapped snapshot cache
+    'outputs': [test_output_writer],                             # Parquet/Feather, CSV, Excel inline, in the background and exported
+    'schema': [test_typed_schema],                               # typed author schema and its legacy CSV view
+    'mapping': [test_cache_mapping],                             # cache columns mapped with one reindex per city column
+    'flags': [test_flags],                                       # americas_or_oceania_before_discovery flags from the country registry
+    'year_map': [test_year_map],                                 # vectorized year_map
+    'buffer': [test_result_buffer],                              # bulk write-back of the resolved cities
+    'resolver': [test_resolver],                                 # vectorized candidate resolver against the row-by-row reference
+    'chunks': [test_chunked_plan],                               # plan of the streaming mode
+    'shards': [test_shard_results],                              # shard partition and resumable shard results
+    'streaming': [test_streaming_run],                           # streaming mode end to end, with a killed run continued with --resume
+    'journal': [test_progress_journal],                          # resume from the progress journal
+    'standin': [test_standin_server],                            # record/replay against the local stand-in server
+    'geonames': [test_geonames_backend],                         # offline GeoNames geocoder
+    'retry': [test_retry_policy],                                # retry and backoff of the API errors
+    'engine': [test_concurrent_engine],                          # concurrent geocoding engine against a fake client with latency
+    'stress': [test_shared_cache],                               # several workers sharing one cache
+}
+
+
+if __name__ == '__main__':
+    # Run one group of checks: python tests.py engine (or python -m pytest tests.py for all of them)
+    if len(sys.argv) > 1 and sys.argv[1] in CHECKS:
+        for check in CHECKS[sys.argv[1]]:
+            check()
+        sys.exit(0)
+
+    # Add your file
+    file_path = 'path/to/your/file.csv'
+    check_ungeocoded_locations(file_path)
@@ -21,6 +21,7 @@ Created on Mon Aug 14 2024
 # Import libraries
 import geopandas as gpd
 import pandas as pd
+import numpy as np
 import matplotlib.pyplot as plt
 import contextily as cx
 import os
@@ -31,18 +32,21 @@ from shapely.geometry import Point, LineString
 import matplotlib.colors as mcolors
 from matplotlib_scalebar.scalebar import ScaleBar
 import matplotlib.patches as mpatches
+from funcs_prepr_GoogleAPI import compute_year_map
+from geocode_schema import read_author_output, split_coordinates
+from geocode_outputs import write_outputs
 
 
 
-# Set file paths for Spyder
+# Set file paths for Spyder (the CSV or the Parquet file written by preprocessing_GoogleAPI.py)
 file_path = 'path/to/your/file.csv'
 # Set file paths for relative paths
 
 output_images_dir = 'path/to/your/output/folder'
 os.makedirs(output_images_dir, exist_ok=True)
 
-# Load data
-authors_small_cities = pd.read_csv(file_path)
+# Load data (typed: lat/lng floats, categorical cities, countries and flags)
+authors_small_cities = read_author_output(file_path)
 
 
 def combine_geographic_data(df):
@@ -53,37 +57,33 @@ def combine_geographic_data(df):
     :param df: pd.DataFrame, the DataFrame containing geographic coordinates and temporal data.
     :return: gpd.GeoDataFrame, the combined and filtered GeoDataFrame with geographic and temporal adjustments.
     """
-    # Function to split coordinates into latitude and longitude
-    def parse_coordinates(coord_str):
-        try:
-            lat, lon = map(float, coord_str.split(", "))
-            return lon, lat  # Order should be (lon, lat) for Point
-        except:
-            return None, None
-
-    # Extract coordinates for birth, death, and active locations
-    birth_points = gpd.GeoSeries(
-        [Point(parse_coordinates(xy)) if xy and pd.notnull(xy) else None for xy in df['borncity_coordinates']],
-        crs="EPSG:4326"
-    )
-    death_points = gpd.GeoSeries(
-        [Point(parse_coordinates(xy)) if xy and pd.notnull(xy) else None for xy in df['deathcity_coordinates']],
-        crs="EPSG:4326"
-    )
-    active_points = gpd.GeoSeries(
-        [Point(parse_coordinates(xy)) if xy and pd.notnull(xy) else None for xy in df['activecity_coordinates']],
-        crs="EPSG:4326"
-    )
-
-    # Combine points into a single GeoSeries, prioritizing death, active, then birth
-    combined_points = death_points.fillna(active_points).fillna(birth_points)
+    # Latitude and longitude of each location: the lat/lng columns of the typed data, or split from the "lat, lng" strings
+    def lat_lng(city_col):
+        if f'{city_col}_lat' in df:
+            return df[f'{city_col}_lat'].to_numpy(dtype='float64'), df[f'{city_col}_lng'].to_numpy(dtype='float64')
+        return split_coordinates(df[f'{city_col}_coordinates'])
+
+    # Combine the locations, prioritizing death, active, then birth
+    lat = np.full(len(df), np.nan)
+    lng = np.full(len(df), np.nan)
+    for city_col in ['borncity', 'activecity', 'deathcity']:
+        city_lat, city_lng = lat_lng(city_col)
+        has_location = ~np.isnan(city_lat)
+        lat[has_location] = city_lat[has_location]
+        lng[has_location] = city_lng[has_location]
+
+    combined_points = gpd.GeoSeries(gpd.points_from_xy(lng, lat), index=df.index, crs="EPSG:4326")
+    combined_points[np.isnan(lat)] = None
     
     # Create a GeoDataFrame using the combined geometry column
     authors_geo_df = gpd.GeoDataFrame(df, geometry=combined_points)
     authors_geo_df = authors_geo_df[authors_geo_df.geometry.notnull()]  # Filter non-null geometry
 
-    # Use the 'year_map' column as 'effective_year' 
-    authors_geo_df['effective_year'] = authors_geo_df['year_map']
+    # Use the 'year_map' column as 'effective_year' (computed the same way as in the preprocessing if the file has no year_map)
+    if 'year_map' in authors_geo_df:
+        authors_geo_df['effective_year'] = authors_geo_df['year_map'].astype('Int32')
+    else:
+        authors_geo_df['effective_year'] = compute_year_map(authors_geo_df)
     
     # Convert CRS to Web Mercator for mapping
     authors_geo_df = authors_geo_df.set_crs("EPSG:4326").to_crs(epsg=3857)
@@ -278,7 +278,7 @@ def plot_authors_birth_death(gdf, start_year, end_year, output_dir):
 
     """
    
-    gdf = gdf[(gdf['deathyear'] >= start_year) & (gdf['deathyear'] <= end_year)  
+    gdf = gdf[(gdf['deathyear'] >= start_year) & (gdf['deathyear'] <= end_year)]
     gdf = gdf.dropna(subset=['latitude_born', 'longitude_born', 'latitude_death', 'longitude_death'])
 
     gdf['birth_point'] = gdf.apply(lambda row: Point(row['longitude_born'], row['latitude_born']), axis=1)
@@ -513,18 +513,14 @@ def combine_year_columns(authors_within_boundaries, northsea_gdf):
 
 def save_combined_authors_to_files(combined_authors, file_path_excel, file_path_csv):
     """
-    Saves the combined GeoDataFrame to both Excel and CSV files.
+    Saves the combined GeoDataFrame to CSV and GeoParquet files, and to an Excel file (see geocode_outputs.py).
 
     Parameters:
     combined_authors (GeoDataFrame): The combined GeoDataFrame of authors data.
     file_path_excel (str): Path where the Excel file will be saved.
     file_path_csv (str): Path where the CSV file will be saved.
     """
-    # Save the GeoDataFrame as an Excel file
-    combined_authors.to_excel(file_path_excel, index=False)
-
-    # Save the GeoDataFrame as a CSV file
-    combined_authors.to_csv(file_path_csv, index=False)
+    write_outputs(combined_authors, file_path_csv, file_path_excel)
 
 
 